@@ -0,0 +1,82 @@
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from mock_legacy_server import start_mock_server
+from download_lagacy_imagescoloured_final_v2 import download_legacy
+from download_legacy_async import download_legacy_async
+
+# Benchmark de los motores de descarga contra el servidor local sintético
+
+
+def synthetic_catalog(n, seed=42):
+    """Catálogo aleatorio con columnas ra/dec"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'ra': rng.uniform(0, 360, n),
+        'dec': rng.uniform(-60, 30, n),
+    })
+
+
+def run_engine(name, func, data, base_url, **kwargs):
+    out_path = tempfile.mkdtemp(prefix=f'bench_{name}_')
+    try:
+        start = time.perf_counter()
+        func(data, out_path, 256, base_url=base_url, **kwargs)
+        elapsed = time.perf_counter() - start
+        n_files = sum(1 for f in os.listdir(out_path) if f.endswith('.jpeg'))
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return elapsed, n_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thread vs asyncio download engines")
+    parser.add_argument("--n", type=int, default=2000, help="Number of synthetic cutouts")
+    parser.add_argument("--concurrency", type=int, default=32, help="Async engine concurrency")
+    parser.add_argument("--priority", type=float, default=0.5, help="Thread engine priority")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Simulated server latency per request (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of injected 503 responses")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help="Server concurrency before latency grows / 429s (default: unlimited)")
+    parser.add_argument("--fixed", action="store_true",
+                        help="Also run the async engine with a fixed (non-adaptive) limit")
+    args = parser.parse_args()
+
+    # Evitar una línea de log por imagen
+    logging.getLogger().setLevel(logging.WARNING)
+
+    server, base_url = start_mock_server(latency=args.latency, error_rate=args.error_rate,
+                                        capacity=args.capacity)
+    data = synthetic_catalog(args.n)
+
+    results = {}
+    try:
+        results['threads'] = run_engine('threads', download_legacy, data, base_url,
+                                        priority=args.priority)
+        results['async'] = run_engine('async', download_legacy_async, data, base_url,
+                                      concurrency=args.concurrency)
+        if args.fixed:
+            results['fixed'] = run_engine('fixed', download_legacy_async, data, base_url,
+                                          concurrency=args.concurrency, adaptive=False)
+    finally:
+        server.shutdown()
+
+    print(f"\nBenchmark: {args.n} cutouts from {base_url} (latency={args.latency}s, "
+          f"error_rate={args.error_rate}, capacity={args.capacity})")
+    for name, (elapsed, n_files) in results.items():
+        print(f"  {name:8s} {elapsed:8.2f}s  {n_files / elapsed:8.1f} img/s  ({n_files} files)")
+    speedup = results['threads'][0] / results['async'][0]
+    print(f"  async speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
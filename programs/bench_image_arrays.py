@@ -0,0 +1,70 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from mock_legacy_server import synthetic_jpeg
+from rebuild_image_arrays import list_images, process_image, build_image_array
+
+# Benchmark del constructor de X_{set}.npy: bucle serie original frente al
+# constructor multiproceso sobre un conjunto sintético de JPEGs.
+
+
+def make_jpeg_set(path, n, size=256):
+    """n JPEGs sintéticos de size x size con nombres tipo download_legacy"""
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        ra, dec = rng.uniform(0, 360), rng.uniform(-60, 30)
+        with open(os.path.join(path, f"{ra}_{dec}_{i}_{size}pix.jpeg"), 'wb') as f:
+            f.write(synthetic_jpeg(size, seed=i % 64))
+
+
+def serial_build(input_dir, output_path):
+    """Bucle original de rebuild_image_arrays.py (lista + np.array)"""
+    images = []
+    for filename in list_images(input_dir):
+        images.append(process_image(os.path.join(input_dir, filename)))
+    images_array = np.array(images, dtype=np.float32)
+    np.save(output_path, images_array)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serial vs parallel image-array builder")
+    parser.add_argument("--n", type=int, default=2000, help="Number of synthetic JPEGs")
+    parser.add_argument("--workers", type=int, nargs='+', default=None,
+                        help="Worker counts to test (default: 1 and all cores)")
+    args = parser.parse_args()
+
+    workers_list = args.workers or sorted({1, os.cpu_count() or 1})
+    tmp = tempfile.mkdtemp(prefix='bench_arrays_')
+    try:
+        input_dir = os.path.join(tmp, 'jpeg')
+        make_jpeg_set(input_dir, args.n)
+
+        serial_path = os.path.join(tmp, 'X_serial.npy')
+        start = time.perf_counter()
+        serial_build(input_dir, serial_path)
+        serial_time = time.perf_counter() - start
+
+        print(f"\nImage-array benchmark ({args.n} JPEGs, {os.cpu_count()} cores)")
+        print(f"  serial        {serial_time:7.2f}s  {args.n / serial_time:7.1f} img/s")
+
+        reference = np.load(serial_path, mmap_mode='r')
+        for workers in workers_list:
+            parallel_path = os.path.join(tmp, f'X_parallel_{workers}.npy')
+            start = time.perf_counter()
+            build_image_array(input_dir, parallel_path, workers=workers)
+            elapsed = time.perf_counter() - start
+            identical = np.array_equal(reference, np.load(parallel_path, mmap_mode='r'))
+            print(f"  parallel x{workers:<3d} {elapsed:7.2f}s  {args.n / elapsed:7.1f} img/s  "
+                  f"speedup {serial_time / elapsed:5.2f}x  identical={identical}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
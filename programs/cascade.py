@@ -0,0 +1,148 @@
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+
+from input_pipeline import ArraySource, ARRAY_DIR, LABEL_DIR
+from classical_features import (extract_features, image_features, predict_scores, set_n_jobs,
+                                MODEL_DIR)
+from export_model import load_scorer, predict
+
+# Cascada de dos etapas delante de la CNN.
+#
+# Etapa 1: features clásicas + RF/SVM (classical_features.py), cientos de
+# veces más barata que la CNN. Solo las posiciones con score >= umbral
+# pasan a la etapa 2 (DeepShadows); el resto se descartan como artefactos.
+# El umbral se ajusta en validación para conservar una fracción objetivo
+# de las galaxias LSB (recall de la etapa 1) y el informe en test compara
+# el cómputo ahorrado con el recall perdido respecto a la CNN sola.
+
+DEFAULT_TARGETS = (0.99, 0.995, 0.999)
+
+# Score de las posiciones descartadas por la etapa 1
+REJECTED_SCORE = 0.0
+
+
+def threshold_for_recall(scores, labels, target):
+    """Mayor umbral que deja pasar al menos target de los positivos"""
+    positives = np.sort(scores[labels == 1])
+    if len(positives) == 0:
+        return -np.inf
+    keep = int(np.ceil(target * len(positives)))
+    return positives[len(positives) - keep] if keep else np.inf
+
+
+class CascadeScorer:
+    """Batch float32 -> scores; la CNN solo ve lo que supera el umbral"""
+
+    def __init__(self, stage1, threshold, cnn):
+        self.stage1 = stage1
+        self.threshold = threshold
+        self.cnn = cnn
+        self.seen = 0
+        self.passed = 0
+
+    def __call__(self, x):
+        scores = np.full(len(x), REJECTED_SCORE, dtype=np.float32)
+        passed = predict_scores(self.stage1, image_features(x)) >= self.threshold
+        if passed.any():
+            scores[passed] = self.cnn(x[passed])
+        self.seen += len(x)
+        self.passed += int(passed.sum())
+        return scores
+
+
+def load_cascade(stage1_path, threshold, cnn_path, threads=1):
+    import joblib
+    # Modelos guardados con n_jobs=-1 sobresuscribirían los procesos de score_catalog
+    stage1 = set_n_jobs(joblib.load(stage1_path), threads)
+    return CascadeScorer(stage1, threshold, load_scorer(cnn_path, threads))
+
+
+def evaluate_cascade(stage1_path, cnn_path, array_dir=ARRAY_DIR, label_dir=LABEL_DIR,
+                     targets=DEFAULT_TARGETS, tune_set='val', eval_set='test', threads=1,
+                     batch_size=2048):
+    """Ajusta umbrales en tune_set e informa ahorro/recall en eval_set"""
+    import joblib
+
+    stage1 = set_n_jobs(joblib.load(stage1_path), threads)
+    tune = ArraySource.from_split(tune_set, array_dir, label_dir)
+    tune_scores = predict_scores(stage1, extract_features(tune, batch_size, n_jobs=threads))
+    tune_labels = np.asarray(tune.labels)
+    thresholds = {t: threshold_for_recall(tune_scores, tune_labels, t) for t in targets}
+
+    # Coste por imagen de cada etapa, medido en eval_set
+    source = ArraySource.from_split(eval_set, array_dir, label_dir)
+    labels = np.asarray(source.labels)
+    start = time.perf_counter()
+    stage1_scores = predict_scores(stage1, extract_features(source, batch_size, n_jobs=threads))
+    stage1_time = time.perf_counter() - start
+
+    cnn = load_scorer(cnn_path, threads)
+    start = time.perf_counter()
+    cnn_scores, _ = predict(cnn, source)
+    cnn_time = time.perf_counter() - start
+
+    positives = labels == 1
+    cnn_pred = cnn_scores > 0.5
+    cnn_recall = cnn_pred[positives].mean() if positives.any() else float('nan')
+
+    report = {'n': int(len(labels)), 'stage1_ms_per_image': 1000 * stage1_time / len(labels),
+              'cnn_ms_per_image': 1000 * cnn_time / len(labels), 'cnn_recall': float(cnn_recall),
+              'targets': []}
+    print(f"\nCascade report ({eval_set}: {len(labels)} images, thresholds tuned on {tune_set})")
+    print(f"  stage 1: {report['stage1_ms_per_image']:.3f} ms/image | "
+          f"CNN: {report['cnn_ms_per_image']:.3f} ms/image | CNN-only recall: {cnn_recall:.4f}")
+    print(f"  {'target':>7s} {'threshold':>10s} {'pass':>7s} {'s1 recall':>10s} "
+          f"{'recall':>8s} {'lost':>8s} {'precision':>9s} {'saved':>7s}")
+    for target, threshold in thresholds.items():
+        passed = stage1_scores >= threshold
+        cascade_pred = passed & cnn_pred
+        recall = cascade_pred[positives].mean() if positives.any() else float('nan')
+        precision = (cascade_pred & positives).sum() / max(cascade_pred.sum(), 1)
+        pass_fraction = passed.mean()
+        # Coste de la cascada frente a la CNN sobre todas las imágenes
+        saved = 1 - (stage1_time + pass_fraction * cnn_time) / cnn_time
+        entry = {
+            'target': target,
+            'threshold': float(threshold),
+            'pass_fraction': float(pass_fraction),
+            'stage1_recall': float(passed[positives].mean()) if positives.any() else float('nan'),
+            'recall': float(recall),
+            'recall_lost': float(cnn_recall - recall),
+            'precision': float(precision),
+            'compute_saved': float(saved),
+        }
+        report['targets'].append(entry)
+        print(f"  {target:7.3f} {threshold:10.4f} {pass_fraction:7.2%} "
+              f"{entry['stage1_recall']:10.4f} {recall:8.4f} {entry['recall_lost']:8.4f} "
+              f"{precision:9.4f} {saved:7.1%}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune and evaluate the two-stage cascade")
+    parser.add_argument("--stage1", default=os.path.join(MODEL_DIR, 'rf.joblib'),
+                        help="Classical model from classical_features.py")
+    parser.add_argument("--cnn", required=True, help="CNN model (.keras/.tflite/.onnx)")
+    parser.add_argument("--targets", type=float, nargs='+', default=list(DEFAULT_TARGETS),
+                        help="Stage-1 recall targets on the tuning split")
+    parser.add_argument("--array-dir", default=ARRAY_DIR)
+    parser.add_argument("--label-dir", default=LABEL_DIR)
+    parser.add_argument("--tune-set", default="val")
+    parser.add_argument("--eval-set", default="test")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    report = evaluate_cascade(args.stage1, args.cnn, args.array_dir, args.label_dir,
+                              args.targets, args.tune_set, args.eval_set, args.threads)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import argparse
+import tempfile
+import threading
+
+# Checkpoint indexado para descargas reanudables.
+#
+# Sustituye a download_checkpoint.txt: cada objeto se identifica por
+# (ra, dec, size, layer, pixscale, bands) en una tabla SQLite en modo WAL
+# (solo se añade al log, un corte a mitad de escritura no corrompe lo ya
+# confirmado). Las actualizaciones se acumulan en memoria y se confirman
+# por lotes en una transacción (un fsync por lote). Al abrir se carga
+# todo el índice en un dict para consultas O(1).
+
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LAYER = 'ls-dr9'
+DEFAULT_PIXSCALE = 0.262
+DEFAULT_BANDS = 'grz'
+
+# {ra}_{dec}_{idx}_{size}pix.jpeg, formato de download_legacy (size "256.0"
+# cuando la tabla de entrada era solo numérica), y {ra}_{dec}_{size}pix.jpeg
+# sin índice de los notebooks (notebooks/download_checkpoint.txt)
+FILENAME_RE = re.compile(r'^([\d\.\-eE+]+)_([\d\.\-eE+]+)(?:_\d+)?_(\d+)(?:\.0)?pix\.jpe?g$',
+                         re.IGNORECASE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoint (
+    ra REAL NOT NULL,
+    dec REAL NOT NULL,
+    size INTEGER NOT NULL,
+    layer TEXT NOT NULL,
+    pixscale REAL NOT NULL,
+    bands TEXT NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    file_path TEXT,
+    updated REAL,
+    PRIMARY KEY (ra, dec, size, layer, pixscale, bands)
+) WITHOUT ROWID
+"""
+
+_UPSERT = """
+INSERT INTO checkpoint (ra, dec, size, layer, pixscale, bands, status, reason,
+                        attempts, file_path, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (ra, dec, size, layer, pixscale, bands) DO UPDATE SET
+    status = excluded.status,
+    reason = excluded.reason,
+    attempts = excluded.attempts,
+    file_path = COALESCE(excluded.file_path, checkpoint.file_path),
+    updated = excluded.updated
+"""
+
+
+def make_key(ra, dec, size, layer=DEFAULT_LAYER, pixscale=DEFAULT_PIXSCALE, bands=DEFAULT_BANDS):
+    """Clave normalizada de un cutout"""
+    return (float(ra), float(dec), int(size), str(layer), float(pixscale), str(bands))
+
+
+def parse_checkpoint_line(line, layer=DEFAULT_LAYER, pixscale=DEFAULT_PIXSCALE,
+                          bands=DEFAULT_BANDS):
+    """Convierte una línea de download_checkpoint.txt en (key, file_path)"""
+    file_path = line.strip()
+    if not file_path:
+        return None
+    match = FILENAME_RE.match(os.path.basename(file_path))
+    if not match:
+        return None
+    try:
+        key = make_key(match.group(1), match.group(2), match.group(3), layer, pixscale, bands)
+    except ValueError:
+        return None
+    return key, file_path
+
+
+class CheckpointStore:
+    def __init__(self, db_path, batch_size=500, flush_interval=5.0):
+        """
+        batch_size: actualizaciones pendientes que fuerzan un commit
+        flush_interval: segundos máximos entre commits
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._last_flush = time.time()
+        # Callback opcional on_flush(filas, segundos) tras cada commit (métricas)
+        self.on_flush = None
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+        # Índice en memoria: key -> (status, attempts)
+        self._index = {}
+        self._paths = {}
+        for row in self._conn.execute(
+                "SELECT ra, dec, size, layer, pixscale, bands, status, attempts, file_path "
+                "FROM checkpoint"):
+            key = tuple(row[:6])
+            self._index[key] = (row[6], row[7])
+            if row[6] == DONE and row[8]:
+                self._paths[row[8]] = key
+
+    # ------------------------------------------------------------------
+    # Consultas O(1)
+    # ------------------------------------------------------------------
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return self.is_done(key)
+
+    def is_done(self, key):
+        entry = self._index.get(key)
+        return entry is not None and entry[0] == DONE
+
+    def is_done_path(self, file_path):
+        """Compatibilidad con el checkpoint de rutas"""
+        return file_path in self._paths
+
+    def key_for_path(self, file_path):
+        """Clave de un fichero completado (None si no consta como done)"""
+        return self._paths.get(file_path)
+
+    def status(self, key):
+        entry = self._index.get(key)
+        return entry[0] if entry else None
+
+    def attempts(self, key):
+        entry = self._index.get(key)
+        return entry[1] if entry else 0
+
+    def done_keys(self):
+        return {key for key, (status, _) in self._index.items() if status == DONE}
+
+    # ------------------------------------------------------------------
+    # Actualizaciones por lotes
+    # ------------------------------------------------------------------
+    def mark_done(self, key, file_path=None):
+        with self._lock:
+            attempts = self.attempts(key) + 1
+            self._index[key] = (DONE, attempts)
+            if file_path:
+                self._paths[file_path] = key
+            self._pending[key] = (DONE, None, attempts, file_path, time.time())
+            self._maybe_flush()
+
+    def mark_failed(self, key, reason, file_path=None):
+        with self._lock:
+            attempts = self.attempts(key) + 1
+            self._index[key] = (FAILED, attempts)
+            if file_path:
+                self._paths.pop(file_path, None)
+            self._pending[key] = (FAILED, str(reason), attempts, file_path, time.time())
+            self._maybe_flush()
+        return attempts
+
+    def _maybe_flush(self):
+        if (len(self._pending) >= self.batch_size
+                or time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Confirma las actualizaciones pendientes en una sola transacción"""
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._pending:
+                return 0
+            rows = [key + value for key, value in self._pending.items()]
+            start = time.perf_counter()
+            with self._conn:
+                self._conn.executemany(_UPSERT, rows)
+            self._pending.clear()
+            if self.on_flush is not None:
+                self.on_flush(len(rows), time.perf_counter() - start)
+            return len(rows)
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # ------------------------------------------------------------------
+    # Ledger e importación
+    # ------------------------------------------------------------------
+    def failed(self):
+        """Filas en estado failed: (ra, dec, size, layer, pixscale, bands, reason, attempts, file_path)"""
+        self.flush()
+        return self._conn.execute(
+            "SELECT ra, dec, size, layer, pixscale, bands, reason, attempts, file_path "
+            "FROM checkpoint WHERE status = ?", (FAILED,)).fetchall()
+
+    def merge_from(self, other_db_path):
+        """Incorpora otro checkpoint (p.ej. de un shard); 'done' prevalece sobre 'failed'.
+
+        Devuelve (filas incorporadas, filas done en ambos).
+        """
+        other = sqlite3.connect(other_db_path)
+        try:
+            rows = other.execute(
+                "SELECT ra, dec, size, layer, pixscale, bands, status, reason, attempts, "
+                "file_path, updated FROM checkpoint").fetchall()
+        finally:
+            other.close()
+
+        merged = 0
+        conflicts = 0
+        with self._lock:
+            for row in rows:
+                key = tuple(row[:6])
+                status, reason, attempts, file_path, updated = row[6:]
+                current = self._index.get(key)
+                if current is not None and current[0] == DONE:
+                    conflicts += int(status == DONE)
+                    continue
+                if current is not None:
+                    attempts = max(attempts, current[1])
+                self._index[key] = (status, attempts)
+                if status == DONE and file_path:
+                    self._paths[file_path] = key
+                self._pending[key] = (status, reason, attempts, file_path, updated)
+                merged += 1
+            self.flush()
+        return merged, conflicts
+
+    def import_text_checkpoint(self, txt_path, layer=DEFAULT_LAYER, pixscale=DEFAULT_PIXSCALE,
+                               bands=DEFAULT_BANDS):
+        """Importa un download_checkpoint.txt (una ruta por línea)"""
+        imported = 0
+        skipped = 0
+        entries = []
+        with open(txt_path, 'r') as f:
+            for line in f:
+                parsed = parse_checkpoint_line(line, layer, pixscale, bands)
+                if parsed is None:
+                    skipped += int(bool(line.strip()))
+                    continue
+                entries.append(parsed)
+        # Índice en memoria y base de datos se actualizan juntos bajo el lock
+        now = time.time()
+        rows = []
+        with self._lock:
+            for key, file_path in entries:
+                if self.is_done(key):
+                    continue
+                self._index[key] = (DONE, 1)
+                self._paths[file_path] = key
+                rows.append(key + (DONE, None, 1, file_path, now))
+                imported += 1
+            self.flush()
+            with self._conn:
+                self._conn.executemany(_UPSERT, rows)
+        logging.info(f"Imported {imported} entries from {txt_path}"
+                     + (f" ({skipped} unparseable lines skipped)" if skipped else ""))
+        return imported
+
+
+def open_checkpoint(out_path, checkpoint_file=None, **kwargs):
+    """Abre el checkpoint de un directorio de salida, importando el .txt antiguo si existe"""
+    legacy_txt = os.path.join(out_path, 'download_checkpoint.txt')
+    if checkpoint_file is None:
+        checkpoint_file = os.path.join(out_path, 'download_checkpoint.db')
+    elif checkpoint_file.endswith('.txt'):
+        legacy_txt = checkpoint_file
+        checkpoint_file = os.path.splitext(checkpoint_file)[0] + '.db'
+
+    is_new = not os.path.exists(checkpoint_file)
+    store = CheckpointStore(checkpoint_file, **kwargs)
+    if is_new and os.path.exists(legacy_txt):
+        store.import_text_checkpoint(legacy_txt)
+    logging.info(f"Checkpoint loaded with {len(store)} entries ({checkpoint_file})")
+    return store
+
+
+def benchmark_restart(n_rows=100_000):
+    """Mide escritura por lotes y reapertura de un checkpoint de n_rows filas"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        store = CheckpointStore(db_path, batch_size=5000)
+        start = time.perf_counter()
+        for i in range(n_rows):
+            key = make_key(i * 1e-3, -i * 1e-3, 256)
+            store.mark_done(key, os.path.join(tmp, f"{i}.jpeg"))
+        store.close()
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = CheckpointStore(db_path)
+        probe = make_key((n_rows // 2) * 1e-3, -(n_rows // 2) * 1e-3, 256)
+        found = probe in store
+        restart_time = time.perf_counter() - start
+        store.close()
+
+    print(f"Checkpoint benchmark ({n_rows} rows)")
+    print(f"  batched writes: {write_time:.2f}s ({n_rows / write_time:.0f} rows/s)")
+    print(f"  restart + lookup: {restart_time:.3f}s (found={found})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checkpoint store utilities")
+    parser.add_argument("--import-txt", nargs=2, metavar=("TXT", "DB"),
+                        help="Import a download_checkpoint.txt into a checkpoint DB")
+    parser.add_argument("--bench", type=int, metavar="N", help="Benchmark restart with N rows")
+    args = parser.parse_args()
+
+    if args.import_txt:
+        txt_path, db_path = args.import_txt
+        with CheckpointStore(db_path) as store:
+            store.import_text_checkpoint(txt_path)
+            print(f"{db_path}: {len(store)} entries")
+    if args.bench:
+        benchmark_restart(args.bench)
+
+
+if __name__ == "__main__":
+    main()
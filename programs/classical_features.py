@@ -0,0 +1,344 @@
+import os
+import time
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+from input_pipeline import ArraySource, ARRAY_DIR, LABEL_DIR
+
+# Camino rápido con ML clásico: features compactas por imagen + SVM/RF.
+#
+# Las features se calculan por batches vectorizados directamente desde los
+# arrays memory-mapped (X_{set}.npy o X_{set}_u8.npy):
+#
+#   momentos de color   media, desviación, asimetría por banda y colores
+#                       (diferencias entre bandas) en centro y total
+#   perfil radial       brillo medio por anillo y banda
+#   HOG simplificado    histograma de orientaciones del gradiente por celda
+#
+# y se guardan en un almacén en disco (FEATURE_DIR) indexado por el array de
+# origen y los parámetros, así que entrenar de nuevo no recalcula nada.
+
+FEATURE_DIR = '../Datasets_DeepShadows/features/'
+MODEL_DIR = '../Datasets_DeepShadows/classical_models/'
+
+# Cambiar al modificar el cálculo de features (invalida la caché)
+FEATURE_VERSION = 1
+
+RADIAL_BINS = 8
+HOG_CELL = 16
+HOG_ORIENTATIONS = 8
+
+
+def _channels_first(x):
+    """(B, H, W, C) -> (B, C, H*W) contiguo: reducciones rápidas sobre píxeles"""
+    b, h, w, c = x.shape
+    return np.ascontiguousarray(x.reshape(b, h * w, c).transpose(0, 2, 1))
+
+
+def color_moments(x):
+    """(B, H, W, C) -> media, std y asimetría por banda + colores centro/total"""
+    b, h, w, c = x.shape
+    flat = _channels_first(x)
+    mean = flat.mean(axis=2)
+    centered = flat - mean[:, :, None]
+    sq = centered * centered
+    var = sq.mean(axis=2)
+    std = np.sqrt(var)
+    skew = (sq * centered).mean(axis=2) / np.maximum(std, 1e-6) ** 3
+
+    # Región central (mitad del lado): la galaxia está centrada en el cutout
+    ch, cw = h // 4, w // 4
+    center = _channels_first(x[:, ch:h - ch, cw:w - cw, :]).mean(axis=2)
+    colors = [mean[:, i] - mean[:, i + 1] for i in range(c - 1)]
+    center_colors = [center[:, i] - center[:, i + 1] for i in range(c - 1)]
+    concentration = center.mean(axis=1) / np.maximum(mean.mean(axis=1), 1e-6)
+    return np.column_stack([mean, std, skew, center] + colors + center_colors + [concentration])
+
+
+_radial_cache = {}
+
+
+def _radial_weights(h, w, n_bins):
+    """Matriz (H*W, n_bins) que promedia los píxeles de cada anillo"""
+    key = (h, w, n_bins)
+    if key not in _radial_cache:
+        yy, xx = np.mgrid[:h, :w]
+        r = np.hypot(yy - (h - 1) / 2, xx - (w - 1) / 2)
+        bins = np.minimum((r / (min(h, w) / 2) * n_bins).astype(int), n_bins - 1)
+        weights = np.zeros((h * w, n_bins), dtype=np.float32)
+        weights[np.arange(h * w), bins.ravel()] = 1.0
+        weights /= weights.sum(axis=0, keepdims=True)
+        _radial_cache[key] = weights
+    return _radial_cache[key]
+
+
+def radial_profile(x, n_bins=RADIAL_BINS):
+    """(B, H, W, C) -> brillo medio por anillo y banda (B, C * n_bins)"""
+    b, h, w, c = x.shape
+    # Un único producto matricial (BLAS) para todos los anillos
+    profile = _channels_first(x) @ _radial_weights(h, w, n_bins)
+    return profile.reshape(b, -1)
+
+
+_cell_cache = {}
+
+
+def _cell_index(h, w, cell):
+    """Celda de cada píxel (H, W); -1 fuera de la rejilla"""
+    key = (h, w, cell)
+    if key not in _cell_cache:
+        ny, nx = h // cell, w // cell
+        yy, xx = np.mgrid[:h, :w]
+        index = (yy // cell) * nx + xx // cell
+        index[(yy >= ny * cell) | (xx >= nx * cell)] = -1
+        _cell_cache[key] = index
+    return _cell_cache[key]
+
+
+def hog_features(x, cell=HOG_CELL, n_orientations=HOG_ORIENTATIONS):
+    """HOG simplificado sobre la luminancia: (B, cells * n_orientations)"""
+    lum = x @ np.full(x.shape[3], 1.0 / x.shape[3], dtype=x.dtype)
+    gy = np.zeros_like(lum)
+    gx = np.zeros_like(lum)
+    gy[:, 1:-1, :] = lum[:, 2:, :] - lum[:, :-2, :]
+    gx[:, :, 1:-1] = lum[:, :, 2:] - lum[:, :, :-2]
+    magnitude = np.hypot(gx, gy)
+    # Orientación sin signo en [0, pi)
+    orientation = np.arctan2(gy, gx)
+    orientation[orientation < 0] += np.pi
+    bins = (orientation * (n_orientations / np.pi)).astype(np.intp)
+    np.minimum(bins, n_orientations - 1, out=bins)
+
+    # Histograma de todas las (imagen, celda, orientación) con un solo bincount
+    b, h, w = lum.shape
+    cells = _cell_index(h, w, cell)
+    n_cells = (h // cell) * (w // cell)
+    inside = (cells >= 0).ravel()
+    bins = bins.reshape(b, -1)
+    magnitude = magnitude.reshape(b, -1)
+    if not inside.all():
+        bins, magnitude = bins[:, inside], magnitude[:, inside]
+    offsets = cells.ravel()[inside] * n_orientations
+    index = bins
+    index += offsets
+    index += (np.arange(b) * (n_cells * n_orientations))[:, None]
+    hist = np.bincount(index.ravel(), weights=magnitude.ravel(),
+                       minlength=b * n_cells * n_orientations)
+    hist = hist.reshape(b, n_cells, n_orientations).astype(np.float32)
+    # Normalización L2 por celda
+    hist /= np.sqrt((hist ** 2).sum(axis=2, keepdims=True) + 1e-6)
+    return hist.reshape(b, -1)
+
+
+def image_features(x):
+    """Batch normalizado (B, H, W, C) -> features float32 (B, F)"""
+    x = np.asarray(x, dtype=np.float32)
+    return np.hstack([color_moments(x), radial_profile(x), hog_features(x)]).astype(np.float32)
+
+
+def _block_features(source, start, stop):
+    images, _ = source.read_block(start, stop)
+    x = images.astype(np.float32)
+    if source.scale != 1.0:
+        x *= source.scale
+    return image_features(x)
+
+
+def extract_features(source, batch_size=2048, n_jobs=1):
+    """Features de toda la fuente por bloques contiguos del memmap.
+
+    Los bloques se reparten en hilos (numpy libera el GIL en las
+    operaciones pesadas) y cada uno escribe en su rango del resultado.
+    """
+    from joblib import Parallel, delayed
+
+    ranges = source.block_ranges(batch_size)
+    n_features = _block_features(source, 0, min(len(source), 1)).shape[1]
+    out = np.empty((len(source), n_features), dtype=np.float32)
+
+    def run(start, stop):
+        out[start:stop] = _block_features(source, start, stop)
+
+    Parallel(n_jobs=n_jobs, prefer='threads')(delayed(run)(start, stop)
+                                              for start, stop in ranges)
+    return out
+
+
+def _cache_key(set_name, array_dir):
+    """Huella del array de origen (ruta, tamaño, mtime) y de los parámetros"""
+    paths = [os.path.join(array_dir, f'X_{set_name}_u8.npy'),
+             os.path.join(array_dir, f'X_{set_name}.npy')]
+    path = next((p for p in paths if os.path.exists(p)), paths[1])
+    stat = os.stat(path)
+    payload = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                          FEATURE_VERSION, RADIAL_BINS, HOG_CELL, HOG_ORIENTATIONS])
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def load_features(set_name, array_dir=ARRAY_DIR, label_dir=LABEL_DIR, feature_dir=FEATURE_DIR,
+                  batch_size=2048, n_jobs=1):
+    """(features, labels) de un split; se calculan solo si no están en caché"""
+    source = ArraySource.from_split(set_name, array_dir, label_dir)
+    labels = np.asarray(source.labels, dtype=np.int32)
+    os.makedirs(feature_dir, exist_ok=True)
+    cache_path = os.path.join(feature_dir,
+                              f'features_{set_name}_{_cache_key(set_name, array_dir)}.npy')
+    if os.path.exists(cache_path):
+        features = np.load(cache_path, mmap_mode='r')
+        if len(features) == len(labels):
+            print(f"{set_name}: {features.shape} features from cache")
+            return features, labels
+
+    start = time.perf_counter()
+    features = extract_features(source, batch_size, n_jobs)
+    elapsed = time.perf_counter() - start
+    tmp_path = cache_path + '.tmp.npy'
+    np.save(tmp_path, features)
+    os.replace(tmp_path, cache_path)
+    print(f"{set_name}: {features.shape} features in {elapsed:.1f}s "
+          f"({len(features) / elapsed:.0f} images/s)")
+    return features, labels
+
+
+def make_classifier(kind='rf', n_jobs=-1, seed=0, **params):
+    """StandardScaler + SVC o RandomForest (como Luis-DeepShadows.ipynb)"""
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.svm import SVC
+    from sklearn.ensemble import RandomForestClassifier as RF
+
+    if kind == 'svm':
+        params.setdefault('C', 1.0)
+        params.setdefault('gamma', 'scale')
+        return make_pipeline(StandardScaler(), SVC(random_state=seed, **params))
+    params.setdefault('n_estimators', 300)
+    params.setdefault('min_samples_leaf', 2)
+    return make_pipeline(StandardScaler(),
+                         RF(n_jobs=n_jobs, random_state=seed, **params))
+
+
+def set_n_jobs(classifier, n_jobs=1):
+    """Fija n_jobs en todos los pasos que lo tengan (p.ej. el RF de la pipeline)"""
+    params = {name: n_jobs for name in classifier.get_params() if name.endswith('n_jobs')}
+    if params:
+        classifier.set_params(**params)
+    return classifier
+
+
+def predict_scores(classifier, features):
+    """Score monótono de la clase LSB: probabilidad (RF) o distancia al margen (SVM)"""
+    if hasattr(classifier, 'predict_proba'):
+        return classifier.predict_proba(features)[:, 1]
+    return classifier.decision_function(features)
+
+
+def _subsample(features, labels, max_samples, seed=0):
+    """Submuestra estratificada (SVC escala O(N^2) con N)"""
+    if not max_samples or len(labels) <= max_samples:
+        return np.asarray(features), labels
+    from sklearn.model_selection import train_test_split
+    idx, _ = train_test_split(np.arange(len(labels)), train_size=max_samples,
+                              stratify=labels, random_state=seed)
+    idx.sort()
+    return np.asarray(features[idx]), labels[idx]
+
+
+def train_classifier(kind='rf', array_dir=ARRAY_DIR, label_dir=LABEL_DIR,
+                     feature_dir=FEATURE_DIR, model_dir=MODEL_DIR, cv=5, n_jobs=-1, grid=False,
+                     max_svm_samples=20000, seed=0):
+    """Validación cruzada en train, ajuste final y evaluación en test"""
+    import joblib
+    from sklearn.model_selection import cross_validate, GridSearchCV, StratifiedKFold
+    from sklearn.metrics import (accuracy_score, precision_score, recall_score,
+                                 roc_auc_score)
+
+    X_train, y_train = load_features('train', array_dir, label_dir, feature_dir, n_jobs=n_jobs)
+    if kind == 'svm':
+        X_train, y_train = _subsample(X_train, y_train, max_svm_samples, seed)
+    X_train = np.asarray(X_train)
+
+    classifier = make_classifier(kind, n_jobs, seed)
+    folds = StratifiedKFold(cv, shuffle=True, random_state=seed)
+    if grid:
+        param_grid = ({'svc__C': [0.3, 1, 3, 10], 'svc__gamma': ['scale', 0.01]}
+                      if kind == 'svm' else
+                      {'randomforestclassifier__n_estimators': [200, 500],
+                       'randomforestclassifier__max_features': ['sqrt', 0.3]})
+        search = GridSearchCV(classifier, param_grid, cv=folds, scoring='roc_auc',
+                              n_jobs=n_jobs)
+        search.fit(X_train, y_train)
+        classifier = search.best_estimator_
+        print(f"Grid search best ({kind}): {search.best_params_} AUC={search.best_score_:.4f}")
+    else:
+        # En RF el paralelismo está dentro del modelo; en SVM, entre folds
+        scores = cross_validate(classifier, X_train, y_train, cv=folds,
+                                scoring=['accuracy', 'roc_auc'],
+                                n_jobs=1 if kind == 'rf' else n_jobs)
+        print(f"{cv}-fold CV ({kind}): accuracy {scores['test_accuracy'].mean():.4f} "
+              f"± {scores['test_accuracy'].std():.4f}, AUC {scores['test_roc_auc'].mean():.4f}")
+
+    start = time.perf_counter()
+    classifier.fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
+
+    results = {'kind': kind, 'fit_s': fit_time, 'n_train': len(y_train)}
+    if os.path.exists(os.path.join(label_dir, 'y_test.npy')):
+        X_test, y_test = load_features('test', array_dir, label_dir, feature_dir, n_jobs=n_jobs)
+        start = time.perf_counter()
+        X_test = np.asarray(X_test)
+        proba = predict_scores(classifier, X_test)
+        pred = classifier.predict(X_test)
+        predict_time = time.perf_counter() - start
+        results.update({
+            'accuracy': accuracy_score(y_test, pred),
+            'precision': precision_score(y_test, pred, zero_division=0),
+            'recall': recall_score(y_test, pred, zero_division=0),
+            'auc': roc_auc_score(y_test, proba) if len(np.unique(y_test)) > 1 else float('nan'),
+            'predict_images_per_s': len(y_test) / predict_time,
+        })
+        print(f"\nResultados en test ({kind}):")
+        for name in ('accuracy', 'precision', 'recall', 'auc'):
+            print(f" - {name}: {results[name]:.4f}")
+        print(f" - predicción: {results['predict_images_per_s']:.0f} images/s "
+              f"(sin contar la extracción de features)")
+
+    os.makedirs(model_dir, exist_ok=True)
+    model_path = os.path.join(model_dir, f'{kind}.joblib')
+    # Un solo hilo al cargarlo: score_catalog ya reparte el trabajo en procesos
+    joblib.dump(set_n_jobs(classifier, 1), model_path)
+    print(f"Modelo guardado en {model_path}")
+    return classifier, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classical-ML baseline on image features")
+    parser.add_argument("--model", choices=["rf", "svm"], nargs='+', default=["rf"])
+    parser.add_argument("--array-dir", default=ARRAY_DIR)
+    parser.add_argument("--label-dir", default=LABEL_DIR)
+    parser.add_argument("--feature-dir", default=FEATURE_DIR, help="Feature cache directory")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--cv", type=int, default=5, help="Cross-validation folds")
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--grid", action="store_true", help="Small GridSearchCV instead of plain CV")
+    parser.add_argument("--max-svm-samples", type=int, default=20000,
+                        help="Stratified training subsample for the SVM")
+    parser.add_argument("--features-only", action="store_true",
+                        help="Only fill the feature cache for train/val/test")
+    args = parser.parse_args()
+
+    if args.features_only:
+        for set_name in ('train', 'val', 'test'):
+            load_features(set_name, args.array_dir, args.label_dir, args.feature_dir,
+                          n_jobs=args.n_jobs)
+        return
+
+    for kind in args.model:
+        train_classifier(kind, args.array_dir, args.label_dir, args.feature_dir, args.model_dir,
+                         args.cv, args.n_jobs, args.grid, args.max_svm_samples)
+
+
+if __name__ == "__main__":
+    main()
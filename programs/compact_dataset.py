@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from checkpoint_store import FILENAME_RE
+from preprocessing import TARGET_SIZE, ORIGINAL_PIXSCALE
+
+# Formato compacto de los arrays de imágenes: píxeles uint8 (1 byte por
+# canal en lugar de 4 de float32 u 8 de float64) más metadatos. La
+# normalización a [0, 1] se hace por batch al cargar.
+#
+#   X_{set}_u8.npy         uint8 (N, 64, 64, 3)
+#   X_{set}_meta.json      scale, crop, pixscale de origen, tamaño...
+#   X_{set}_index.csv      fila -> file_name, ra, dec
+
+ARRAY_DIR = '../Datasets_DeepShadows/array_images/'
+
+
+def compact_path(array_dir, set_name):
+    return os.path.join(array_dir, f'X_{set_name}_u8.npy')
+
+
+def _meta_path(array_dir, set_name):
+    return os.path.join(array_dir, f'X_{set_name}_meta.json')
+
+
+def _index_path(array_dir, set_name):
+    return os.path.join(array_dir, f'X_{set_name}_index.csv')
+
+
+def filename_index(files):
+    """Índice fila -> file_name, ra, dec, extraído de los nombres de forma vectorizada"""
+    names = pd.Series(list(files), dtype=object)
+    # Mismo patrón que el checkpoint: grupos ra, dec y size
+    parts = names.str.extract(FILENAME_RE)
+    return pd.DataFrame({
+        'file_name': names,
+        'ra': pd.to_numeric(parts[0], errors='coerce'),
+        'dec': pd.to_numeric(parts[1], errors='coerce'),
+        'source_size': pd.to_numeric(parts[2], errors='coerce'),
+    })
+
+
+def write_compact_metadata(array_dir, set_name, files, crop_mode='fraction', crop_factor=None,
+                           target_size=TARGET_SIZE, source_pixscale=ORIGINAL_PIXSCALE,
+                           count=None, **extra):
+    """Escribe X_{set}_meta.json y X_{set}_index.csv junto al array uint8"""
+    index = filename_index(files)
+    source_size = index['source_size'].dropna()
+    meta = {
+        'dtype': 'uint8',
+        'count': len(index) if count is None else count,
+        'scale': 1 / 255.0,
+        'crop_mode': crop_mode,
+        'crop_factor': crop_factor,
+        'target_size': list(target_size),
+        'source_pixscale': source_pixscale,
+        'source_size': int(source_size.iloc[0]) if len(source_size) else None,
+    }
+    meta.update(extra)
+    with open(_meta_path(array_dir, set_name), 'w') as f:
+        json.dump(meta, f, indent=1)
+    index.drop(columns='source_size').to_csv(_index_path(array_dir, set_name),
+                                             index_label='row')
+
+
+def convert_float_array(array_dir, set_name, chunk=4096):
+    """Convierte un X_{set}.npy float (valores en [0, 1]) al formato uint8"""
+    source = np.load(os.path.join(array_dir, f'X_{set_name}.npy'), mmap_mode='r')
+    output = np.lib.format.open_memmap(compact_path(array_dir, set_name), mode='w+',
+                                       dtype=np.uint8, shape=source.shape)
+    for start in range(0, len(source), chunk):
+        block = np.asarray(source[start:start + chunk], dtype=np.float32)
+        output[start:start + chunk] = np.clip(np.rint(block * 255.0), 0, 255)
+    output.flush()
+    return output
+
+
+class CompactArray:
+    """Array uint8 memory-mapped con normalización perezosa por batch"""
+
+    def __init__(self, array_dir, set_name, mmap_mode='r'):
+        self.pixels = np.load(compact_path(array_dir, set_name), mmap_mode=mmap_mode)
+        meta_path = _meta_path(array_dir, set_name)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'scale': 1 / 255.0}
+        self.scale = self.meta['scale']
+        self._index_path = _index_path(array_dir, set_name)
+        self._index = None
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    @property
+    def index(self):
+        if self._index is None and os.path.exists(self._index_path):
+            self._index = pd.read_csv(self._index_path, index_col='row')
+        return self._index
+
+    def batch(self, indices, dtype=np.float32):
+        """Imágenes normalizadas para los índices dados (o un slice)"""
+        out = self.pixels[indices].astype(dtype)
+        out /= 1.0 / self.scale
+        return out
+
+    def __getitem__(self, indices):
+        return self.batch(indices)
+
+    def iter_batches(self, batch_size=256, shuffle=False, seed=None, dtype=np.float32):
+        """Recorre el array en batches normalizados; con shuffle, índices ordenados por batch"""
+        n = len(self)
+        order = np.arange(n)
+        if shuffle:
+            order = np.random.default_rng(seed).permutation(n)
+        for start in range(0, n, batch_size):
+            idx = order[start:start + batch_size]
+            if shuffle:
+                # Lectura más secuencial del memmap; se reordena al final
+                sort = np.argsort(idx)
+                block = self.batch(idx[sort], dtype)
+                out = np.empty_like(block)
+                out[sort] = block
+                yield idx, out
+            else:
+                yield idx, self.batch(slice(start, start + len(idx)), dtype)
+
+    def to_float(self, dtype=np.float32):
+        """Array completo normalizado (solo si cabe en memoria)"""
+        return self.batch(slice(None), dtype)
+
+
+def benchmark_load(array_dir, set_name, batch_size=256):
+    """Compara la carga float32 completa con el formato uint8 + normalización por batch"""
+    float_path = os.path.join(array_dir, f'X_{set_name}.npy')
+    results = {}
+    if os.path.exists(float_path):
+        start = time.perf_counter()
+        X = np.load(float_path)
+        results['float32 np.load'] = (time.perf_counter() - start, X.nbytes)
+        del X
+
+    start = time.perf_counter()
+    X = np.load(compact_path(array_dir, set_name))
+    results['uint8 np.load'] = (time.perf_counter() - start, X.nbytes)
+    del X
+
+    start = time.perf_counter()
+    data = CompactArray(array_dir, set_name)
+    for _ in data.iter_batches(batch_size):
+        pass
+    batch_bytes = batch_size * int(np.prod(data.shape[1:])) * 4
+    results['uint8 mmap + batches'] = (time.perf_counter() - start, batch_bytes)
+
+    print(f"Load benchmark: {set_name} ({len(data)} images)")
+    for name, (elapsed, nbytes) in results.items():
+        print(f"  {name:22s} {elapsed:7.2f}s  resident {nbytes / 1024 ** 2:9.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact uint8 image-array format")
+    parser.add_argument("command", choices=["convert", "bench"],
+                        help="convert X_{set}.npy float arrays, or benchmark loading")
+    parser.add_argument("--sets", nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument("--array-dir", default=ARRAY_DIR, help="Directory with X_{set}.npy")
+    parser.add_argument("--jpeg-dir", default=None,
+                        help="JPEG directory pattern with {set} to build the filename index")
+    args = parser.parse_args()
+
+    for set_name in args.sets:
+        if args.command == "convert":
+            output = convert_float_array(args.array_dir, set_name)
+            files = []
+            if args.jpeg_dir:
+                jpeg_dir = args.jpeg_dir.format(set=set_name)
+                files = sorted(f for f in os.listdir(jpeg_dir)
+                               if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+            if files and len(files) != len(output):
+                print(f"Warning: {len(files)} JPEGs vs {len(output)} images, index not written")
+                files = []
+            write_compact_metadata(args.array_dir, set_name, files, count=len(output),
+                                   converted_from='float')
+            print(f"{set_name}: {compact_path(args.array_dir, set_name)} {output.shape}")
+        else:
+            benchmark_load(args.array_dir, set_name)
+
+
+if __name__ == "__main__":
+    main()
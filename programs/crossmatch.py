@@ -0,0 +1,233 @@
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# Cross-match de posiciones contra los catálogos de referencia.
+#
+# Sustituye a las búsquedas con máscaras booleanas sobre todo el DataFrame
+# por imagen (O(N x M)): se construye un KD-tree sobre vectores unitarios
+# una sola vez y todas las posiciones se cruzan en una llamada vectorizada
+# con una tolerancia angular real (no una caja en ra/dec).
+
+# Tolerancia por defecto: 0.001 grados, como las cajas de get_label /
+# find_in_catalogs
+DEFAULT_TOL_ARCSEC = 3.6
+
+
+def radec_to_xyz(ra, dec):
+    """(ra, dec) en grados -> vectores unitarios (N, 3)"""
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
+def arcsec_to_chord(sep_arcsec):
+    return 2.0 * np.sin(np.radians(np.asarray(sep_arcsec) / 3600.0) / 2.0)
+
+
+def chord_to_arcsec(chord):
+    return np.degrees(2.0 * np.arcsin(np.clip(np.asarray(chord) / 2.0, 0.0, 1.0))) * 3600.0
+
+
+def gnomonic(ra, dec, ra0, dec0):
+    """Proyección tangente (TAN) en torno a (ra0, dec0): (xi, eta) en arcsec
+
+    xi crece hacia el este (RA creciente) y eta hacia el norte.
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+    return np.degrees(xi) * 3600.0, np.degrees(eta) * 3600.0
+
+
+def inverse_gnomonic(xi, eta, ra0, dec0):
+    """(xi, eta) en arcsec sobre el plano tangente en (ra0, dec0) -> (ra, dec) en grados"""
+    xi, eta = np.radians(np.asarray(xi) / 3600.0), np.radians(np.asarray(eta) / 3600.0)
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denom))
+    return np.degrees(ra) % 360.0, np.degrees(dec)
+
+
+class CatalogIndex:
+    """KD-tree sobre un catálogo de posiciones (se construye una vez)"""
+
+    def __init__(self, ra, dec):
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        valid = np.isfinite(ra) & np.isfinite(dec)
+        # Posiciones en el catálogo original de cada punto del árbol
+        self.rows = np.flatnonzero(valid)
+        self.ra, self.dec = ra[valid], dec[valid]
+        self.tree = cKDTree(radec_to_xyz(ra[valid], dec[valid]))
+
+    @classmethod
+    def from_dataframe(cls, df, ra_col='ra', dec_col='dec'):
+        return cls(df[ra_col].to_numpy(), df[dec_col].to_numpy())
+
+    def __len__(self):
+        return len(self.rows)
+
+    def match(self, ra, dec, tol_arcsec=DEFAULT_TOL_ARCSEC):
+        """Vecino más cercano dentro de tol_arcsec.
+
+        Devuelve (fila del catálogo o -1, separación en arcsec o inf,
+        número de objetos del catálogo dentro de la tolerancia).
+        """
+        xyz = radec_to_xyz(ra, dec)
+        n = len(xyz)
+        rows = np.full(n, -1, dtype=np.int64)
+        sep = np.full(n, np.inf)
+        counts = np.zeros(n, dtype=np.int64)
+        finite = np.all(np.isfinite(xyz), axis=1)
+        if not finite.any() or len(self) == 0:
+            return rows, sep, counts
+
+        radius = float(arcsec_to_chord(tol_arcsec))
+        dist, idx = self.tree.query(xyz[finite], k=1, distance_upper_bound=radius)
+        hit = np.isfinite(dist)
+        sub_rows = np.full(len(dist), -1, dtype=np.int64)
+        sub_rows[hit] = self.rows[idx[hit]]
+        sub_sep = np.full(len(dist), np.inf)
+        sub_sep[hit] = chord_to_arcsec(dist[hit])
+
+        sub_counts = np.zeros(len(dist), dtype=np.int64)
+        if hit.any():
+            sub_counts[hit] = self.tree.query_ball_point(xyz[finite][hit], r=radius,
+                                                         return_length=True)
+        rows[finite] = sub_rows
+        sep[finite] = sub_sep
+        counts[finite] = sub_counts
+        return rows, sep, counts
+
+    def in_box(self, ra, dec, tol=0.001):
+        """True si algún objeto cumple |ra - ra_cat| < tol y |dec - dec_cat| < tol.
+
+        Mismo criterio que las cajas de get_label / find_in_catalogs (tol en
+        grados, sin envolver ra); el KD-tree solo acota los candidatos con
+        el círculo que contiene la caja.
+        """
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        found = np.zeros(len(ra), dtype=bool)
+        finite = np.flatnonzero(np.isfinite(ra) & np.isfinite(dec))
+        if len(finite) == 0 or len(self) == 0:
+            return found
+
+        # Cuerda máxima entre puntos de la caja: 2 * sqrt(2) * sin(tol / 2)
+        radius = 2.0 * np.sqrt(2.0) * np.sin(np.radians(tol) / 2.0) * (1.0 + 1e-9)
+        candidates = self.tree.query_ball_point(radec_to_xyz(ra[finite], dec[finite]),
+                                                r=radius)
+        lengths = np.fromiter(map(len, candidates), dtype=np.int64, count=len(candidates))
+        if lengths.sum() == 0:
+            return found
+        cat = np.concatenate([c for c in candidates if c]).astype(np.int64)
+        pos = np.repeat(finite, lengths)
+        hit = ((np.abs(self.ra[cat] - ra[pos]) < tol) &
+               (np.abs(self.dec[cat] - dec[pos]) < tol))
+        found[pos[hit]] = True
+        return found
+
+
+def crossmatch_labels(ra, dec, lsb_index, art_index, tol_arcsec=DEFAULT_TOL_ARCSEC):
+    """Etiquetas de todas las posiciones en una llamada.
+
+    expected_label = 1 si hay galaxia LSB dentro de la tolerancia (prioridad
+    galaxias, como get_label / find_in_catalogs), 0 en otro caso. dual
+    marca posiciones en ambos catálogos y ambiguous las que además tienen
+    más de un candidato en alguno de ellos.
+    """
+    lsb_row, lsb_sep, lsb_n = lsb_index.match(ra, dec, tol_arcsec)
+    art_row, art_sep, art_n = art_index.match(ra, dec, tol_arcsec)
+
+    in_lsb = lsb_row >= 0
+    in_artifacts = art_row >= 0
+    dual = in_lsb & in_artifacts
+    return pd.DataFrame({
+        'ra': np.asarray(ra, dtype=np.float64),
+        'dec': np.asarray(dec, dtype=np.float64),
+        'in_lsb': in_lsb,
+        'in_artifacts': in_artifacts,
+        'expected_label': in_lsb.astype(np.int32),
+        'lsb_row': lsb_row,
+        'lsb_sep_arcsec': lsb_sep,
+        'art_row': art_row,
+        'art_sep_arcsec': art_sep,
+        'dual': dual,
+        'ambiguous': dual | (lsb_n > 1) | (art_n > 1),
+    })
+
+
+def load_catalog_indexes(lsb_path, artifact_path):
+    """KD-trees de los catálogos LSB y de artefactos"""
+    lsb_df = pd.read_csv(lsb_path)
+    art_df = pd.read_csv(artifact_path)
+    return CatalogIndex.from_dataframe(lsb_df), CatalogIndex.from_dataframe(art_df)
+
+
+def legacy_labels(ra, dec, lsb_df, art_df, tol=0.001):
+    """Búsqueda original por máscaras (get_label), solo para el benchmark"""
+    labels = []
+    for r, d in zip(ra, dec):
+        match_lsb = lsb_df[(abs(lsb_df['ra'] - r) < tol) & (abs(lsb_df['dec'] - d) < tol)]
+        if not match_lsb.empty:
+            labels.append(1)
+            continue
+        labels.append(0)
+    return np.array(labels, dtype=np.int32)
+
+
+def benchmark(n_images=40000, n_catalog=20000, legacy_rows=2000, seed=0):
+    """Compara el KD-tree con las máscaras booleanas sobre datos sintéticos"""
+    rng = np.random.default_rng(seed)
+    lsb_df = pd.DataFrame({'ra': rng.uniform(0, 360, n_catalog),
+                           'dec': np.degrees(np.arcsin(rng.uniform(-1, 1, n_catalog)))})
+    art_df = pd.DataFrame({'ra': rng.uniform(0, 360, n_catalog),
+                           'dec': np.degrees(np.arcsin(rng.uniform(-1, 1, n_catalog)))})
+
+    # Imágenes: mitad LSB, mitad artefactos, con ruido de astrometría de ~0.1"
+    source = pd.concat([lsb_df, art_df]).sample(n_images, replace=True, random_state=seed)
+    jitter = 0.1 / 3600
+    ra = source['ra'].to_numpy() + rng.normal(0, jitter, n_images)
+    dec = source['dec'].to_numpy() + rng.normal(0, jitter, n_images)
+
+    start = time.perf_counter()
+    lsb_index, art_index = CatalogIndex.from_dataframe(lsb_df), CatalogIndex.from_dataframe(art_df)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = crossmatch_labels(ra, dec, lsb_index, art_index)
+    match_time = time.perf_counter() - start
+
+    legacy_rows = min(legacy_rows, n_images)
+    start = time.perf_counter()
+    legacy = legacy_labels(ra[:legacy_rows], dec[:legacy_rows], lsb_df, art_df)
+    legacy_time = (time.perf_counter() - start) * n_images / legacy_rows
+
+    agree = np.mean(legacy == result['expected_label'].to_numpy()[:legacy_rows])
+    print(f"Cross-match benchmark: {n_images} images vs 2 x {n_catalog} catalog rows")
+    print(f"  boolean masks: {legacy_time:8.2f}s (extrapolated from {legacy_rows})")
+    print(f"  KD-tree:       {build_time + match_time:8.3f}s "
+          f"(build {build_time:.3f}s + match {match_time:.3f}s)")
+    print(f"  speedup:       {legacy_time / (build_time + match_time):8.0f}x")
+    print(f"  label agreement on timed subset: {agree:.2%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-match benchmark")
+    parser.add_argument("--images", type=int, default=40000, help="Number of image positions")
+    parser.add_argument("--catalog", type=int, default=20000, help="Rows per reference catalog")
+    parser.add_argument("--legacy-rows", type=int, default=2000,
+                        help="Positions timed with the boolean-mask loop (extrapolated)")
+    args = parser.parse_args()
+    benchmark(args.images, args.catalog, args.legacy_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import os
+import csv
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from checkpoint_store import FILENAME_RE, make_key, open_checkpoint
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+# Integridad de las descargas.
+#
+# Antes, response.content se escribía directamente en la ruta final y
+# cualquier fichero existente contaba como descargado: un JPEG truncado o
+# vacío de una ejecución interrumpida sobrevivía para siempre y acababa
+# rompiendo (o envenenando en silencio) rebuild_image_arrays.py. Ahora:
+#   - cada respuesta se comprueba antes de guardarla (Content-Length y
+#     marcadores de inicio/fin del formato);
+#   - se escribe en un .tmp y se renombra (os.replace es atómico), así que
+#     en la ruta final solo hay ficheros completos;
+#   - scan_tree valida un árbol existente leyendo solo la cabecera y la
+#     cola de cada fichero (sin decodificar), en paralelo, y quarantine
+#     aparta los defectuosos y los marca como failed en el checkpoint para
+#     que la siguiente ejecución (o --retry-failed) los vuelva a descargar.
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+FITS_MAGIC = b'SIMPLE  ='
+FITS_BLOCK = 2880
+
+# Bytes leídos del final del fichero: el EOI puede ir seguido de relleno
+TAIL_BYTES = 32
+TMP_SUFFIX = '.tmp'
+
+QUARANTINE_DIR = 'quarantine'
+QUARANTINE_LOG = 'quarantine.csv'
+
+
+def _format(file_path):
+    return 'fits' if file_path.lower().endswith(('.fits', '.fit', '.fz')) else 'jpeg'
+
+
+def check_bytes(head, tail, size, fmt='jpeg'):
+    """Motivo del defecto a partir de cabecera, cola y tamaño (None si es válido)"""
+    if size == 0:
+        return 'empty file'
+    if fmt == 'fits':
+        if not head.startswith(FITS_MAGIC):
+            return 'missing FITS header'
+        if size % FITS_BLOCK:
+            return f'truncated FITS ({size} bytes, not a multiple of {FITS_BLOCK})'
+        return None
+    if not head.startswith(JPEG_SOI):
+        return 'missing JPEG SOI marker'
+    if not tail.rstrip(b'\x00\r\n ').endswith(JPEG_EOI):
+        return 'missing JPEG EOI marker (truncated)'
+    return None
+
+
+def validate_content(content, expected_length=None, fmt='jpeg'):
+    """Comprueba una respuesta antes de escribirla (None si es válida)"""
+    if expected_length is not None and len(content) != int(expected_length):
+        return f'Content-Length mismatch ({len(content)} of {expected_length} bytes)'
+    return check_bytes(content[:len(FITS_MAGIC)], content[-TAIL_BYTES:], len(content), fmt)
+
+
+def atomic_write(file_path, content):
+    """Escribe en file_path.tmp y renombra: la ruta final nunca queda a medias"""
+    tmp_path = file_path + TMP_SUFFIX
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return file_path
+
+
+def check_file(file_path, fmt=None):
+    """Valida un fichero leyendo solo cabecera y cola (None si es válido)"""
+    fmt = fmt or _format(file_path)
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(len(FITS_MAGIC))
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - TAIL_BYTES))
+            tail = f.read()
+    except OSError as e:
+        return f'{type(e).__name__}: {e}'
+    return check_bytes(head, tail, size, fmt)
+
+
+def scan_tree(out_path, extension='jpeg', workers=16):
+    """Valida todos los *.{extension} de out_path en paralelo.
+
+    Devuelve (número de ficheros revisados, [(file_path, motivo)] de los
+    defectuosos, [ficheros .tmp huérfanos]).
+    """
+    suffix = f'.{extension}'
+    paths, stale = [], []
+    with os.scandir(out_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(suffix):
+                paths.append(entry.path)
+            elif entry.name.endswith(suffix + TMP_SUFFIX):
+                stale.append(entry.path)
+
+    fmt = _format(suffix)
+    # E/S pura (dos lecturas pequeñas por fichero): los hilos bastan
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reasons = executor.map(lambda path: check_file(path, fmt), paths, chunksize=256)
+        bad = [(path, reason) for path, reason in zip(paths, reasons) if reason]
+    return len(paths), bad, stale
+
+
+def _key_for(store, file_path):
+    key = store.key_for_path(file_path)
+    if key is None:
+        match = FILENAME_RE.match(os.path.basename(file_path))
+        if match:
+            key = make_key(match.group(1), match.group(2), match.group(3))
+    return key
+
+
+def quarantine(out_path, bad, store=None):
+    """Mueve los ficheros defectuosos a out_path/quarantine y los re-encola.
+
+    Cada fichero queda anotado en quarantine.csv; con store, su objeto
+    pasa a failed en el checkpoint, de modo que el plan de descargas lo
+    vuelve a pedir y aparece en el registro de fallidos (--retry-failed).
+    """
+    if not bad:
+        return 0
+    quarantine_dir = os.path.join(out_path, QUARANTINE_DIR)
+    os.makedirs(quarantine_dir, exist_ok=True)
+    log_path = os.path.join(quarantine_dir, QUARANTINE_LOG)
+    write_header = not os.path.exists(log_path)
+
+    requeued = 0
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(log_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(['file_name', 'reason', 'quarantined_at'])
+        for file_path, reason in bad:
+            name = os.path.basename(file_path)
+            shutil.move(file_path, os.path.join(quarantine_dir, name))
+            writer.writerow([name, reason, now])
+            if store is not None:
+                key = _key_for(store, file_path)
+                if key is not None:
+                    store.mark_failed(key, f'corrupt file: {reason}', file_path)
+                    requeued += 1
+    logging.warning(f"Quarantined {len(bad)} corrupt files in {quarantine_dir} "
+                    f"({requeued} re-enqueued)")
+    return requeued
+
+
+def verify_tree(out_path, extension='jpeg', workers=16, store=None, dry_run=False):
+    """Escanea out_path, borra los .tmp huérfanos y pone en cuarentena los defectuosos"""
+    start = time.perf_counter()
+    checked, bad, stale = scan_tree(out_path, extension, workers)
+    elapsed = time.perf_counter() - start
+    logging.info(f"Verified {checked} files in {elapsed:.2f}s: {len(bad)} corrupt, "
+                 f"{len(stale)} stale temp files")
+    for file_path, reason in bad[:20]:
+        logging.warning(f"Corrupt: {os.path.basename(file_path)} ({reason})")
+    if not dry_run:
+        for tmp_path in stale:
+            os.remove(tmp_path)
+        quarantine(out_path, bad, store)
+    return checked, bad
+
+
+def synthetic_tree(out_path, n_files=20000, corrupt_fraction=0.01, seed=0):
+    """Árbol de JPEGs sintéticos con una fracción truncada o vacía"""
+    import random
+    from mock_legacy_server import synthetic_jpeg
+
+    rng = random.Random(seed)
+    os.makedirs(out_path, exist_ok=True)
+    content = synthetic_jpeg(256)
+    corrupt = set(rng.sample(range(n_files), int(n_files * corrupt_fraction)))
+    for i in range(n_files):
+        data = content
+        if i in corrupt:
+            data = content[:rng.randrange(0, len(content) - 1)]
+        with open(os.path.join(out_path, f"{10 + i * 1e-3}_{1.0}_{i}_256pix.jpeg"), 'wb') as f:
+            f.write(data)
+    return len(corrupt)
+
+
+def benchmark(n_files=20000, workers=16, decode_sample=2000):
+    """Escaneo por marcadores frente a decodificación completa con PIL"""
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        n_corrupt = synthetic_tree(tmp, n_files)
+        start = time.perf_counter()
+        checked, bad, _ = scan_tree(tmp, workers=workers)
+        scan_time = time.perf_counter() - start
+
+        paths = sorted(os.path.join(tmp, name) for name in os.listdir(tmp))[:decode_sample]
+        start = time.perf_counter()
+        for path in paths:
+            try:
+                with Image.open(path) as img:
+                    img.load()
+            except OSError:
+                pass
+        decode_time = (time.perf_counter() - start) * n_files / len(paths)
+
+    print(f"Integrity scan: {checked} files, {n_corrupt} corrupted on purpose")
+    print(f"  marker scan ({workers} threads): {scan_time:6.2f}s, {len(bad)} flagged")
+    print(f"  full PIL decode (extrapolated):  {decode_time:6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate downloaded cutouts and quarantine "
+                                                 "corrupt files")
+    parser.add_argument("output", nargs='?', help="Download directory to verify")
+    parser.add_argument("--extension", default='jpeg', choices=['jpeg', 'fits'])
+    parser.add_argument("--workers", type=int, default=16, help="Scanner threads")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint where quarantined objects are re-enqueued "
+                             "(default: download_checkpoint.db in the output directory)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report corrupt files")
+    parser.add_argument("--bench", type=int, default=None, metavar="N",
+                        help="Benchmark the scanner on N synthetic files")
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.workers)
+        return
+    if not args.output:
+        parser.error("output is required unless --bench is given")
+
+    if args.dry_run:
+        verify_tree(args.output, args.extension, args.workers, dry_run=True)
+        return
+    from retry_queue import write_failed_ledger
+    store = open_checkpoint(args.output, args.checkpoint)
+    _, bad = verify_tree(args.output, args.extension, args.workers, store)
+    if bad:
+        write_failed_ledger(store)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,23 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
 import pandas as pd
 import requests
 import logging
 import argparse
 import time
-import psutil
-import sys
+
+from rate_controller import AdaptiveRateController, THROTTLE_STATUS
+from checkpoint_store import make_key, open_checkpoint
+from download_plan import LEGACY_URL, build_download_plan
+from sharding import parse_shard, select_shard, shard_checkpoint_path, merge_shards
+from manifest import update_manifest, shard_manifest_path
+from download_metrics import DownloadMetrics, DEFAULT_INTERVAL
+from download_integrity import atomic_write, validate_content, verify_tree
+from retry_queue import (RetryQueue, DEFAULT_MAX_ATTEMPTS, failed_ledger_path,
+                         write_failed_ledger, read_failed_ledger)
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-# Configuración avanzada de gestión de recursos
-class ResourceManager:
-    def __init__(self, priority=0.5):
-        """
-        priority: 0.1 (baja) - 1.0 (alta)
-        """
-        self.priority = max(0.1, min(1.0, priority))
-        self.last_check = time.time()
-        self.cooldown = 0
-        
-    def can_proceed(self):
-        """Determina si es seguro continuar con las descargas"""
-        # Enfriamiento después de pausas forzadas
-        if self.cooldown > time.time():
-            return False
-        
-        # Solo verificar cada 15 segundos
-        if time.time() - self.last_check < 15:
-            return True
-            
-        self.last_check = time.time()
-        
-        # Obtener métricas del sistema
-        cpu_percent = psutil.cpu_percent(interval=1)
-        mem_available = psutil.virtual_memory().available / (1024 ** 3)  # GB
-        
-        # Umbrales ajustables por prioridad
-        cpu_threshold = 80 - (20 * self.priority)  # Más estricto con prioridad baja
-        mem_threshold = 1.0 + (2 * self.priority)  # Más memoria libre con prioridad baja
-        
-        # Verificar condiciones
-        if cpu_percent > cpu_threshold:
-            logging.warning(f"CPU usage high ({cpu_percent}% > {cpu_threshold}%), pausing downloads")
-            self.cooldown = time.time() + 30  # Pausa de 30 segundos
-            return False
-            
-        if mem_available < mem_threshold:
-            logging.warning(f"Memory low ({mem_available:.1f}GB < {mem_threshold:.1f}GB), pausing downloads")
-            self.cooldown = time.time() + 45  # Pausa de 45 segundos
-            return False
-            
-        return True
-    
-    def adaptive_sleep(self):
-        """Pausa adaptativa basada en condiciones del sistema"""
-        if not self.can_proceed():
-            sleep_time = min(60, 15 + (1 - self.priority) * 45)
-            logging.info(f"System busy. Sleeping for {sleep_time} seconds...")
-            time.sleep(sleep_time)
-            return True
-        return False
 
 def read_table(file_name):
     try:
@@ -75,125 +31,312 @@ def read_table(file_name):
         logging.error("File not found.")
         return None
 
-def download_legacy_image(url_file_path, resource_manager):
-    """Función de descarga con gestión de recursos"""
-    url, file_path = url_file_path
-    
-    # Esperar si el sistema está ocupado
-    if resource_manager.adaptive_sleep():
-        return None  # Saltar esta descarga por ahora
+def attempt_download(url, file_path, controller, metrics=None):
+    """Un intento de descarga bajo el controlador.
+
+    Devuelve (file_path o None, motivo, reintentable): 429/5xx y errores de
+    red son reintentables; otros códigos (p.ej. 404 fuera del footprint) no.
+    """
+    controller.acquire()
+    start = time.time()
+    status = None
+    nbytes = 0
+    invalid = None
+    try:
+        response = requests.get(url, timeout=30)
+        status = response.status_code
+        nbytes = len(response.content)
+        if status == 200:
+            # Respuesta incompleta (corte de conexión, cuerpo truncado): reintentar.
+            # Con Content-Encoding la longitud anunciada es la comprimida.
+            expected = None
+            if not response.headers.get('Content-Encoding'):
+                expected = response.headers.get('Content-Length')
+            invalid = validate_content(response.content, expected,
+                                       'fits' if file_path.endswith('.fits') else 'jpeg')
+            if invalid:
+                logging.warning(f"Invalid response for {url}: {invalid}")
+                return None, invalid, True
+            atomic_write(file_path, response.content)
+            logging.info(f"Downloaded: {file_path}")
+            return file_path, None, False
+        reason = f"HTTP {status}"
+        if status not in THROTTLE_STATUS:
+            logging.error(f"Failed to download: {url} (Status: {status})")
+            return None, reason, False
+        return None, reason, True
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Download error for {url}: {str(e)}")
+        return None, f"{type(e).__name__}: {e}", True
+    finally:
+        elapsed = time.time() - start
+        controller.record(elapsed, status, valid=not invalid)
+        if metrics is not None:
+            metrics.record_request(elapsed, status, nbytes)
+        controller.release()
+
+def run_downloads(items, controller, store, max_attempts=DEFAULT_MAX_ATTEMPTS, metrics=None):
+    """Descarga items (url, file_path, key) con cola de reintentos persistente.
+
+    Los fallos reintentables vuelven a la cola con backoff exponencial con
+    jitter (sin bloquear un hilo) hasta agotar max_attempts; cada fallo
+    queda en el checkpoint. metrics (DownloadMetrics) recibe cada petición
+    y cada objeto terminado. Devuelve (descargados, claves fallidas).
+    """
+    queue = RetryQueue(items, max_attempts)
+    failed = set()
+    downloaded_count = 0
+    capacity = 2 * controller.max_limit
+
+    def submit(executor, item):
+        url, file_path, _ = item
+        if os.path.exists(file_path):
+            return executor.submit(lambda: (file_path, None, False))
+        return executor.submit(attempt_download, url, file_path, controller, metrics)
+
+    with ThreadPoolExecutor(max_workers=controller.max_limit) as executor:
+        in_flight = {}
+        while len(queue) or in_flight:
+            for item in queue.pop_ready(capacity - len(in_flight)):
+                in_flight[submit(executor, item)] = item
+            if not in_flight:
+                # Solo quedan objetos esperando su backoff
+                time.sleep(queue.wait_time())
+                continue
+            done, _ = wait(in_flight, timeout=queue.wait_time(), return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                url, file_path, key = item
+                result, reason, retryable = future.result()
+                if result:
+                    downloaded_count += 1
+                    failed.discard(key)
+                    if metrics is not None:
+                        metrics.record_object(True)
+                    # Checkpoint por lotes (commit agrupado)
+                    store.mark_done(key, result)
+                    
+                    # Actualizar contador cada 10 descargas
+                    if downloaded_count % 10 == 0:
+                        logging.info(f"Progress: {downloaded_count}/{len(items)} downloaded "
+                                     f"({len(queue)} queued, {queue.retried} retries)")
+                        
+                    if downloaded_count % 500 == 0:
+                        logging.info(f"Rate controller: {controller.summary()}")
+                    continue
+
+                store.mark_failed(key, reason, file_path)
+                if retryable and queue.retry(item):
+                    continue
+                failed.add(key)
+                if metrics is not None:
+                    metrics.record_object(False)
+                if retryable:
+                    logging.error(f"Failed to download: {url} after "
+                                  f"{queue.attempts[item]} attempts ({reason})")
+
+    logging.info(f"Retry queue: {queue.retried} retries, {queue.exhausted} objects out of "
+                 f"attempts, {len(failed)} failed")
+    return downloaded_count, failed
+
+def prepare_downloads(data, out_path, radii_default, store, base_url=LEGACY_URL):
+    """Construye la lista (url, file_path, key) de descargas pendientes"""
+    # Verificar columnas requeridas
+    if 'ra' not in data.columns or 'dec' not in data.columns:
+        logging.error("Dataframe missing 'ra' or 'dec' columns")
+        return None, None
+
+    # Plan vectorizado: un único scandir y consulta del checkpoint por conjuntos
+    plan = build_download_plan(data, out_path, radii_default, store, base_url)
+    pending = plan[plan['needs_download']]
+    urls_file_paths = [
+        (url, file_path, make_key(ra, dec, size))
+        for url, file_path, ra, dec, size in zip(pending['url'], pending['file_path'],
+                                                 pending['ra'], pending['dec'], pending['size'])
+    ]
+    missing = plan.loc[~plan['needs_download'], 'file_path'].tolist()
     
-    if not os.path.exists(file_path):
-        try:
-            response = requests.get(url, timeout=30)
-            if response.status_code == 200:
-                with open(file_path, 'wb') as file:
-                    file.write(response.content)
-                logging.info(f"Downloaded: {file_path}")
-                return file_path
-            else:
-                logging.error(f"Failed to download: {url} (Status: {response.status_code})")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Download error for {url}: {str(e)}")
-    else:
-        logging.info(f"Skipping {file_path}, already exists.")
+    return urls_file_paths, missing
+
+def make_controller(concurrency=None, priority=0.5, adaptive=True):
+    # Límite máximo de concurrencia según prioridad si no se indica
+    if concurrency is None:
+        if priority < 0.3:
+            concurrency = 2  # Mínimo para prioridad baja
+        elif priority < 0.7:
+            concurrency = 4  # Balanceado
+        else:
+            concurrency = 6  # Máximo para prioridad alta
     
-    return None
+    # Controlador adaptativo: ajusta las peticiones en vuelo entre 1 y concurrency
+    return AdaptiveRateController(max_limit=concurrency, priority=priority, adaptive=adaptive)
 
-def download_legacy(data, out_path, radii_default=256, checkpoint_file=None, priority=0.5):
+def download_legacy(data, out_path, radii_default=256, checkpoint_file=None, priority=0.5,
+                    base_url=LEGACY_URL, concurrency=None, adaptive=True, manifest_path=None,
+                    label_column='label', catalog_name=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                    verify=False, metrics_path=None, metrics_interval=DEFAULT_INTERVAL):
     # Crear directorio si no existe
     os.makedirs(out_path, exist_ok=True)
     
-    # Usar checkpoint en el directorio de salida
-    if checkpoint_file is None:
-        checkpoint_file = os.path.join(out_path, 'download_checkpoint.txt')
-    
-    # Inicializar gestor de recursos
-    resource_manager = ResourceManager(priority=priority)
-    
-    # Cargar archivos ya descargados
-    downloaded_files = {}
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, 'r') as f:
-            downloaded_files = {line.strip(): True for line in f}
-        logging.info(f"Checkpoint loaded with {len(downloaded_files)} entries")
-
-    urls_file_paths = []
-    missing = []
+    controller = make_controller(concurrency, priority, adaptive)
     
-    # Verificar columnas requeridas
-    if 'ra' not in data.columns or 'dec' not in data.columns:
-        logging.error("Dataframe missing 'ra' or 'dec' columns")
-        return
+    # Checkpoint indexado en el directorio de salida (importa el .txt antiguo)
+    store = open_checkpoint(out_path, checkpoint_file)
+    if verify:
+        # Ficheros truncados de ejecuciones anteriores: cuarentena y re-encolado
+        verify_tree(out_path, store=store)
 
-    # Preparar lista de descargas
-    for idx, row in data.iterrows():
-        ra = row["ra"]
-        dec = row["dec"]
-        radii = row.get('radii', radii_default)
-        
-        # Generar nombre único con índice
-        unique_name = f"{ra}_{dec}_{idx}"
-        file_name = f"{unique_name}_{radii}pix.jpeg"
-        file_path = os.path.join(out_path, file_name)
-        
-        url = f"https://www.legacysurvey.org/viewer/jpeg-cutout?ra={ra}&dec={dec}&size={radii}&layer=ls-dr9&pixscale=0.262&bands=grz"
-        
-        if file_path not in downloaded_files and not os.path.exists(file_path):
-            urls_file_paths.append((url, file_path))
-        else:
-            missing.append(file_path)
+    urls_file_paths, missing = prepare_downloads(data, out_path, radii_default,
+                                                 store, base_url)
+    if urls_file_paths is None:
+        store.close()
+        return
 
     logging.info(f"Total images to download: {len(urls_file_paths)}")
     logging.info(f"Images already downloaded: {len(missing)}")
     
-    # Configuración dinámica de workers
-    def calculate_workers():
-        """Calcula workers óptimos basado en uso del sistema"""
-        if resource_manager.priority < 0.3:
-            return 2  # Mínimo para prioridad baja
-        elif resource_manager.priority < 0.7:
-            return 4  # Balanceado
-        else:
-            return 6  # Máximo para prioridad alta
+    # Ejecutar descargas; el controlador limita las peticiones en vuelo.
+    # Las métricas se vuelcan cada metrics_interval s y al terminar.
+    metrics = DownloadMetrics(len(urls_file_paths), controller, metrics_path, metrics_interval)
+    metrics.attach_store(store)
+    with metrics:
+        downloaded_count, _ = run_downloads(urls_file_paths, controller, store, max_attempts,
+                                            metrics)
+        write_failed_ledger(store)
+        store.close()
+    logging.info(f"Successfully downloaded {downloaded_count} images")
+    logging.info(f"Rate controller: {controller.summary()}")
+    
+    # Manifest Parquet para los constructores de arrays
+    update_manifest(data, out_path, radii_default, manifest_path,
+                    label_column=label_column, catalog_name=catalog_name)
 
-    # Ejecutar descargas con gestión de recursos
-    downloaded_count = 0
-    with ThreadPoolExecutor(max_workers=calculate_workers()) as executor:
-        futures = {executor.submit(download_legacy_image, item, resource_manager): item 
-                   for item in urls_file_paths}
-        
-        # Procesar resultados con barra de progreso
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                downloaded_count += 1
-                # Actualizar checkpoint inmediatamente
-                with open(checkpoint_file, 'a') as f:
-                    f.write(result + '\n')
-                
-                # Actualizar contador cada 10 descargas
-                if downloaded_count % 10 == 0:
-                    logging.info(f"Progress: {downloaded_count}/{len(urls_file_paths)} downloaded")
-                    
-                # Verificar recursos con más frecuencia bajo carga
-                if downloaded_count % 50 == 0:
-                    resource_manager.adaptive_sleep()
+def retry_failed(out_path, checkpoint_file=None, ledger_path=None, priority=0.5,
+                 base_url=LEGACY_URL, concurrency=None, adaptive=True,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, metrics_path=None,
+                 metrics_interval=DEFAULT_INTERVAL):
+    """Reintenta solo los objetos del registro de fallidos, sin recorrer el catálogo"""
+    store = open_checkpoint(out_path, checkpoint_file)
+    ledger_path = ledger_path or failed_ledger_path(store.db_path)
+    ledger = read_failed_ledger(ledger_path)
+    if ledger.empty:
+        logging.info(f"No failed objects in {ledger_path}")
+        store.close()
+        return 0
 
-    logging.info(f"Successfully downloaded {downloaded_count} images")
+    items = []
+    for row in ledger.itertuples(index=False):
+        key = make_key(row.ra, row.dec, row.size, row.layer, row.pixscale, row.bands)
+        if store.is_done(key) or not isinstance(row.file_path, str):
+            continue
+        url = (f"{base_url}?ra={key[0]}&dec={key[1]}&size={key[2]}&layer={key[3]}"
+               f"&pixscale={key[4]}&bands={key[5]}")
+        items.append((url, row.file_path, key))
+    logging.info(f"Retrying {len(items)} failed objects from {ledger_path}")
+
+    controller = make_controller(concurrency, priority, adaptive)
+    metrics = DownloadMetrics(len(items), controller, metrics_path, metrics_interval)
+    metrics.attach_store(store)
+    with metrics:
+        downloaded_count, failed = run_downloads(items, controller, store, max_attempts, metrics)
+        write_failed_ledger(store, ledger_path)
+        store.close()
+    logging.info(f"Recovered {downloaded_count} images, {len(failed)} still failing")
+    return downloaded_count
 
 def main():
     parser = argparse.ArgumentParser(description="Download images from Legacy")
-    parser.add_argument("table", help="Path to input table")
+    parser.add_argument("table", nargs='?', help="Path to input table")
     parser.add_argument("--object", help="Specific object ID to download")
     parser.add_argument("--legacy", action="store_true", help="Download legacy images")
     parser.add_argument("--radii_default", type=int, default=256, help="Default pixel radius")
     parser.add_argument("--output", default="./legacy_color_images", help="Output directory")
     parser.add_argument("--priority", type=float, default=0.5, 
                         help="Task priority (0.1=low, 1.0=high, default=0.5)")
+    parser.add_argument("--engine", choices=["threads", "async", "stream"], default="threads",
+                        help="Download engine: thread pool, asyncio with connection pooling, "
+                             "or stream (asyncio straight into a packed dataset in --output)")
+    parser.add_argument("--label-column", default="label",
+                        help="Label column stored in the manifest / packed dataset")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="Max in-flight requests (default: by priority for threads, 32 for async)")
+    parser.add_argument("--base-url", default=LEGACY_URL,
+                        help="Cutout service endpoint (override for local mirrors/tests)")
+    parser.add_argument("--shard", default=None,
+                        help="Download only shard i/N of the table (e.g. 0/4), own checkpoint")
+    parser.add_argument("--shard-scheme", choices=["hash", "healpix"], default="hash",
+                        help="Partitioning: hash of (ra, dec) or contiguous HEALPix pixels")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="Merge per-shard checkpoints in --output into the main checkpoint")
+    parser.add_argument("--verify", action="store_true",
+                        help="Scan existing files first; quarantine and re-download corrupt ones")
+    parser.add_argument("--metrics", default=None, metavar="PATH",
+                        help="Periodic metrics dump (.prom = Prometheus text, otherwise JSON)")
+    parser.add_argument("--metrics-interval", type=float, default=DEFAULT_INTERVAL,
+                        help="Seconds between metrics dumps / progress lines")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="Attempts per object before it goes to the failed-object ledger")
+    parser.add_argument("--retry-failed", nargs='?', const='', default=None, metavar="LEDGER",
+                        help="Only re-download the failed-object ledger "
+                             "(default: failed_objects.csv of --output / --shard)")
     
     args = parser.parse_args()
     
+    if args.merge_shards:
+        merge_shards(args.output)
+        return
+    
+    if args.verify and args.shard:
+        # Las shards comparten directorio: verificar una vez antes de lanzarlas
+        parser.error("--verify scans the whole output directory; run "
+                     "download_integrity.py on it before starting the shards")
+    
+    if args.shard and args.engine == "stream":
+        # Un único dataset empaquetado (meta.json, index.csv y checkpoint) por
+        # directorio: varias shards escribiendo en él lo corromperían
+        parser.error("--shard is not supported with --engine stream; run one stream "
+                     "download per output directory")
+
+    if args.verify and args.engine == "stream":
+        # El motor stream no deja un fichero por objeto que se pueda escanear
+        parser.error("--verify checks per-object files and is not supported with "
+                     "--engine stream; undecodable cutouts are already rejected while packing")
+
+    if args.table is None and args.retry_failed is None:
+        parser.error("table is required unless --merge-shards or --retry-failed is given")
+    
+    if args.retry_failed is not None and args.engine == "stream":
+        # Las etiquetas e índices del dataset salen del catálogo original
+        if args.table is None:
+            parser.error("--retry-failed with --engine stream needs the input table")
+        data = read_table(args.table)
+        if data is not None:
+            from download_to_dataset import retry_failed_stream
+            retry_failed_stream(data, args.output, args.retry_failed or None,
+                                radii_default=args.radii_default,
+                                label_column=args.label_column,
+                                concurrency=args.concurrency or 32, priority=args.priority,
+                                base_url=args.base_url, max_attempts=args.max_attempts,
+                                metrics_path=args.metrics,
+                                metrics_interval=args.metrics_interval)
+        return
+    
+    if args.retry_failed is not None:
+        checkpoint_file = None
+        if args.shard:
+            checkpoint_file = shard_checkpoint_path(args.output, *parse_shard(args.shard))
+        retry_failed(args.output, checkpoint_file, args.retry_failed or None, args.priority,
+                     args.base_url, args.concurrency, max_attempts=args.max_attempts,
+                     metrics_path=args.metrics, metrics_interval=args.metrics_interval)
+        if args.table:
+            # Manifest actualizado con las imágenes recuperadas
+            data = read_table(args.table)
+            if data is not None:
+                update_manifest(data, args.output, args.radii_default,
+                                label_column=args.label_column,
+                                catalog_name=os.path.splitext(os.path.basename(args.table))[0])
+        return
+    
     data = read_table(args.table)
     if data is None:
         return
@@ -202,15 +345,45 @@ def main():
         # Asumiendo que tienes una columna 'object_id' - ajusta según sea necesario
         data = data[data['object_id'] == args.object]
 
+    # Modo shard: subconjunto determinista del catálogo y checkpoint propio
+    checkpoint_file = None
+    manifest_path = None
+    if args.shard:
+        index, total = parse_shard(args.shard)
+        data = select_shard(data, index, total, args.shard_scheme)
+        checkpoint_file = shard_checkpoint_path(args.output, index, total)
+        manifest_path = shard_manifest_path(args.output, index, total)
+    
+    # Catálogo de origen en el manifest: nombre de la tabla de entrada
+    catalog_name = os.path.splitext(os.path.basename(args.table))[0]
+
     if args.legacy:
-        download_legacy(data, args.output, args.radii_default, priority=args.priority)
+        if args.engine == "stream":
+            from download_to_dataset import download_legacy_stream
+            download_legacy_stream(data, args.output, args.radii_default,
+                                   label_column=args.label_column,
+                                   concurrency=args.concurrency or 32, priority=args.priority,
+                                   base_url=args.base_url, max_attempts=args.max_attempts,
+                                   metrics_path=args.metrics,
+                                   metrics_interval=args.metrics_interval)
+        elif args.engine == "async":
+            from download_legacy_async import download_legacy_async
+            download_legacy_async(data, args.output, args.radii_default,
+                                  checkpoint_file=checkpoint_file,
+                                  concurrency=args.concurrency or 32, priority=args.priority,
+                                  base_url=args.base_url, manifest_path=manifest_path,
+                                  label_column=args.label_column, catalog_name=catalog_name,
+                                  metrics_path=args.metrics,
+                                  metrics_interval=args.metrics_interval,
+                                  max_attempts=args.max_attempts, verify=args.verify)
+        else:
+            download_legacy(data, args.output, args.radii_default,
+                            checkpoint_file=checkpoint_file, priority=args.priority,
+                            base_url=args.base_url, concurrency=args.concurrency,
+                            manifest_path=manifest_path, label_column=args.label_column,
+                            catalog_name=catalog_name, max_attempts=args.max_attempts,
+                            verify=args.verify, metrics_path=args.metrics,
+                            metrics_interval=args.metrics_interval)
 
 if __name__ == "__main__":
-    # Verificar si psutil está instalado
-    try:
-        import psutil
-    except ImportError:
-        print("Error: psutil library is required. Install with: pip install psutil")
-        sys.exit(1)
-    
     main()
@@ -0,0 +1,260 @@
+import asyncio
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from download_lagacy_imagescoloured_final_v2 import LEGACY_URL, read_table, prepare_downloads
+from checkpoint_store import open_checkpoint
+from download_integrity import atomic_write, validate_content, verify_tree
+from download_metrics import DownloadMetrics, DEFAULT_INTERVAL
+from manifest import update_manifest
+from rate_controller import AdaptiveRateController, THROTTLE_STATUS
+from retry_queue import DEFAULT_MAX_ATTEMPTS, write_failed_ledger
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+
+async def fetch_cutout(session, url):
+    """Descarga un cutout reutilizando las conexiones del pool.
+
+    Devuelve (status, bytes, motivo si el cuerpo de un 200 no es válido).
+    """
+    async with session.get(url) as response:
+        # Leer siempre el cuerpo para devolver la conexión al pool
+        content = await response.read()
+        if response.status != 200:
+            return response.status, None, None
+        # Con Content-Encoding la longitud anunciada es la comprimida
+        expected = None if response.headers.get('Content-Encoding') else response.content_length
+        return response.status, content, validate_content(content, expected)
+
+
+async def download_with_retry(session, controller, url, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                              metrics=None):
+    """Reintenta 429/5xx y errores de red; nunca descarta por congestión.
+
+    Devuelve (bytes, None) o (None, motivo del fallo).
+    """
+    reason = None
+    for attempt in range(max_attempts):
+        await controller.acquire_async()
+        start = time.time()
+        status = None
+        content = None
+        invalid = None
+        try:
+            status, content, invalid = await fetch_cutout(session, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            reason = f"{type(e).__name__}: {e}"
+            logging.warning(f"Download error for {url}: {str(e)}")
+        finally:
+            elapsed = time.time() - start
+            controller.record(elapsed, status, valid=not invalid)
+            if metrics is not None:
+                metrics.record_request(elapsed, status, len(content) if content else 0)
+            await controller.release_async()
+
+        if status == 200 and not invalid:
+            return content, None
+        if invalid:
+            # Cuerpo truncado o incompleto: se reintenta como un error de red
+            reason = invalid
+            logging.warning(f"Invalid response for {url}: {invalid}")
+        elif status is not None:
+            reason = f"HTTP {status}"
+            if status not in THROTTLE_STATUS:
+                logging.error(f"Failed to download: {url} (Status: {status})")
+                return None, reason
+        if attempt + 1 < max_attempts:
+            await asyncio.sleep(controller.backoff_delay(attempt))
+
+    logging.error(f"Failed to download: {url} after {max_attempts} attempts")
+    return None, reason
+
+
+async def save_to_file(item, content):
+    """Destino por defecto: un JPEG por objeto"""
+    file_path = item[1]
+    atomic_write(file_path, content)
+    logging.debug(f"Downloaded: {file_path}")
+    return file_path
+
+
+async def _worker(session, controller, queue, store, stats, handle, metrics=None, on_done=None,
+                  max_attempts=DEFAULT_MAX_ATTEMPTS, store_executor=None):
+    """Consume la cola de descargas hasta recibir None
+
+    Las actualizaciones del checkpoint (que pueden disparar un commit con
+    fsync) se ejecutan en store_executor, fuera del event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            url, file_path, key = item[:3]
+            result = None
+            try:
+                content, reason = await download_with_retry(session, controller, url,
+                                                            max_attempts, metrics)
+                if content is not None:
+                    result = await handle(item, content)
+                    if result is None:
+                        reason = "rejected by sink"
+            except Exception as e:
+                # p.ej. disco lleno al escribir: el objeto falla, el worker sigue
+                logging.error(f"Could not store {url}: {type(e).__name__}: {e}")
+                result, reason = None, f"{type(e).__name__}: {e}"
+            if metrics is not None:
+                metrics.record_object(bool(result))
+            if not result:
+                await loop.run_in_executor(store_executor, store.mark_failed, key, reason,
+                                           file_path)
+            else:
+                # Mismo checkpoint indexado que el motor con hilos
+                await loop.run_in_executor(store_executor, store.mark_done, key, result)
+                if on_done is not None:
+                    await loop.run_in_executor(store_executor, on_done, item, result)
+                stats['downloaded'] += 1
+                if stats['downloaded'] % 100 == 0:
+                    logging.info(f"Progress: {stats['downloaded']}/{stats['total']} downloaded")
+        finally:
+            queue.task_done()
+
+
+async def download_all(urls_file_paths, store, controller, timeout=30, handle=save_to_file,
+                       metrics=None, on_done=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Descarga la lista sobre un pool keep-alive; el controlador fija las peticiones en vuelo.
+
+    handle(item, content) decide qué hacer con los bytes descargados y
+    devuelve el identificador que se guarda en el checkpoint (o None).
+    on_done(item, resultado) se llama después de marcarlo como hecho, en el
+    mismo hilo del checkpoint (puede hacer flush sin bloquear el event loop).
+    """
+    concurrency = controller.max_limit
+    stats = {'downloaded': 0, 'total': len(urls_file_paths)}
+    if not urls_file_paths:
+        return stats
+
+    # Un único conector: las conexiones TLS se reutilizan entre peticiones
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency,
+                                     keepalive_timeout=60, ttl_dns_cache=300)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    # Cola acotada: no se crean decenas de miles de tareas en memoria
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+
+    # Un único hilo para el checkpoint: las actualizaciones conservan su orden
+    store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+    try:
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=client_timeout) as session:
+            workers = [asyncio.create_task(_worker(session, controller, queue, store, stats,
+                                                   handle, metrics, on_done, max_attempts,
+                                                   store_executor))
+                       for _ in range(concurrency)]
+
+            async def produce():
+                for item in urls_file_paths:
+                    await queue.put(item)
+                for _ in workers:
+                    await queue.put(None)
+
+            # Productor y workers juntos: si un worker muere el error se
+            # propaga en lugar de dejar al productor bloqueado en la cola llena
+            producer = asyncio.create_task(produce())
+            try:
+                await asyncio.gather(producer, *workers)
+            except BaseException:
+                for task in [producer] + workers:
+                    task.cancel()
+                raise
+    finally:
+        store_executor.shutdown(wait=True)
+    return stats
+
+
+def download_legacy_async(data, out_path, radii_default=256, checkpoint_file=None,
+                          concurrency=32, timeout=30, base_url=LEGACY_URL, priority=0.5,
+                          adaptive=True, manifest_path=None, label_column='label',
+                          catalog_name=None, metrics_path=None,
+                          metrics_interval=DEFAULT_INTERVAL, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                          verify=False):
+    """Equivalente asíncrono de download_legacy (mismo checkpoint, --verify y registro de fallidos)"""
+    os.makedirs(out_path, exist_ok=True)
+
+    store = open_checkpoint(out_path, checkpoint_file)
+    if verify:
+        # Ficheros truncados de ejecuciones anteriores: cuarentena y re-encolado
+        verify_tree(out_path, store=store)
+    urls_file_paths, missing = prepare_downloads(data, out_path, radii_default,
+                                                 store, base_url)
+    if urls_file_paths is None:
+        store.close()
+        return
+
+    logging.info(f"Total images to download: {len(urls_file_paths)}")
+    logging.info(f"Images already downloaded: {len(missing)}")
+
+    controller = AdaptiveRateController(max_limit=concurrency, priority=priority,
+                                        adaptive=adaptive)
+    metrics = DownloadMetrics(len(urls_file_paths), controller, metrics_path, metrics_interval)
+    metrics.attach_store(store)
+    start = time.time()
+    try:
+        with metrics:
+            stats = asyncio.run(download_all(urls_file_paths, store, controller, timeout,
+                                             metrics=metrics, max_attempts=max_attempts))
+            # Último commit dentro de la ventana medida
+            store.flush()
+        write_failed_ledger(store)
+    finally:
+        store.close()
+    elapsed = time.time() - start
+    rate = stats['downloaded'] / elapsed if elapsed > 0 else 0.0
+    logging.info(f"Successfully downloaded {stats['downloaded']} images "
+                 f"in {elapsed:.1f}s ({rate:.1f} img/s, max concurrency={concurrency})")
+    logging.info(f"Rate controller: {controller.summary()}")
+
+    update_manifest(data, out_path, radii_default, manifest_path,
+                    label_column=label_column, catalog_name=catalog_name)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download Legacy images with asyncio")
+    parser.add_argument("table", help="Path to input table")
+    parser.add_argument("--radii_default", type=int, default=256, help="Default pixel radius")
+    parser.add_argument("--output", default="./legacy_color_images", help="Output directory")
+    parser.add_argument("--concurrency", type=int, default=32, help="Max in-flight requests")
+    parser.add_argument("--priority", type=float, default=0.5,
+                        help="Task priority (0.1=low, 1.0=high, default=0.5)")
+    parser.add_argument("--base-url", default=LEGACY_URL, help="Cutout service endpoint")
+    parser.add_argument("--metrics", default=None, metavar="PATH",
+                        help="Periodic metrics dump (.prom = Prometheus text, otherwise JSON)")
+    parser.add_argument("--metrics-interval", type=float, default=DEFAULT_INTERVAL,
+                        help="Seconds between metrics dumps / progress lines")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="Attempts per object before it goes to the failed-object ledger")
+    parser.add_argument("--verify", action="store_true",
+                        help="Scan existing files first; quarantine and re-download corrupt ones")
+
+    args = parser.parse_args()
+
+    data = read_table(args.table)
+    if data is None:
+        return
+
+    download_legacy_async(data, args.output, args.radii_default,
+                          concurrency=args.concurrency, priority=args.priority,
+                          base_url=args.base_url, metrics_path=args.metrics,
+                          metrics_interval=args.metrics_interval,
+                          max_attempts=args.max_attempts, verify=args.verify)
+
+
+if __name__ == "__main__":
+    main()
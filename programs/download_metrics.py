@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+
+# Métricas de las descargas.
+#
+# Hasta ahora la única señal era una línea de log cada 10 descargas. Aquí
+# se acumulan, con coste O(1) por petición: histograma de latencias,
+# bytes recibidos, peticiones por código de estado (None = error de red),
+# peticiones en vuelo y límite del controlador, tiempo de cada flush del
+# checkpoint, objetos completados/fallidos y ETA. Un hilo en segundo plano
+# vuelca periódicamente un JSON o texto Prometheus (según la extensión,
+# .prom) de forma atómica, y al terminar se registra un resumen.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FLUSH_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+DEFAULT_INTERVAL = 30.0
+PROMETHEUS_PREFIX = 'legacy_download'
+
+
+class Histogram:
+    """Histograma acumulativo con límites fijos (como los de Prometheus)"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Cuantil aproximado por interpolación lineal dentro del bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def as_dict(self):
+        mean = self.sum / self.count if self.count else None
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': mean,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': {str(b): c for b, c in zip(self.buckets + ('+Inf',), self.counts)},
+        }
+
+    def prometheus(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, n in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class DownloadMetrics:
+    def __init__(self, total=0, controller=None, dump_path=None, interval=DEFAULT_INTERVAL):
+        """
+        total: objetos a descargar en esta ejecución (para la ETA)
+        controller: AdaptiveRateController del que se leen en vuelo y límite
+        dump_path: fichero de volcado periódico (.prom = texto Prometheus, si no JSON)
+        """
+        self.total = total
+        self.controller = controller
+        self.dump_path = dump_path
+        self.interval = interval
+
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.flush_time = Histogram(FLUSH_BUCKETS)
+        self.status_counts = {}
+        self.bytes = 0
+        self.completed = 0
+        self.failed = 0
+
+        self.start_time = time.time()
+        # Ventana para las tasas recientes: (instante, objetos, bytes) del último volcado
+        self._window = (self.start_time, 0, 0)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ------------------------------------------------------------------
+    # Registro (llamado desde los hilos de descarga)
+    # ------------------------------------------------------------------
+    def record_request(self, latency, status, nbytes=0):
+        """Una petición HTTP (status None = excepción de red)"""
+        key = str(status) if status is not None else 'error'
+        with self._lock:
+            self.latency.observe(latency)
+            self.status_counts[key] = self.status_counts.get(key, 0) + 1
+            self.bytes += nbytes
+
+    def record_object(self, ok):
+        """Un objeto terminado: descargado u otro fallo definitivo"""
+        with self._lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def record_flush(self, rows, elapsed):
+        with self._lock:
+            self.flush_time.observe(elapsed)
+
+    def attach_store(self, store):
+        """Mide los flush del checkpoint"""
+        store.on_flush = self.record_flush
+        return store
+
+    # ------------------------------------------------------------------
+    # Lectura
+    # ------------------------------------------------------------------
+    def snapshot(self, advance_window=False):
+        """Estado actual como dict (tasas globales y desde el último volcado)"""
+        now = time.time()
+        with self._lock:
+            elapsed = max(now - self.start_time, 1e-9)
+            finished = self.completed + self.failed
+            window_start, window_done, window_bytes = self._window
+            window = max(now - window_start, 1e-9)
+            recent_rate = (finished - window_done) / window
+            recent_bytes = (self.bytes - window_bytes) / window
+            if advance_window:
+                self._window = (now, finished, self.bytes)
+
+            requests = sum(self.status_counts.values())
+            errors = sum(n for status, n in self.status_counts.items() if status != '200')
+            rate = finished / elapsed
+            remaining = max(self.total - finished, 0)
+            # ETA con la tasa reciente (la global arrastra el arranque lento)
+            eta_rate = recent_rate if window >= 1.0 and recent_rate > 0 else rate
+            snapshot = {
+                'timestamp': now,
+                'elapsed_s': elapsed,
+                'total': self.total,
+                'completed': self.completed,
+                'failed': self.failed,
+                'remaining': remaining,
+                'objects_per_s': rate,
+                'recent_objects_per_s': recent_rate,
+                'eta_s': remaining / eta_rate if eta_rate > 0 else None,
+                'requests': requests,
+                'status_counts': dict(self.status_counts),
+                'error_rate': errors / requests if requests else 0.0,
+                'bytes': self.bytes,
+                'bytes_per_s': self.bytes / elapsed,
+                'recent_bytes_per_s': recent_bytes,
+                'latency_s': self.latency.as_dict(),
+                'checkpoint_flush_s': self.flush_time.as_dict(),
+            }
+        if self.controller is not None:
+            snapshot['in_flight'] = self.controller.in_flight
+            snapshot['concurrency_limit'] = int(self.controller.limit)
+        return snapshot
+
+    def prometheus(self, snapshot=None):
+        """Texto en formato de exposición de Prometheus"""
+        snapshot = snapshot or self.snapshot()
+        p = PROMETHEUS_PREFIX
+        lines = [f"# HELP {p}_requests_total HTTP requests by status code (error = network)",
+                 f"# TYPE {p}_requests_total counter"]
+        for status, n in sorted(snapshot['status_counts'].items()):
+            lines.append(f'{p}_requests_total{{status="{status}"}} {n}')
+        gauges = [
+            ('bytes_total', 'counter', 'Response bytes received', snapshot['bytes']),
+            ('objects_completed_total', 'counter', 'Objects downloaded', snapshot['completed']),
+            ('objects_failed_total', 'counter', 'Objects that failed for good', snapshot['failed']),
+            ('objects_remaining', 'gauge', 'Objects still pending', snapshot['remaining']),
+            ('bytes_per_second', 'gauge', 'Recent receive rate', snapshot['recent_bytes_per_s']),
+            ('eta_seconds', 'gauge', 'Estimated time to completion', snapshot['eta_s']),
+            ('in_flight', 'gauge', 'Requests in flight', snapshot.get('in_flight')),
+            ('concurrency_limit', 'gauge', 'Rate controller limit',
+             snapshot.get('concurrency_limit')),
+        ]
+        for name, kind, help_text, value in gauges:
+            if value is None:
+                continue
+            lines += [f"# HELP {p}_{name} {help_text}", f"# TYPE {p}_{name} {kind}",
+                      f"{p}_{name} {value}"]
+        with self._lock:
+            lines += self.latency.prometheus(f"{p}_request_seconds", "Request latency")
+            lines += self.flush_time.prometheus(f"{p}_checkpoint_flush_seconds",
+                                                "Checkpoint commit time")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None):
+        """Vuelca el estado a path (atómico); devuelve el snapshot"""
+        path = path or self.dump_path
+        snapshot = self.snapshot(advance_window=True)
+        if path:
+            if path.endswith('.prom'):
+                content = self.prometheus(snapshot)
+            else:
+                content = json.dumps(snapshot, indent=1)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return snapshot
+
+    def progress_line(self, snapshot):
+        eta = snapshot['eta_s']
+        eta_text = time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else '?'
+        line = (f"{snapshot['completed'] + snapshot['failed']}/{snapshot['total']} objects, "
+                f"{snapshot['recent_objects_per_s']:.1f} obj/s, "
+                f"{snapshot['recent_bytes_per_s'] / 1e6:.2f} MB/s, "
+                f"p50 {_fmt_seconds(snapshot['latency_s']['p50'])} "
+                f"p99 {_fmt_seconds(snapshot['latency_s']['p99'])}, "
+                f"errors {snapshot['error_rate']:.1%}, ETA {eta_text}")
+        if 'in_flight' in snapshot:
+            line += f", in flight {snapshot['in_flight']}/{snapshot['concurrency_limit']}"
+        return line
+
+    def summary(self):
+        """Resumen final en varias líneas"""
+        s = self.snapshot()
+        statuses = ", ".join(f"{k}: {v}" for k, v in sorted(s['status_counts'].items()))
+        lat = s['latency_s']
+        flush = s['checkpoint_flush_s']
+        return "\n".join([
+            f"Download metrics after {s['elapsed_s']:.1f}s:",
+            f"  objects: {s['completed']} downloaded, {s['failed']} failed, "
+            f"{s['remaining']} remaining ({s['objects_per_s']:.2f} obj/s)",
+            f"  requests: {s['requests']} ({statuses or 'none'}), "
+            f"error rate {s['error_rate']:.1%}",
+            f"  received: {s['bytes'] / 1e6:.1f} MB ({s['bytes_per_s'] / 1e6:.2f} MB/s)",
+            f"  latency: mean {_fmt_seconds(lat['mean'])}, p50 {_fmt_seconds(lat['p50'])}, "
+            f"p90 {_fmt_seconds(lat['p90'])}, p99 {_fmt_seconds(lat['p99'])}, "
+            f"max {_fmt_seconds(lat['max'])}",
+            f"  checkpoint flushes: {flush['count']} ({flush['sum']:.3f}s total, "
+            f"max {_fmt_seconds(flush['max'])})",
+        ])
+
+    # ------------------------------------------------------------------
+    # Volcado periódico
+    # ------------------------------------------------------------------
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            logging.info(f"Metrics: {self.progress_line(self.dump())}")
+
+    def stop(self):
+        """Detiene el volcado periódico, escribe el último y registra el resumen"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.dump()
+        logging.info(self.summary())
+        if self.dump_path:
+            logging.info(f"Metrics written to {self.dump_path}")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def _fmt_seconds(value):
+    if value is None:
+        return '-'
+    return f"{value * 1000:.0f}ms" if value < 1 else f"{value:.2f}s"
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from checkpoint_store import DEFAULT_LAYER, DEFAULT_PIXSCALE, DEFAULT_BANDS
+
+# Construcción vectorizada del plan de descargas.
+#
+# Sustituye al bucle data.iterrows() + os.path.exists por fila: las URLs y
+# nombres se generan con operaciones de columna, los ficheros existentes se
+# obtienen con un único os.scandir y se comparan como conjunto.
+
+LEGACY_URL = "https://www.legacysurvey.org/viewer/jpeg-cutout"
+
+
+def scan_existing(out_path, suffix='.jpeg'):
+    """Nombres de los ficheros ya presentes en out_path (un solo scandir)"""
+    if not os.path.isdir(out_path):
+        return set()
+    with os.scandir(out_path) as entries:
+        return {entry.name for entry in entries
+                if entry.name.endswith(suffix) and entry.is_file()}
+
+
+def _row_dtype(data):
+    """dtype de las filas que devolvía data.iterrows() (común a todas las columnas)"""
+    return np.result_type(*[dtype if isinstance(dtype, np.dtype) else np.dtype(object)
+                            for dtype in data.dtypes])
+
+
+def build_download_plan(data, out_path, radii_default=256, store=None, base_url=LEGACY_URL,
+                        layer=DEFAULT_LAYER, pixscale=DEFAULT_PIXSCALE, bands=DEFAULT_BANDS,
+                        extension='jpeg'):
+    """Plan de descargas como DataFrame, una fila por objeto del catálogo.
+
+    Columnas: row_index, ra, dec, size, file_name, file_path, url, exists,
+    in_checkpoint, needs_download. Los nombres son idénticos a los de
+    download_legacy ({ra}_{dec}_{idx}_{size}pix.jpeg; extension='fits'
+    para los cutouts FITS de fits_cutouts.py).
+    """
+    if 'ra' not in data.columns or 'dec' not in data.columns:
+        raise KeyError("Dataframe missing 'ra' or 'dec' columns")
+
+    ra = data['ra'].to_numpy()
+    dec = data['dec'].to_numpy()
+    if 'radii' in data.columns:
+        size = data['radii']
+    else:
+        size = pd.Series(radii_default, index=data.index)
+
+    # str(float) vectorizado: mismo formato que f"{ra}" (repr más corto).
+    # iterrows convertía cada fila al dtype común de la tabla: en tablas solo
+    # numéricas un radii entero salía como "256.0" en el nombre y en la URL
+    columns = [data['ra'], data['dec'], size]
+    if 'radii' in data.columns and _row_dtype(data).kind == 'f':
+        columns = [column.astype(float) for column in columns]
+    ra_str, dec_str, size_str = (column.astype(str) for column in columns)
+    idx_str = pd.Series(data.index.astype(str), index=data.index)
+
+    file_name = ra_str + '_' + dec_str + '_' + idx_str + '_' + size_str + f'pix.{extension}'
+    file_path = os.path.join(out_path, '') + file_name
+    url = (f"{base_url}?ra=" + ra_str + "&dec=" + dec_str + "&size=" + size_str
+           + f"&layer={layer}&pixscale={pixscale}&bands={bands}")
+
+    # Ficheros existentes: diferencia de conjuntos en lugar de stat por fila
+    exists = file_name.isin(scan_existing(out_path, f'.{extension}')).to_numpy()
+
+    in_checkpoint = np.zeros(len(data), dtype=bool)
+    if store is not None and len(store):
+        done = [key[:3] for key in store.done_keys()
+                if key[3:] == (layer, float(pixscale), bands)]
+        if done:
+            keys = pd.MultiIndex.from_arrays([ra.astype(float), dec.astype(float),
+                                              size.to_numpy().astype(int)])
+            in_checkpoint = keys.isin(done)
+
+    return pd.DataFrame({
+        'row_index': data.index.to_numpy(),
+        'ra': ra,
+        'dec': dec,
+        'size': size.to_numpy(),
+        'file_name': file_name.to_numpy(),
+        'file_path': file_path.to_numpy(),
+        'url': url.to_numpy(),
+        'exists': exists,
+        'in_checkpoint': in_checkpoint,
+        'needs_download': ~(exists | in_checkpoint),
+    })
+
+
+def plan_to_arrow(plan):
+    """Plan como tabla Arrow"""
+    import pyarrow as pa
+    return pa.Table.from_pandas(plan, preserve_index=False)
+
+
+def write_plan(plan, path):
+    """Guarda el plan en Parquet"""
+    import pyarrow.parquet as pq
+    pq.write_table(plan_to_arrow(plan), path)
+    logging.info(f"Download plan written to {path} ({len(plan)} rows)")
+
+
+def legacy_prepare_downloads(data, out_path, radii_default, downloaded_files, base_url=LEGACY_URL):
+    """Bucle original con iterrows (solo para el benchmark)"""
+    urls_file_paths = []
+    missing = []
+    for idx, row in data.iterrows():
+        ra = row["ra"]
+        dec = row["dec"]
+        radii = row.get('radii', radii_default)
+        unique_name = f"{ra}_{dec}_{idx}"
+        file_name = f"{unique_name}_{radii}pix.jpeg"
+        file_path = os.path.join(out_path, file_name)
+        url = f"{base_url}?ra={ra}&dec={dec}&size={radii}&layer=ls-dr9&pixscale=0.262&bands=grz"
+        if file_path not in downloaded_files and not os.path.exists(file_path):
+            urls_file_paths.append((url, file_path))
+        else:
+            missing.append(file_path)
+    return urls_file_paths, missing
+
+
+def benchmark(n_rows=1_000_000, legacy_rows=None, existing_fraction=0.1, seed=42):
+    """Compara el plan vectorizado con el bucle iterrows sobre n_rows filas sintéticas"""
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'ra': rng.uniform(0, 360, n_rows),
+        'dec': rng.uniform(-60, 30, n_rows),
+    })
+
+    with tempfile.TemporaryDirectory() as out_path:
+        # Una fracción de los ficheros ya existe en disco
+        n_existing = int(n_rows * existing_fraction)
+        names = (data['ra'].astype(str) + '_' + data['dec'].astype(str) + '_'
+                 + data.index.astype(str) + '_256pix.jpeg')
+        for name in names.iloc[:n_existing]:
+            open(os.path.join(out_path, name), 'wb').close()
+
+        start = time.perf_counter()
+        plan = build_download_plan(data, out_path)
+        vector_time = time.perf_counter() - start
+
+        subset = data if legacy_rows is None else data.iloc[:legacy_rows]
+        start = time.perf_counter()
+        pending, _ = legacy_prepare_downloads(subset, out_path, 256, {})
+        legacy_time = (time.perf_counter() - start) * n_rows / len(subset)
+
+    assert int(plan['needs_download'].sum()) == n_rows - n_existing
+    if legacy_rows is None:
+        assert len(pending) == int(plan['needs_download'].sum())
+
+    extrapolated = " (extrapolated)" if legacy_rows is not None else ""
+    print(f"Download plan benchmark ({n_rows} rows, {n_existing} existing files)")
+    print(f"  iterrows loop: {legacy_time:8.2f}s{extrapolated}")
+    print(f"  vectorized:    {vector_time:8.2f}s")
+    print(f"  speedup:       {legacy_time / vector_time:8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a vectorized download plan")
+    parser.add_argument("table", nargs='?', help="Path to input table")
+    parser.add_argument("--output", default="./legacy_color_images", help="Output directory")
+    parser.add_argument("--radii_default", type=int, default=256, help="Default pixel radius")
+    parser.add_argument("--plan-out", default="download_plan.parquet", help="Parquet plan path")
+    parser.add_argument("--bench", type=int, metavar="N", help="Benchmark against iterrows on N rows")
+    parser.add_argument("--legacy-rows", type=int, default=None,
+                        help="Rows timed with the iterrows loop (extrapolated to N)")
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.bench, args.legacy_rows)
+        return
+
+    if args.table is None:
+        parser.error("table is required unless --bench is given")
+
+    from download_lagacy_imagescoloured_final_v2 import read_table
+    from checkpoint_store import open_checkpoint
+
+    data = read_table(args.table)
+    if data is None:
+        return
+    os.makedirs(args.output, exist_ok=True)
+    with open_checkpoint(args.output) as store:
+        plan = build_download_plan(data, args.output, args.radii_default, store)
+    write_plan(plan, args.plan_out)
+    print(f"{int(plan['needs_download'].sum())}/{len(plan)} cutouts need download")
+
+
+if __name__ == "__main__":
+    main()
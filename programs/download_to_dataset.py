@@ -0,0 +1,195 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from download_lagacy_imagescoloured_final_v2 import read_table
+from download_legacy_async import download_all
+from download_plan import LEGACY_URL, build_download_plan
+from checkpoint_store import make_key, open_checkpoint
+from download_metrics import DownloadMetrics, DEFAULT_INTERVAL
+from rate_controller import AdaptiveRateController
+from manifest import numeric_labels
+from packed_dataset import PackedDatasetWriter
+from preprocessing import (TARGET_SIZE, CROP_FACTOR, CROP_MODES, ORIGINAL_PIXSCALE,
+                           preprocess_bytes)
+from retry_queue import (DEFAULT_MAX_ATTEMPTS, failed_ledger_path, write_failed_ledger,
+                         read_failed_ledger)
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+# Descarga en streaming directamente a un dataset empaquetado: los bytes
+# de cada cutout se decodifican, recortan y redimensionan en memoria y se
+# añaden al dataset junto con su etiqueta, sin escribir un JPEG por objeto.
+
+
+def download_legacy_stream(data, dataset_dir, radii_default=256, label_column='label',
+                           crop_mode='fraction', target_size=TARGET_SIZE,
+                           crop_factor=CROP_FACTOR, concurrency=32, chunk_size=4096,
+                           flush_rows=1000, timeout=30, base_url=LEGACY_URL, priority=0.5,
+                           max_attempts=DEFAULT_MAX_ATTEMPTS, metrics_path=None,
+                           metrics_interval=DEFAULT_INTERVAL):
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    # El checkpoint solo se confirma junto con el dataset (ver on_done)
+    store = open_checkpoint(dataset_dir, batch_size=10 ** 9, flush_interval=float('inf'))
+    try:
+        plan = build_download_plan(data, dataset_dir, radii_default, store, base_url)
+    except KeyError as e:
+        logging.error(str(e))
+        store.close()
+        return
+
+    pending = plan[plan['needs_download']]
+
+    attrs = {
+        'crop_mode': crop_mode,
+        'crop_factor': crop_factor,
+        'target_size': list(target_size),
+        'source_size': int(radii_default),
+        'source_pixscale': ORIGINAL_PIXSCALE,
+        'scale': 1 / 255.0,
+    }
+    writer = PackedDatasetWriter(dataset_dir, image_shape=tuple(target_size) + (3,),
+                                 chunk_size=chunk_size, attrs=attrs)
+
+    # Filas ya confirmadas en el dataset pero ausentes del checkpoint (corte
+    # entre ambos flush): se reparan en el checkpoint en vez de duplicarlas
+    file_rows = writer.file_rows()
+    packed = pending['file_name'].isin(file_rows).to_numpy()
+    if packed.any():
+        for ra, dec, size, file_name in zip(pending['ra'][packed], pending['dec'][packed],
+                                            pending['size'][packed],
+                                            pending['file_name'][packed]):
+            store.mark_done(make_key(ra, dec, size), f"{dataset_dir}#{file_rows[file_name]}")
+        store.flush()
+        logging.info(f"{int(packed.sum())} objects already packed, checkpoint repaired")
+        pending = pending[~packed]
+
+    if label_column in data.columns:
+        labels = numeric_labels(data[label_column].reindex(pending['row_index']))
+    else:
+        logging.warning(f"Column '{label_column}' not found, labels set to -1")
+        labels = np.full(len(pending), -1)
+
+    items = [
+        (url, file_name, make_key(ra, dec, size), row_index, ra, dec, label)
+        for url, file_name, ra, dec, size, row_index, label in zip(
+            pending['url'], pending['file_name'], pending['ra'], pending['dec'],
+            pending['size'], pending['row_index'], labels)
+    ]
+    logging.info(f"Total images to download: {len(items)}")
+    logging.info(f"Images already in dataset: {len(plan) - len(items)}")
+
+    async def handle(item, content):
+        _, file_name, _, row_index, ra, dec, label = item
+        loop = asyncio.get_running_loop()
+        try:
+            # Decodificación y resize fuera del event loop
+            image = await loop.run_in_executor(None, preprocess_bytes, content, crop_mode,
+                                               tuple(target_size), crop_factor)
+        except Exception as e:
+            logging.error(f"Could not decode {file_name}: {str(e)}")
+            return None
+        # Fuera del event loop: append espera al lock del writer durante un flush
+        row = await loop.run_in_executor(None, writer.append, image, label, row_index, ra,
+                                         dec, file_name)
+        return f"{dataset_dir}#{row}"
+
+    def on_done(item, result):
+        # Se ejecuta en el hilo del checkpoint (download_all), en orden con
+        # los mark_done y sin bloquear las descargas en vuelo. Toda fila se
+        # añade antes de su mark_done, así que vaciar primero el dataset y
+        # después el checkpoint garantiza que tras un corte nunca hay
+        # objetos marcados como hechos que no estén en disco; el caso
+        # inverso (fila sin su mark_done) se repara al reanudar con
+        # writer.file_rows()
+        if writer.pending >= flush_rows:
+            writer.flush()
+            store.flush()
+
+    controller = AdaptiveRateController(max_limit=concurrency, priority=priority)
+    metrics = DownloadMetrics(len(items), controller, metrics_path, metrics_interval)
+    metrics.attach_store(store)
+    start = time.time()
+    try:
+        with metrics:
+            stats = asyncio.run(download_all(items, store, controller, timeout, handle=handle,
+                                             metrics=metrics, on_done=on_done,
+                                             max_attempts=max_attempts))
+            # Último flush (dataset y checkpoint) dentro de la ventana medida
+            writer.flush()
+            write_failed_ledger(store)
+    finally:
+        writer.close()
+        store.close()
+    elapsed = time.time() - start
+    rate = stats['downloaded'] / elapsed if elapsed > 0 else 0.0
+    logging.info(f"Packed {stats['downloaded']} images into {dataset_dir} "
+                 f"in {elapsed:.1f}s ({rate:.1f} img/s, {writer.count} rows total)")
+    logging.info(f"Rate controller: {controller.summary()}")
+    return stats
+
+
+def retry_failed_stream(data, dataset_dir, ledger_path=None, **kwargs):
+    """Vuelve a lanzar download_legacy_stream solo sobre los objetos del registro de fallidos
+
+    data es el catálogo original (para conservar índices y etiquetas).
+    """
+    ledger_path = ledger_path or failed_ledger_path(
+        os.path.join(dataset_dir, 'download_checkpoint.db'))
+    ledger = read_failed_ledger(ledger_path)
+    if ledger.empty:
+        logging.info(f"No failed objects in {ledger_path}")
+        return None
+    failed = pd.MultiIndex.from_arrays([ledger['ra'].astype(float), ledger['dec'].astype(float)])
+    selected = pd.MultiIndex.from_arrays([data['ra'].astype(float),
+                                          data['dec'].astype(float)]).isin(failed)
+    logging.info(f"Retrying {int(selected.sum())} failed objects from {ledger_path}")
+    return download_legacy_stream(data[selected], dataset_dir, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream Legacy cutouts into a packed dataset")
+    parser.add_argument("table", help="Path to input table")
+    parser.add_argument("--output", default="./packed_dataset", help="Dataset directory")
+    parser.add_argument("--radii_default", type=int, default=256, help="Default pixel radius")
+    parser.add_argument("--label-column", default="label", help="Column with the class label")
+    parser.add_argument("--crop-mode", choices=CROP_MODES, default="fraction",
+                        help="fraction (CROP_FACTOR) or deepshadows (30 arcsec)")
+    parser.add_argument("--target-size", type=int, default=TARGET_SIZE[0], help="Output size (px)")
+    parser.add_argument("--concurrency", type=int, default=32, help="Max in-flight requests")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="Images per chunk file")
+    parser.add_argument("--base-url", default=LEGACY_URL, help="Cutout service endpoint")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="Attempts per object before it goes to the failed-object ledger")
+    parser.add_argument("--metrics", default=None, metavar="PATH",
+                        help="Periodic metrics dump (.prom = Prometheus text, otherwise JSON)")
+    parser.add_argument("--metrics-interval", type=float, default=DEFAULT_INTERVAL,
+                        help="Seconds between metrics dumps / progress lines")
+    parser.add_argument("--retry-failed", nargs='?', const='', default=None, metavar="LEDGER",
+                        help="Only re-download the objects of the table listed in the "
+                             "failed-object ledger (default: failed_objects.csv of --output)")
+    args = parser.parse_args()
+
+    data = read_table(args.table)
+    if data is None:
+        return
+
+    kwargs = dict(radii_default=args.radii_default, label_column=args.label_column,
+                  crop_mode=args.crop_mode, target_size=(args.target_size, args.target_size),
+                  concurrency=args.concurrency, chunk_size=args.chunk_size,
+                  base_url=args.base_url, max_attempts=args.max_attempts,
+                  metrics_path=args.metrics, metrics_interval=args.metrics_interval)
+    if args.retry_failed is not None:
+        retry_failed_stream(data, args.output, args.retry_failed or None, **kwargs)
+    else:
+        download_legacy_stream(data, args.output, **kwargs)
+
+
+if __name__ == "__main__":
+    main()
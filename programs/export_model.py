@@ -0,0 +1,298 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
+
+from input_pipeline import ArraySource, batch_generator, ARRAY_DIR, LABEL_DIR
+
+# Exportación del clasificador a runtimes ligeros de CPU.
+#
+# TensorFlow completo tarda segundos en importarse y ocupa cientos de MB por
+# worker. El modelo Keras (train_deepshadows.py / notebooks) se exporta a
+# TFLite (con int8 post-training calibrado sobre X_val) y, si están
+# instalados tf2onnx/onnxruntime, a ONNX. El informe compara precisión y
+# AUC con el modelo Keras y la latencia/memoria de cada runtime medida en un
+# proceso nuevo (import + carga + inferencia).
+
+EXPORT_DIR = '../Datasets_DeepShadows/exported/'
+
+
+def _float32_model(model):
+    """Copia del modelo con política float32 (los modelos bf16 no convierten a int8)"""
+    config = model.get_config()
+    for layer in config.get('layers', []):
+        if 'dtype' in layer.get('config', {}):
+            layer['config']['dtype'] = 'float32'
+    clone = model.__class__.from_config(config)
+    clone.set_weights([np.asarray(w, dtype=np.float32) for w in model.get_weights()])
+    return clone
+
+
+def calibration_data(source, n_samples=512, batch_size=1, seed=0):
+    """Generador representativo para la cuantización (muestras aleatorias de X_val)"""
+    def generator():
+        seen = 0
+        for x, _ in batch_generator(source, batch_size, shuffle=True, buffer_size=2048,
+                                    seed=seed):
+            yield [x]
+            seen += len(x)
+            if seen >= n_samples:
+                break
+    return generator
+
+
+def export_tflite(model, path, calibration=None):
+    """Keras -> .tflite; con calibration, cuantización int8 completa (E/S float32)"""
+    import tensorflow as tf
+
+    saved_model = tempfile.mkdtemp(prefix='export_sm_')
+    try:
+        _float32_model(model).export(saved_model, format='tf_saved_model', verbose=False)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model)
+        if calibration is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = calibration
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        content = converter.convert()
+    finally:
+        shutil.rmtree(saved_model, ignore_errors=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def export_onnx(model, path, calibration=None):
+    """Keras -> .onnx (tf2onnx); con calibration, int8 estático (onnxruntime)"""
+    try:
+        import tf2onnx
+        import tensorflow as tf
+    except ImportError:
+        raise ImportError("tf2onnx is required for ONNX export. Install with: pip install tf2onnx")
+
+    model = _float32_model(model)
+    spec = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name='input'),)
+    float_path = path if calibration is None else path + '.float.onnx'
+    tf2onnx.convert.from_keras(model, input_signature=spec, output_path=float_path)
+    if calibration is None:
+        return path
+
+    try:
+        from onnxruntime.quantization import (quantize_static, CalibrationDataReader,
+                                              QuantType, QuantFormat)
+    except ImportError:
+        raise ImportError("onnxruntime is required for ONNX int8 quantization. "
+                          "Install with: pip install onnxruntime")
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self._batches = iter(calibration())
+
+        def get_next(self):
+            batch = next(self._batches, None)
+            return None if batch is None else {'input': batch[0]}
+
+    quantize_static(float_path, path, Reader(), quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    os.remove(float_path)
+    return path
+
+
+class TFLiteScorer:
+    """Inferencia TFLite sin TensorFlow si hay LiteRT / tflite_runtime instalado"""
+
+    def __init__(self, path, threads=1):
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                import tensorflow as tf
+                Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=threads)
+        self._input = self.interpreter.get_input_details()[0]['index']
+        self._output = self.interpreter.get_output_details()[0]['index']
+        self._batch = None
+
+    def __call__(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if self._batch != len(x):
+            # Redimensionar solo cuando cambia el tamaño de batch
+            self.interpreter.resize_tensor_input(self._input, x.shape)
+            self.interpreter.allocate_tensors()
+            self._batch = len(x)
+        self.interpreter.set_tensor(self._input, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output).reshape(-1).astype(np.float32)
+
+
+class OnnxScorer:
+    def __init__(self, path, threads=1):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("onnxruntime is required for .onnx models. "
+                              "Install with: pip install onnxruntime")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self._input = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        out = self.session.run(None, {self._input: np.asarray(x, dtype=np.float32)})[0]
+        return out.reshape(-1).astype(np.float32)
+
+
+class KerasScorer:
+    def __init__(self, path, threads=1):
+        from train_deepshadows import configure_cpu
+        tf = configure_cpu(intra_op=threads, inter_op=1)
+        self.model = tf.keras.models.load_model(path, compile=False)
+
+    def __call__(self, x):
+        return np.asarray(self.model(x, training=False), dtype=np.float32).reshape(-1)
+
+
+def load_scorer(path, threads=1):
+    """Función batch float32 -> scores según la extensión del modelo"""
+    if path.endswith('.tflite'):
+        return TFLiteScorer(path, threads)
+    if path.endswith('.onnx'):
+        return OnnxScorer(path, threads)
+    return KerasScorer(path, threads)
+
+
+def predict(scorer, source, batch_size=256):
+    """Scores y etiquetas de toda la fuente, en orden"""
+    scores, labels = [], []
+    for x, y in batch_generator(source, batch_size, shuffle=False):
+        scores.append(scorer(x))
+        labels.append(y)
+    return np.concatenate(scores), np.concatenate(labels)
+
+
+def parity_metrics(scores, labels, reference=None):
+    from sklearn.metrics import roc_auc_score
+
+    metrics = {
+        'accuracy': float(np.mean((scores > 0.5) == (labels > 0.5))),
+        'auc': float(roc_auc_score(labels, scores)) if len(np.unique(labels)) > 1 else float('nan'),
+    }
+    if reference is not None:
+        metrics['max_abs_diff'] = float(np.max(np.abs(scores - reference)))
+        metrics['class_agreement'] = float(np.mean((scores > 0.5) == (reference > 0.5)))
+    return metrics
+
+
+def _measure_runtime(path, batch_size, repeats, threads):
+    """En un proceso nuevo: tiempo de import+carga, RSS y latencia por batch"""
+    import psutil
+
+    process = psutil.Process()
+    rss_start = process.memory_info().rss
+    start = time.perf_counter()
+    scorer = load_scorer(path, threads)
+    x = np.random.default_rng(0).random((batch_size, 64, 64, 3), dtype=np.float32)
+    scorer(x)
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        scorer(x)
+        latencies.append(time.perf_counter() - t0)
+    return {
+        'load_s': load_time,
+        'rss_mb': (process.memory_info().rss - rss_start) / 1024 ** 2,
+        'latency_ms': 1000 * float(np.median(latencies)),
+        'samples_per_s': batch_size / float(np.median(latencies)),
+    }
+
+
+def measure_runtime(path, batch_size=256, repeats=20, threads=1):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_measure_runtime, path, batch_size, repeats, threads).result()
+
+
+def export_and_compare(model_path, out_dir=EXPORT_DIR, formats=('tflite',), int8=True,
+                       array_dir=ARRAY_DIR, label_dir=LABEL_DIR, calib_set='val', eval_set='test',
+                       calib_samples=512, batch_sizes=(1, 256), threads=1):
+    """Exporta, comprueba paridad en eval_set y compara latencia/memoria"""
+    from train_deepshadows import configure_cpu
+    tf = configure_cpu(intra_op=threads)
+
+    os.makedirs(out_dir, exist_ok=True)
+    model = tf.keras.models.load_model(model_path, compile=False)
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    calibration = None
+    if int8:
+        calibration = calibration_data(ArraySource.from_split(calib_set, array_dir, label_dir),
+                                       calib_samples)
+
+    exported = {'keras': model_path}
+    for fmt in formats:
+        export = export_tflite if fmt == 'tflite' else export_onnx
+        exported[f'{fmt} float32'] = export(model, os.path.join(out_dir, f'{name}.{fmt}'))
+        if int8:
+            exported[f'{fmt} int8'] = export(model, os.path.join(out_dir, f'{name}_int8.{fmt}'),
+                                             calibration)
+
+    eval_source = ArraySource.from_split(eval_set, array_dir, label_dir)
+    reference, labels = predict(lambda x: np.asarray(model(x, training=False)).reshape(-1),
+                                eval_source)
+
+    report = {}
+    for label, path in exported.items():
+        scores = reference if label == 'keras' else predict(load_scorer(path, threads),
+                                                            eval_source)[0]
+        entry = parity_metrics(scores, labels, None if label == 'keras' else reference)
+        entry['size_mb'] = os.path.getsize(path) / 1024 ** 2 if os.path.isfile(path) else None
+        for batch_size in batch_sizes:
+            entry[f'batch{batch_size}'] = measure_runtime(path, batch_size, threads=threads)
+        report[label] = entry
+
+    print(f"\nExport report ({eval_set}: {len(labels)} samples, {threads} thread(s))")
+    print(f"  {'model':16s} {'size MB':>8s} {'acc':>7s} {'AUC':>7s} {'max|Δ|':>8s} "
+          f"{'load s':>7s} {'RSS MB':>7s} "
+          + " ".join(f"{f'ms@{b}':>8s}" for b in batch_sizes))
+    for label, entry in report.items():
+        first = entry[f'batch{batch_sizes[0]}']
+        print(f"  {label:16s} {entry['size_mb'] or 0:8.2f} {entry['accuracy']:7.4f} "
+              f"{entry['auc']:7.4f} {entry.get('max_abs_diff', 0.0):8.4f} "
+              f"{first['load_s']:7.2f} {first['rss_mb']:7.0f} "
+              + " ".join(f"{entry[f'batch{b}']['latency_ms']:8.2f}" for b in batch_sizes))
+
+    with open(os.path.join(out_dir, f'{name}_export_report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the classifier to TFLite/ONNX")
+    parser.add_argument("model", help="Trained Keras model (.keras)")
+    parser.add_argument("--out-dir", default=EXPORT_DIR)
+    parser.add_argument("--format", nargs='+', choices=["tflite", "onnx"], default=["tflite"])
+    parser.add_argument("--no-int8", action="store_true", help="Skip int8 quantization")
+    parser.add_argument("--array-dir", default=ARRAY_DIR)
+    parser.add_argument("--label-dir", default=LABEL_DIR)
+    parser.add_argument("--calib-set", default="val", help="Split used for int8 calibration")
+    parser.add_argument("--eval-set", default="test", help="Split used for the parity check")
+    parser.add_argument("--calib-samples", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    export_and_compare(args.model, args.out_dir, args.format, not args.no_int8, args.array_dir,
+                       args.label_dir, args.calib_set, args.eval_set, args.calib_samples,
+                       threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+import io
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import TARGET_SIZE, CROP_FACTOR, CROP_MODES, crop_box
+from checkpoint_store import DEFAULT_BANDS, make_key, open_checkpoint
+from download_plan import build_download_plan
+from retry_queue import DEFAULT_MAX_ATTEMPTS, write_failed_ledger
+from packed_dataset import META_FILE, INDEX_FILE, ChunkedDatasetWriter
+
+# Cutouts FITS multibanda (/viewer/fits-cutout) en un cubo por bandas.
+#
+# Los JPEG de jpeg-cutout son RGB de 8 bits con un stretch fijo, que
+# pierde el rango dinámico de las galaxias de bajo brillo superficial. Los
+# FITS traen el flujo float32 de cada banda. Se guardan en un cubo
+# troceado en disco:
+#
+#   cube/
+#     meta.json            filas confirmadas, bandas, forma del stamp
+#     index.csv            fila -> row_index, ra, dec, label, file_name
+#     g/X_00000.npy ...    bloques de chunk_size stamps (H, W) float32
+#     r/X_00000.npy ...
+#
+# Cada banda va en sus propios bloques memory-mapped, así que leer solo
+# la banda r, o la ventana central de unos pocos stamps, toca únicamente
+# esas páginas del disco y no el cubo entero.
+
+FITS_URL = "https://www.legacysurvey.org/viewer/fits-cutout"
+
+CUBE_CHUNK = 256
+
+
+def _require_astropy():
+    try:
+        from astropy.io import fits
+    except ImportError:
+        raise ImportError("astropy is required for FITS cutouts. Install with: pip install astropy")
+    return fits
+
+
+def _chunk_path(path, band, chunk_id):
+    return os.path.join(path, band, f'X_{chunk_id:05d}.npy')
+
+
+def read_fits_cutout(source):
+    """Ruta o bytes de fits-cutout -> (array float32 (bandas, H, W), bandas)"""
+    fits = _require_astropy()
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with fits.open(source, memmap=False) as hdul:
+        data = np.asarray(hdul[0].data, dtype=np.float32)
+        header = hdul[0].header
+    if data.ndim == 2:
+        data = data[None]
+    bands = [header.get(f'BAND{i}') for i in range(len(data))]
+    if None in bands:
+        bands = list(header.get('BANDS', DEFAULT_BANDS))[:len(data)]
+    return data, bands
+
+
+class FitsCubeWriter(ChunkedDatasetWriter):
+    def __init__(self, path, bands=tuple(DEFAULT_BANDS), stamp_shape=(256, 256),
+                 chunk_size=CUBE_CHUNK, attrs=None):
+        """
+        bands: orden de las bandas en cada stamp añadido
+        stamp_shape: (H, W) de cada banda
+        chunk_size: stamps por bloque .npy
+        """
+        self._requested = (list(bands), tuple(stamp_shape))
+        self._chunks = None
+        super().__init__(path, {
+            'count': 0,
+            'chunk_size': chunk_size,
+            'bands': list(bands),
+            'stamp_shape': list(stamp_shape),
+            'dtype': np.dtype(np.float32).str,
+            'attrs': attrs or {},
+        })
+        self.bands = self.meta['bands']
+
+    def _check_meta(self, meta):
+        bands, stamp_shape = self._requested
+        if list(meta['bands']) != bands or tuple(meta['stamp_shape']) != stamp_shape:
+            raise ValueError(f"{self.path} has bands {meta['bands']} and stamps "
+                             f"{meta['stamp_shape']}, requested {bands} {list(stamp_shape)}")
+
+    def _open_chunk(self, chunk_id):
+        self._flush_chunks()
+        shape = (self.chunk_size,) + tuple(self.meta['stamp_shape'])
+        self._chunks = []
+        for band in self.bands:
+            chunk_path = _chunk_path(self.path, band, chunk_id)
+            if os.path.exists(chunk_path):
+                self._chunks.append(np.load(chunk_path, mmap_mode='r+'))
+            else:
+                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                self._chunks.append(np.lib.format.open_memmap(chunk_path, mode='w+',
+                                                              dtype=np.float32, shape=shape))
+
+    def _store(self, offset, stamp):
+        for chunk, band_data in zip(self._chunks, stamp):
+            chunk[offset] = band_data
+
+    def _flush_chunks(self):
+        for chunk in self._chunks or []:
+            chunk.flush()
+
+    def _close_chunks(self):
+        self._chunks = None
+
+    def append(self, stamp, label=-1, row_index=-1, ra=np.nan, dec=np.nan, file_name=''):
+        """Añade un stamp (bandas, H, W) en el orden de self.bands; devuelve su fila"""
+        stamp = np.asarray(stamp, dtype=np.float32)
+        if stamp.shape != (len(self.bands),) + tuple(self.meta['stamp_shape']):
+            raise ValueError(f"Stamp shape {stamp.shape} does not match cube "
+                             f"{(len(self.bands),) + tuple(self.meta['stamp_shape'])}")
+        return self._append(stamp, label, row_index, ra, dec, file_name)
+
+
+class FitsCube:
+    """Lectura perezosa de un cubo FITS: solo se mapean las bandas y bloques pedidos"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        self.chunk_size = self.meta['chunk_size']
+        self.bands = list(self.meta['bands'])
+        self.stamp_shape = tuple(self.meta['stamp_shape'])
+        self.attrs = self.meta.get('attrs', {})
+        self._chunks = {}
+        self._index = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def index(self):
+        if self._index is None:
+            index = pd.read_csv(os.path.join(self.path, INDEX_FILE))
+            self._index = index.iloc[:self.count].reset_index(drop=True)
+        return self._index
+
+    @property
+    def labels(self):
+        return self.index['label'].to_numpy()
+
+    def _chunk(self, band, chunk_id):
+        key = (band, chunk_id)
+        if key not in self._chunks:
+            self._chunks[key] = np.load(_chunk_path(self.path, band, chunk_id), mmap_mode='r')
+        return self._chunks[key]
+
+    def band_names(self, bands):
+        if bands is None:
+            return self.bands
+        bands = list(bands)
+        unknown = set(bands) - set(self.bands)
+        if unknown:
+            raise KeyError(f"Bands {sorted(unknown)} not in cube (has {self.bands})")
+        return bands
+
+    def read(self, start, stop, bands=None, window=None):
+        """Stamps [start, stop) como (N, bandas, h, w) float32
+
+        bands: subconjunto de bandas (por defecto todas)
+        window: (left, upper, right, lower) en píxeles; solo se leen esas filas/columnas
+        """
+        bands = self.band_names(bands)
+        stop = min(stop, self.count)
+        left, upper, right, lower = window or (0, 0, self.stamp_shape[1], self.stamp_shape[0])
+        out = np.empty((max(stop - start, 0), len(bands), lower - upper, right - left),
+                       dtype=np.float32)
+        for chunk_id in range(start // self.chunk_size, -(-stop // self.chunk_size)):
+            first = max(start, chunk_id * self.chunk_size)
+            last = min(stop, (chunk_id + 1) * self.chunk_size)
+            rows = slice(first - chunk_id * self.chunk_size, last - chunk_id * self.chunk_size)
+            for b, band in enumerate(bands):
+                out[first - start:last - start, b] = \
+                    self._chunk(band, chunk_id)[rows, upper:lower, left:right]
+        return out
+
+    def band(self, band, start=0, stop=None):
+        """Una sola banda (N, H, W)"""
+        return self.read(start, self.count if stop is None else stop, [band])[:, 0]
+
+    def view(self, bands=None, window=None):
+        """Vista (N, h, w, bandas) para ArraySource (input_pipeline.py)"""
+        return _FitsView(self, self.band_names(bands), window)
+
+
+class _FitsView:
+    """Vista canales-al-final de un FitsCube con bandas/ventana fijas"""
+
+    def __init__(self, cube, bands, window):
+        self._cube = cube
+        self._bands = bands
+        self._window = window
+        h, w = cube.stamp_shape
+        if window is not None:
+            h, w = window[3] - window[1], window[2] - window[0]
+        self.shape = (len(cube), h, w, len(bands))
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_block(self, start, stop):
+        return self._cube.read(start, stop, self._bands, self._window).transpose(0, 2, 3, 1)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self.read_block(start, stop)
+        rows = np.arange(len(self))[key]
+        if np.ndim(rows) == 0:
+            return self.read_block(int(rows), int(rows) + 1)[0]
+        return np.stack([self.read_block(int(r), int(r) + 1)[0] for r in rows])
+
+
+def download_fits(data, out_path, radii_default=256, base_url=FITS_URL, concurrency=4,
+                  priority=0.5, bands=DEFAULT_BANDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Descarga los FITS del catálogo en out_path; devuelve el plan
+
+    Mismo camino que las descargas JPEG: checkpoint en out_path, cola de
+    reintentos con backoff y registro failed_objects.csv al terminar.
+    """
+    from rate_controller import AdaptiveRateController
+    from download_lagacy_imagescoloured_final_v2 import run_downloads
+
+    os.makedirs(out_path, exist_ok=True)
+    store = open_checkpoint(out_path)
+    try:
+        plan = build_download_plan(data, out_path, radii_default, store, base_url=base_url,
+                                   bands=bands, extension='fits')
+        pending = plan[plan['needs_download']]
+        logging.info(f"FITS cutouts to download: {len(pending)} "
+                     f"({int(plan['exists'].sum())} on disk)")
+
+        items = [(url, file_path, make_key(ra, dec, size, bands=bands))
+                 for url, file_path, ra, dec, size in zip(pending['url'], pending['file_path'],
+                                                          pending['ra'], pending['dec'],
+                                                          pending['size'])]
+        controller = AdaptiveRateController(max_limit=concurrency, priority=priority)
+        downloaded, _ = run_downloads(items, controller, store, max_attempts)
+        store.flush()
+        write_failed_ledger(store)
+    finally:
+        store.close()
+    logging.info(f"Downloaded {downloaded}/{len(pending)} FITS cutouts")
+    plan['exists'] = [os.path.exists(p) for p in plan['file_path']]
+    return plan
+
+
+def pack_fits(plan, cube_path, labels=None, chunk_size=CUBE_CHUNK, flush_every=CUBE_CHUNK):
+    """Añade al cubo los FITS del plan que están en disco y aún no están en él"""
+    plan = plan[plan['exists']]
+    if labels is None:
+        labels = pd.Series(-1, index=plan['row_index'])
+    writer = None
+    # Ficheros ya en el cubo; se lee al abrir el escritor con el primer stamp
+    done = set()
+    packed = 0
+    try:
+        for row_index, ra, dec, file_name, file_path in zip(
+                plan['row_index'], plan['ra'], plan['dec'], plan['file_name'],
+                plan['file_path']):
+            if file_name in done:
+                continue
+            try:
+                stamp, bands = read_fits_cutout(file_path)
+            except Exception as e:
+                logging.warning(f"Cannot read {file_path}: {e}")
+                continue
+            if writer is None:
+                writer = FitsCubeWriter(cube_path, bands, stamp.shape[1:], chunk_size)
+                done = set(FitsCube(cube_path).index['file_name']) if writer.count else set()
+                if file_name in done:
+                    continue
+            writer.append(stamp, labels.get(row_index, -1), row_index, ra, dec, file_name)
+            packed += 1
+            if packed % flush_every == 0:
+                writer.flush()
+    finally:
+        if writer is not None:
+            writer.close()
+    logging.info(f"Packed {packed} FITS cutouts into {cube_path}")
+    return packed
+
+
+def _resize_band(band, size):
+    from PIL import Image
+    return np.asarray(Image.fromarray(band).resize(size, Image.LANCZOS),
+                      dtype=np.float32)
+
+
+def build_fits_array(cube_path, output_path, bands=None, crop_mode='fraction',
+                     target_size=TARGET_SIZE, crop_factor=CROP_FACTOR, block=CUBE_CHUNK):
+    """X (N, H, W, bandas) float32 desde el cubo, leyendo solo bandas y ventana pedidas"""
+    cube = FitsCube(cube_path)
+    bands = cube.band_names(bands)
+    height, width = cube.stamp_shape
+    window = crop_box(width, height, crop_mode, crop_factor)
+    shape = (len(cube),) + tuple(target_size) + (len(bands),)
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=shape)
+    for start in range(0, len(cube), block):
+        stamps = cube.read(start, start + block, bands, window)
+        for i, stamp in enumerate(stamps):
+            for b, band in enumerate(stamp):
+                output[start + i, :, :, b] = _resize_band(band, tuple(target_size))
+    output.flush()
+    del output
+    return bands
+
+
+def synthetic_demo(n=64, size=256, concurrency=8):
+    """Descarga de un servidor local, empaquetado y lecturas parciales con FITS sintéticos"""
+    from mock_legacy_server import start_mock_server
+
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'ra': rng.uniform(0, 360, n), 'dec': rng.uniform(-60, 30, n),
+                         'label': rng.integers(0, 2, n)})
+    server, base_url = start_mock_server()
+    tmp = tempfile.mkdtemp(prefix='fits_cutouts_')
+    try:
+        fits_dir = os.path.join(tmp, 'fits')
+        plan = download_fits(data, fits_dir, size,
+                             base_url=base_url.replace('jpeg-cutout', 'fits-cutout'),
+                             concurrency=concurrency)
+        cube_path = os.path.join(tmp, 'cube')
+        pack_fits(plan, cube_path, data['label'])
+        # Reanudar no duplica filas
+        assert pack_fits(plan, cube_path, data['label']) == 0
+
+        cube = FitsCube(cube_path)
+        reference, _ = read_fits_cutout(plan['file_path'].iloc[-1])
+        assert np.array_equal(cube.read(n - 1, n)[0], reference)
+        assert np.array_equal(cube.band('r')[-1], reference[1])
+        assert np.array_equal(cube.labels, data['label'].to_numpy())
+
+        def timed(label, func):
+            start = time.perf_counter()
+            result = func()
+            print(f"  {label:34s} {result.nbytes / 1024 ** 2:8.2f} MB  "
+                  f"{1000 * (time.perf_counter() - start):7.1f} ms")
+
+        cube_mb = n * len(cube.bands) * size * size * 4 / 1024 ** 2
+        print(f"\nFITS cube: {n} stamps x {cube.bands} x {size}px ({cube_mb:.1f} MB on disk)")
+        timed("all bands, all stamps", lambda: cube.read(0, n))
+        timed("band r only", lambda: cube.band('r'))
+        timed("bands g+z, 8 stamps", lambda: cube.read(0, 8, ['g', 'z']))
+        timed("r, 30\" window (deepshadows)",
+              lambda: cube.read(0, n, ['r'], crop_box(size, size, 'deepshadows')))
+
+        array_path = os.path.join(tmp, 'X_fits.npy')
+        build_fits_array(cube_path, array_path, bands=['g', 'r'])
+        X = np.load(array_path, mmap_mode='r')
+        print(f"  build_fits_array(g, r): {X.shape} {X.dtype}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-band FITS cutouts in a memory-mapped cube")
+    parser.add_argument("table", nargs='?', help="Catalog with ra/dec (and label)")
+    parser.add_argument("--fits-dir", default="./legacy_fits", help="Downloaded FITS directory")
+    parser.add_argument("--cube", default=None, help="Pack the FITS into this cube directory")
+    parser.add_argument("--array", default=None, help="Build X (N, H, W, bands) from the cube")
+    parser.add_argument("--bands", default=None, help="Bands to read for --array (e.g. gr)")
+    parser.add_argument("--crop-mode", choices=CROP_MODES, default="fraction")
+    parser.add_argument("--radii_default", type=int, default=256)
+    parser.add_argument("--label-column", default="label")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="Attempts per cutout before it goes to failed_objects.csv")
+    parser.add_argument("--base-url", default=FITS_URL)
+    parser.add_argument("--no-download", action="store_true", help="Only pack FITS already on disk")
+    parser.add_argument("--synthetic", type=int, default=None, metavar="N",
+                        help="Demo against the local mock server with N synthetic FITS")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    if args.synthetic:
+        synthetic_demo(args.synthetic)
+        return
+
+    if args.table:
+        from download_lagacy_imagescoloured_final_v2 import read_table
+        data = read_table(args.table)
+        if data is None:
+            return
+        if args.no_download:
+            plan = build_download_plan(data, args.fits_dir, args.radii_default, extension='fits')
+        else:
+            plan = download_fits(data, args.fits_dir, args.radii_default, args.base_url,
+                                 args.concurrency, max_attempts=args.max_attempts)
+        if args.cube:
+            labels = None
+            if args.label_column in data.columns:
+                labels = data[args.label_column]
+            pack_fits(plan, args.cube, labels)
+
+    if args.array:
+        if not args.cube:
+            parser.error("--array requires --cube")
+        bands = build_fits_array(args.cube, args.array, args.bands and list(args.bands),
+                                 args.crop_mode)
+        print(f"Guardado {args.array} (bandas {''.join(bands)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,26 @@
 import numpy as np
 import os
-import pandas as pd
 import re
+import time
+import argparse
+import pandas as pd
 import matplotlib.pyplot as plt
-from PIL import Image
-from tqdm import tqdm
 import warnings
 
+from compact_dataset import compact_path
+from crossmatch import CatalogIndex
+from manifest import read_manifest
+
 # Ignorar warnings de imágenes
 warnings.filterwarnings('ignore', category=UserWarning)
 
+# Verificación de X/y contra los catálogos en una sola pasada vectorizada:
+# los nombres de fichero se parsean de una vez, la búsqueda en catálogos usa
+# los KD-trees de crossmatch.CatalogIndex para acotar candidatos (con la
+# misma caja |dra| < tol, |ddec| < tol del script original, así que los
+# conteos no cambian) y X solo se abre con memmap para comprobar la forma y
+# las muestras aleatorias.
+
 # Configuración de rutas
 BASE_DIR = '../Datasets_DeepShadows/'
 ARRAY_DIR = os.path.join(BASE_DIR, 'array_images/')
@@ -24,213 +35,208 @@ JPEG_DIRS = {
 LSB_PATH = os.path.join(BASE_DIR, 'Datasets/random_LSBGs_all.csv')
 ARTIFACT_PATH = os.path.join(BASE_DIR, 'Datasets/random_negative_all_2.csv')
 
-# Cargar catálogos
-print("Cargando catálogos de referencia...")
-lsb_df = pd.read_csv(LSB_PATH)
-art_df = pd.read_csv(ARTIFACT_PATH)
-print(f"Catálogo LSB: {len(lsb_df)} objetos")
-print(f"Catálogo Artefactos: {len(art_df)} objetos")
-
-# Función para parsear nombres de archivo
-def parse_filename(filename):
-    match = re.match(r'^([\d\.\-]+)_([\d\.\-]+)_\d+_256pix\.jpe?g', filename, re.IGNORECASE)
-    if match:
-        try:
-            ra = float(match.group(1))
-            dec = float(match.group(2))
-            return (ra, dec)
-        except ValueError:
-            return (None, None)
-    return (None, None)
-
-# Función para buscar en catálogos
-def find_in_catalogs(ra, dec, tol=0.001):
-    """Busca coordenadas en los catálogos con tolerancia"""
-    results = {
-        'in_lsb': False,
-        'in_artifacts': False,
-        'expected_label': 0
-    }
-    
-    if ra is None or dec is None:
-        return results
-    
-    # Buscar en LSB
-    lsb_match = lsb_df[
-        (np.abs(lsb_df['ra'] - ra) < tol) & 
-        (np.abs(lsb_df['dec'] - dec) < tol)
-    ]
-    if not lsb_match.empty:
-        results['in_lsb'] = True
-        results['expected_label'] = 1
-    
-    # Buscar en artefactos
-    art_match = art_df[
-        (np.abs(art_df['ra'] - ra) < tol) & 
-        (np.abs(art_df['dec'] - dec) < tol)
-    ]
-    if not art_match.empty:
-        results['in_artifacts'] = True
-        # Solo sobrescribir si no está en LSB (prioridad galaxias)
-        if not results['in_lsb']:
-            results['expected_label'] = 0
-    
-    return results
-
-def verify_dataset(set_name, num_samples=10):
+FILENAME_PATTERN = r'^([\d\.\-]+)_([\d\.\-]+)_\d+_256pix\.jpe?g'
+
+# Función para parsear nombres de archivo (todos a la vez; NaN si no encaja)
+def parse_filenames(files):
+    names = pd.Series(list(files), dtype=object)
+    parts = names.str.extract(FILENAME_PATTERN, flags=re.IGNORECASE)
+    ra = pd.to_numeric(parts[0], errors='coerce').to_numpy(dtype=np.float64)
+    dec = pd.to_numeric(parts[1], errors='coerce').to_numpy(dtype=np.float64)
+    return ra, dec
+
+# Búsqueda en catálogos de todas las posiciones (misma lógica que find_in_catalogs)
+def find_in_catalogs(ra, dec, lsb_catalog, art_catalog, tol=0.001):
+    """tol en grados (semiancho de la caja); catálogos como crossmatch.CatalogIndex"""
+    in_lsb = lsb_catalog.in_box(ra, dec, tol)
+    in_artifacts = art_catalog.in_box(ra, dec, tol)
+    # Prioridad galaxias: 1 si está en LSB, 0 en otro caso
+    return in_lsb, in_artifacts, in_lsb.astype(np.int64)
+
+def load_image_array(set_name):
+    """X con memmap (float o formato compacto uint8); no se lee entero"""
+    path = os.path.join(ARRAY_DIR, f'X_{set_name}.npy')
+    if not os.path.exists(path) and os.path.exists(compact_path(ARRAY_DIR, set_name)):
+        path = compact_path(ARRAY_DIR, set_name)
+    return np.load(path, mmap_mode='r')
+
+def list_files(set_name, use_manifest=False):
+    """Ficheros en el orden de X/y y sus coordenadas"""
+    jpeg_dir = JPEG_DIRS[set_name]
+    if use_manifest:
+        manifest = read_manifest(jpeg_dir)
+        return (manifest['file_name'].tolist(), manifest['ra'].to_numpy(),
+                manifest['dec'].to_numpy())
+    files = sorted([f for f in os.listdir(jpeg_dir)
+                    if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
+    ra, dec = parse_filenames(files)
+    return files, ra, dec
+
+def spot_check(X, y, files, ra, dec, in_lsb, in_artifacts, expected_label,
+               num_samples=10, plot=True):
+    """Muestras aleatorias: valores de X e información de catálogos"""
+    np.random.seed(42)
+    sample_indices = np.random.choice(len(X), min(num_samples, len(X)), replace=False)
+
+    print(f"\nVerificando {len(sample_indices)} muestras aleatorias:")
+    for i, idx in enumerate(sample_indices):
+        image = np.asarray(X[idx])
+        status_label = "✓" if y[idx] == expected_label[idx] else "✗"
+        status_lsb = "✓" if in_lsb[idx] else "✗"
+        status_art = "✓" if in_artifacts[idx] else "✗"
+
+        print(f"\nMuestra {i+1}: Índice {idx} - {files[idx]}")
+        print(f"  Coordenadas: RA={ra[idx]:.6f}, DEC={dec[idx]:.6f}")
+        print(f"  En catálogo LSB: {status_lsb} | En catálogo Artefactos: {status_art}")
+        print(f"  Etiqueta esperada: {expected_label[idx]} | Etiqueta real: {y[idx]} {status_label}")
+        print(f"  Imagen: shape={image.shape}, rango=[{image.min()}, {image.max()}]")
+
+        if not plot:
+            continue
+
+        # Visualización
+        fig, axs = plt.subplots(1, 2, figsize=(10, 5))
+
+        # Imagen del array
+        axs[0].imshow(image)
+        axs[0].set_title(f"Array X[{idx}]\nLabel: {y[idx]}")
+        axs[0].axis('off')
+
+        # Información de catálogos
+        catalog_text = (
+            f"En LSB: {in_lsb[idx]}\n"
+            f"En Artefactos: {in_artifacts[idx]}\n"
+            f"Label esperado: {expected_label[idx]}"
+        )
+
+        axs[1].text(0.5, 0.5, catalog_text,
+                   ha='center', va='center', fontsize=12)
+        axs[1].axis('off')
+        axs[1].set_title("Información de Catálogos")
+
+        plt.tight_layout()
+        plt.show()
+
+def verify_dataset(set_name, lsb_catalog, art_catalog, num_samples=10, plot=True,
+                   use_manifest=False, tol=0.001):
     print(f"\n{'='*50}")
     print(f"Verificando conjunto: {set_name}")
     print(f"{'='*50}")
-    
-    # 1. Cargar arrays
+
+    # 1. Abrir arrays (X solo con memmap: forma y muestras)
     try:
-        X = np.load(os.path.join(ARRAY_DIR, f'X_{set_name}.npy'))
+        X = load_image_array(set_name)
         y = np.load(os.path.join(LABEL_DIR, f'y_{set_name}.npy'))
         print(f"Arrays cargados: X.shape={X.shape}, y.shape={y.shape}")
     except Exception as e:
         print(f"Error cargando arrays: {str(e)}")
-        return
-    
+        return None
+
     # 2. Obtener lista de archivos JPEG
-    jpeg_dir = JPEG_DIRS[set_name]
     try:
-        jpeg_files = sorted([f for f in os.listdir(jpeg_dir) 
-                           if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
+        jpeg_files, ra, dec = list_files(set_name, use_manifest)
         print(f"Archivos JPEG encontrados: {len(jpeg_files)}")
     except Exception as e:
         print(f"Error leyendo directorio JPEG: {str(e)}")
-        return
-    
+        return None
+
     # 3. Verificar correspondencia de tamaños
     if len(X) != len(y) or len(X) != len(jpeg_files):
         print(f"¡ERROR! Tamaños no coinciden:")
         print(f"  Array imágenes: {len(X)}")
         print(f"  Array etiquetas: {len(y)}")
         print(f"  Archivos JPEG: {len(jpeg_files)}")
-        return
-    
+        return None
+
     print("✓ Tamaños coinciden")
-    
-    # 4. Verificación detallada de muestras aleatorias
-    np.random.seed(42)
-    sample_indices = np.random.choice(len(X), num_samples, replace=False)
-    
-    print(f"\nVerificando {num_samples} muestras aleatorias:")
-    for i, idx in enumerate(sample_indices):
-        filename = jpeg_files[idx]
-        ra, dec = parse_filename(filename)
-        catalog_info = find_in_catalogs(ra, dec)
-        
-        # Resultados
-        status_label = "✓" if y[idx] == catalog_info['expected_label'] else "✗"
-        status_lsb = "✓" if catalog_info['in_lsb'] else "✗"
-        status_art = "✓" if catalog_info['in_artifacts'] else "✗"
-        
-        print(f"\nMuestra {i+1}: Índice {idx} - {filename}")
-        print(f"  Coordenadas: RA={ra:.6f}, DEC={dec:.6f}")
-        print(f"  En catálogo LSB: {status_lsb} | En catálogo Artefactos: {status_art}")
-        print(f"  Etiqueta esperada: {catalog_info['expected_label']} | Etiqueta real: {y[idx]} {status_label}")
-        
-        # Visualización
-        fig, axs = plt.subplots(1, 2, figsize=(10, 5))
-        
-        # Imagen del array
-        axs[0].imshow(X[idx])
-        axs[0].set_title(f"Array X[{idx}]\nLabel: {y[idx]}")
-        axs[0].axis('off')
-        
-        # Información de catálogos
-        catalog_text = (
-            f"En LSB: {catalog_info['in_lsb']}\n"
-            f"En Artefactos: {catalog_info['in_artifacts']}\n"
-            f"Label esperado: {catalog_info['expected_label']}"
-        )
-        
-        axs[1].text(0.5, 0.5, catalog_text, 
-                   ha='center', va='center', fontsize=12)
-        axs[1].axis('off')
-        axs[1].set_title("Información de Catálogos")
-        
-        plt.tight_layout()
-        plt.show()
-    
-    # 5. Verificación completa de etiquetas
-    print("\nVerificando todas las etiquetas...")
-    correct_labels = 0
-    in_lsb_count = 0
-    in_art_count = 0
-    in_both_count = 0
-    in_neither_count = 0
-    
-    for idx in tqdm(range(len(X)), desc="Progreso"):
-        filename = jpeg_files[idx]
-        ra, dec = parse_filename(filename)
-        catalog_info = find_in_catalogs(ra, dec)
-        
-        # Contar ocurrencias en catálogos
-        if catalog_info['in_lsb'] and catalog_info['in_artifacts']:
-            in_both_count += 1
-        elif catalog_info['in_lsb']:
-            in_lsb_count += 1
-        elif catalog_info['in_artifacts']:
-            in_art_count += 1
-        else:
-            in_neither_count += 1
-        
-        # Verificar etiqueta
-        if y[idx] == catalog_info['expected_label']:
-            correct_labels += 1
-    
+
+    # 4. Búsqueda en catálogos de todas las imágenes (una sola pasada)
+    in_lsb, in_artifacts, expected_label = find_in_catalogs(ra, dec, lsb_catalog,
+                                                            art_catalog, tol)
+    correct = y == expected_label
+
+    # 5. Verificación detallada de muestras aleatorias
+    spot_check(X, y, jpeg_files, ra, dec, in_lsb, in_artifacts, expected_label,
+               num_samples, plot)
+
     # 6. Reporte final
+    n = len(X)
+    correct_labels = int(correct.sum())
+    in_both_count = int((in_lsb & in_artifacts).sum())
+    in_lsb_count = int((in_lsb & ~in_artifacts).sum())
+    in_art_count = int((in_artifacts & ~in_lsb).sum())
+    in_neither_count = n - in_both_count - in_lsb_count - in_art_count
+
     print("\n" + "="*50)
     print("Reporte de Verificación Final")
     print("="*50)
-    print(f"Total muestras: {len(X)}")
-    print(f"Etiquetas correctas: {correct_labels} ({correct_labels/len(X):.2%})")
+    print(f"Total muestras: {n}")
+    print(f"Etiquetas correctas: {correct_labels} ({correct_labels/n:.2%})")
     print("\nDistribución en catálogos:")
-    print(f"- Solo en LSB: {in_lsb_count} ({in_lsb_count/len(X):.2%})")
-    print(f"- Solo en Artefactos: {in_art_count} ({in_art_count/len(X):.2%})")
-    print(f"- En ambos catálogos: {in_both_count} ({in_both_count/len(X):.2%})")
-    print(f"- En ningún catálogo: {in_neither_count} ({in_neither_count/len(X):.2%})")
-    
+    print(f"- Solo en LSB: {in_lsb_count} ({in_lsb_count/n:.2%})")
+    print(f"- Solo en Artefactos: {in_art_count} ({in_art_count/n:.2%})")
+    print(f"- En ambos catálogos: {in_both_count} ({in_both_count/n:.2%})")
+    print(f"- En ningún catálogo: {in_neither_count} ({in_neither_count/n:.2%})")
+
     # 7. Verificar distribución de etiquetas
     galaxy_count = np.sum(y == 1)
     artifact_count = np.sum(y == 0)
     print("\nDistribución de etiquetas en el array:")
-    print(f"- Galaxias (1): {galaxy_count} ({galaxy_count/len(X):.2%})")
-    print(f"- Artefactos (0): {artifact_count} ({artifact_count/len(X):.2%})")
-    
+    print(f"- Galaxias (1): {galaxy_count} ({galaxy_count/n:.2%})")
+    print(f"- Artefactos (0): {artifact_count} ({artifact_count/n:.2%})")
+
     # 8. Guardar resultados detallados
-    results = []
-    for idx in range(len(X)):
-        filename = jpeg_files[idx]
-        ra, dec = parse_filename(filename)
-        catalog_info = find_in_catalogs(ra, dec)
-        correct = y[idx] == catalog_info['expected_label']
-        
-        results.append({
-            'filename': filename,
-            'ra': ra,
-            'dec': dec,
-            'label': y[idx],
-            'expected_label': catalog_info['expected_label'],
-            'in_lsb': catalog_info['in_lsb'],
-            'in_artifacts': catalog_info['in_artifacts'],
-            'correct': correct
-        })
-    
-    results_df = pd.DataFrame(results)
+    results_df = pd.DataFrame({
+        'filename': jpeg_files,
+        'ra': ra,
+        'dec': dec,
+        'label': y,
+        'expected_label': expected_label,
+        'in_lsb': in_lsb,
+        'in_artifacts': in_artifacts,
+        'correct': correct
+    })
     results_path = os.path.join(LABEL_DIR, f'verification_results_{set_name}.csv')
     results_df.to_csv(results_path, index=False)
     print(f"\nResultados detallados guardados en: {results_path}")
+    return correct_labels, n
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify X/y arrays against the reference catalogs")
+    parser.add_argument("--sets", nargs='+', choices=list(JPEG_DIRS), default=list(JPEG_DIRS))
+    parser.add_argument("--samples", type=int, default=10, help="Random samples to inspect")
+    parser.add_argument("--no-plots", action="store_true", help="Print samples without plotting")
+    parser.add_argument("--manifest", action="store_true",
+                        help="Take file order and coordinates from the download manifest")
+    parser.add_argument("--tol", type=float, default=0.001, help="Box half-width in degrees (|dRA| and |dDec| < tol)")
+    args = parser.parse_args()
+
+    # Cargar catálogos
+    print("Cargando catálogos de referencia...")
+    lsb_df = pd.read_csv(LSB_PATH)
+    art_df = pd.read_csv(ARTIFACT_PATH)
+    print(f"Catálogo LSB: {len(lsb_df)} objetos")
+    print(f"Catálogo Artefactos: {len(art_df)} objetos")
+    lsb_catalog = CatalogIndex.from_dataframe(lsb_df)
+    art_catalog = CatalogIndex.from_dataframe(art_df)
+
+    # Ejecutar verificación para todos los conjuntos
+    print("\n" + "="*50)
+    print("INICIANDO VERIFICACIÓN COMPLETA DE DATASETS")
+    print("="*50 + "\n")
 
-# Ejecutar verificación para todos los conjuntos
-print("\n" + "="*50)
-print("INICIANDO VERIFICACIÓN COMPLETA DE DATASETS")
-print("="*50 + "\n")
+    runtimes = {}
+    for dataset in args.sets:
+        start = time.perf_counter()
+        verify_dataset(dataset, lsb_catalog, art_catalog, args.samples, not args.no_plots,
+                       args.manifest, args.tol)
+        runtimes[dataset] = time.perf_counter() - start
+        print(f"\nTiempo de verificación ({dataset}): {runtimes[dataset]:.2f}s")
+        print("\n" + "="*100 + "\n")
 
-for dataset in ['train', 'val', 'test']:
-    verify_dataset(dataset)
-    print("\n" + "="*100 + "\n")
+    print("Verificación completada para todos los conjuntos!")
+    for dataset, elapsed in runtimes.items():
+        print(f"  {dataset:6s} {elapsed:8.2f}s")
 
-print("Verificación completada para todos los conjuntos!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import psutil
+
+from compact_dataset import compact_path, CompactArray
+from packed_dataset import PackedDataset
+
+# Pipeline de entrada para el entrenamiento sobre arrays memory-mapped.
+#
+# Los notebooks cargan X_train/X_val/X_test enteros con np.load (y
+# Luis-DeepShadows.ipynb los convierte además a float64). Aquí las imágenes
+# se leen por bloques contiguos del memmap en orden aleatorio de bloques,
+# pasan por un buffer de shuffle acotado y se normalizan a float32 por
+# batch, así que la memoria residente depende de buffer_size/block_size y
+# no del tamaño del dataset:
+#
+#   bloques (orden aleatorio) -> buffer de shuffle -> batch -> float32 -> prefetch
+#
+# Fuentes: X_{set}.npy float, X_{set}_u8.npy compacto (compact_dataset.py),
+# un dataset empaquetado por bloques (packed_dataset.py) o un cubo FITS
+# multibanda (fits_cutouts.py).
+
+ARRAY_DIR = '../Datasets_DeepShadows/array_images/'
+LABEL_DIR = '../Datasets_DeepShadows/Galaxies_data/'
+
+
+class ArraySource:
+    """Imágenes y etiquetas de un split, sin cargarlas en memoria"""
+
+    def __init__(self, images, labels, scale=1.0, block_reader=None):
+        """
+        images: array indexable (memmap) de forma (N, H, W, C)
+        labels: array (N,) de etiquetas
+        scale: factor de normalización (1/255 para uint8)
+        """
+        self.images = images
+        self.labels = labels
+        self.scale = scale
+        self._block_reader = block_reader
+        if len(images) != len(labels):
+            raise ValueError(f"{len(images)} images vs {len(labels)} labels")
+
+    @classmethod
+    def from_split(cls, set_name, array_dir=ARRAY_DIR, label_dir=LABEL_DIR):
+        """Prefiere el formato compacto uint8 si existe; si no, X_{set}.npy"""
+        labels = np.load(os.path.join(label_dir, f'y_{set_name}.npy'), mmap_mode='r')
+        if os.path.exists(compact_path(array_dir, set_name)):
+            compact = CompactArray(array_dir, set_name)
+            return cls(compact.pixels, labels, compact.scale)
+        images = np.load(os.path.join(array_dir, f'X_{set_name}.npy'), mmap_mode='r')
+        return cls(images, labels, 1 / 255.0 if images.dtype == np.uint8 else 1.0)
+
+    @classmethod
+    def from_packed(cls, path):
+        """Dataset empaquetado: etiquetas del índice, bloques leídos por chunk"""
+        dataset = PackedDataset(path)
+        chunks = list(dataset.iter_chunks())
+        chunk_size = dataset.chunk_size
+
+        def read_block(start, stop):
+            first, last = start // chunk_size, (stop - 1) // chunk_size
+            parts = [chunks[i][max(start - i * chunk_size, 0):stop - i * chunk_size]
+                     for i in range(first, last + 1)]
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+        scale = 1 / 255.0 if np.dtype(dataset.meta['dtype']) == np.uint8 else 1.0
+        return cls(_PackedImages(dataset, read_block), dataset.labels, scale, read_block)
+
+    @classmethod
+    def from_fits(cls, path, bands=None, window=None):
+        """Cubo FITS (fits_cutouts.py): solo se leen las bandas y la ventana pedidas"""
+        from fits_cutouts import FitsCube
+        cube = FitsCube(path)
+        view = cube.view(bands, window)
+        return cls(view, cube.labels, 1.0, view.read_block)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def sample_shape(self):
+        return tuple(self.images.shape[1:])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.images.dtype)
+
+    def read_block(self, start, stop):
+        """Imágenes (sin normalizar) y etiquetas de las filas [start, stop)"""
+        if self._block_reader is not None:
+            images = self._block_reader(start, stop)
+        else:
+            images = self.images[start:stop]
+        return np.array(images), np.asarray(self.labels[start:stop], dtype=np.float32)
+
+    def block_ranges(self, block_size):
+        return [(start, min(start + block_size, len(self)))
+                for start in range(0, len(self), block_size)]
+
+
+class _PackedImages:
+    """Vista mínima (len, shape, dtype) de un PackedDataset para ArraySource"""
+
+    def __init__(self, dataset, read_block):
+        self._dataset = dataset
+        self.shape = (len(dataset),) + dataset.image_shape
+        self.dtype = np.dtype(dataset.meta['dtype'])
+        self._read_block = read_block
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._read_block(*index.indices(len(self))[:2])
+        return self._dataset[index]
+
+
+def normalize(images, scale, dtype=np.float32):
+    """uint8/float -> float32 en [0, 1] (un batch cada vez)"""
+    out = images.astype(dtype)
+    if scale != 1.0:
+        out /= 1.0 / scale
+    return out
+
+
+def batch_generator(source, batch_size=32, shuffle=True, buffer_size=8192, block_size=1024,
+                    seed=None, drop_remainder=False):
+    """Generador numpy de batches (x float32, y float32) para una época.
+
+    Los bloques se leen en orden aleatorio y se mezclan en un buffer de
+    como mucho buffer_size + block_size muestras.
+    """
+    rng = np.random.default_rng(seed)
+    ranges = source.block_ranges(block_size)
+    if shuffle:
+        ranges = [ranges[i] for i in rng.permutation(len(ranges))]
+
+    # Sin shuffle el buffer es 0: los bloques salen en orden
+    buffer_size = buffer_size if shuffle else 0
+    pool_x = np.empty((0,) + source.sample_shape, dtype=source.dtype)
+    pool_y = np.empty(0, dtype=np.float32)
+
+    def emit(x, y, final=False):
+        n_full = len(x) // batch_size * batch_size
+        for start in range(0, n_full, batch_size):
+            yield (normalize(x[start:start + batch_size], source.scale),
+                   y[start:start + batch_size])
+        if final and n_full < len(x) and not drop_remainder:
+            yield normalize(x[n_full:], source.scale), y[n_full:]
+
+    for start, stop in ranges:
+        x, y = source.read_block(start, stop)
+        pool_x = np.concatenate([pool_x, x])
+        pool_y = np.concatenate([pool_y, y])
+        order = rng.permutation(len(pool_x)) if shuffle else np.arange(len(pool_x))
+        # Se emiten batches completos y quedan como mucho buffer_size (+ resto)
+        n_out = max(len(pool_x) - buffer_size, 0) // batch_size * batch_size
+        yield from emit(pool_x[order[:n_out]], pool_y[order[:n_out]])
+        pool_x, pool_y = pool_x[order[n_out:]], pool_y[order[n_out:]]
+
+    yield from emit(pool_x, pool_y, final=True)
+
+
+def make_dataset(source, batch_size=32, shuffle=True, buffer_size=8192, block_size=1024,
+                 seed=None, num_parallel_calls=None, prefetch=None, drop_remainder=False):
+    """tf.data.Dataset de batches (x float32, y float32) sobre una ArraySource.
+
+    Lecturas de bloques en paralelo, shuffle con buffer acotado,
+    normalización en paralelo por batch y prefetch.
+    """
+    try:
+        import tensorflow as tf
+    except ImportError:
+        raise ImportError("tensorflow is required for make_dataset. "
+                          "Use batch_generator for a numpy-only pipeline.")
+
+    autotune = tf.data.AUTOTUNE
+    num_parallel_calls = num_parallel_calls or autotune
+    prefetch = prefetch or autotune
+    ranges = np.array(source.block_ranges(block_size), dtype=np.int64)
+    image_dtype = tf.as_dtype(source.dtype)
+    scale = source.scale
+
+    def read(block_id):
+        start, stop = ranges[block_id]
+        return source.read_block(int(start), int(stop))
+
+    def read_block(block_id):
+        x, y = tf.numpy_function(read, [block_id], [image_dtype, tf.float32])
+        x.set_shape((None,) + source.sample_shape)
+        y.set_shape((None,))
+        return x, y
+
+    def to_float(x, y):
+        x = tf.cast(x, tf.float32)
+        if scale != 1.0:
+            x = x * scale
+        return x, y
+
+    ds = tf.data.Dataset.range(len(ranges))
+    if shuffle:
+        ds = ds.shuffle(len(ranges), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(read_block, num_parallel_calls=num_parallel_calls,
+                deterministic=seed is not None or not shuffle)
+    ds = ds.unbatch()
+    if shuffle:
+        ds = ds.shuffle(buffer_size, seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+    # unbatch pierde la cardinalidad; Keras la necesita para cerrar la época
+    n_batches = len(source) // batch_size if drop_remainder else -(-len(source) // batch_size)
+    ds = ds.apply(tf.data.experimental.assert_cardinality(n_batches))
+    ds = ds.map(to_float, num_parallel_calls=num_parallel_calls)
+    return ds.prefetch(prefetch)
+
+
+def memory_estimate(source, batch_size=32, buffer_size=8192, block_size=1024, prefetch=2):
+    """Memoria aproximada del pipeline (MB), independiente de len(source)"""
+    sample_bytes = int(np.prod(source.sample_shape))
+    raw = (buffer_size + 2 * block_size) * sample_bytes * source.dtype.itemsize
+    batches = (prefetch + 1) * batch_size * sample_bytes * 4
+    return (raw + batches) / 1024 ** 2
+
+
+def measure_throughput(batches, max_batches=None):
+    """Recorre batches y devuelve (muestras, segundos, pico de RSS en MB)"""
+    process = psutil.Process()
+    peak = process.memory_info().rss
+    samples = 0
+    start = time.perf_counter()
+    for i, (x, _) in enumerate(batches):
+        samples += len(x)
+        if i % 20 == 0:
+            peak = max(peak, process.memory_info().rss)
+        if max_batches and i + 1 >= max_batches:
+            break
+    elapsed = time.perf_counter() - start
+    return samples, elapsed, max(peak, process.memory_info().rss) / 1024 ** 2
+
+
+def make_synthetic_split(path, n, image_shape=(64, 64, 3), seed=0):
+    """X_train_u8.npy + y_train.npy sintéticos para el benchmark"""
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    X = np.lib.format.open_memmap(compact_path(path, 'train'), mode='w+', dtype=np.uint8,
+                                  shape=(n,) + tuple(image_shape))
+    for start in range(0, n, 4096):
+        stop = min(start + 4096, n)
+        X[start:stop] = rng.integers(0, 256, (stop - start,) + tuple(image_shape),
+                                     dtype=np.uint8)
+    X.flush()
+    np.save(os.path.join(path, 'y_train.npy'), rng.integers(0, 2, n).astype(np.int32))
+
+
+def benchmark(source, batch_size=32, buffer_size=8192, block_size=1024, engines=('numpy', 'tf'),
+              max_batches=None, seed=0):
+    print(f"Input pipeline benchmark: {len(source)} samples {source.sample_shape} "
+          f"{source.dtype}, batch {batch_size}, buffer {buffer_size}, block {block_size}")
+    print(f"  estimated pipeline memory: "
+          f"{memory_estimate(source, batch_size, buffer_size, block_size):.1f} MB "
+          f"(dataset on disk: {len(source) * np.prod(source.sample_shape) * source.dtype.itemsize / 1024 ** 2:.1f} MB)")
+    for engine in engines:
+        if engine == 'numpy':
+            batches = batch_generator(source, batch_size, True, buffer_size, block_size, seed)
+        else:
+            batches = make_dataset(source, batch_size, True, buffer_size, block_size, seed)
+        samples, elapsed, peak = measure_throughput(batches, max_batches)
+        print(f"  {engine:6s} {samples / elapsed:10.0f} samples/s  "
+              f"({samples} in {elapsed:.2f}s, peak RSS {peak:.0f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory-mapped input pipeline benchmark")
+    parser.add_argument("--set", default="train", help="Split to read (X_{set}/y_{set})")
+    parser.add_argument("--array-dir", default=ARRAY_DIR)
+    parser.add_argument("--label-dir", default=LABEL_DIR)
+    parser.add_argument("--packed", default=None, help="Read a packed dataset directory instead")
+    parser.add_argument("--synthetic", type=int, default=None,
+                        help="Benchmark on N synthetic uint8 images in a temp directory")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--buffer", type=int, default=8192, help="Shuffle buffer (samples)")
+    parser.add_argument("--block", type=int, default=1024, help="Contiguous rows per read")
+    parser.add_argument("--max-batches", type=int, default=None)
+    parser.add_argument("--engine", choices=["numpy", "tf", "both"], default="both")
+    args = parser.parse_args()
+
+    engines = ('numpy', 'tf') if args.engine == 'both' else (args.engine,)
+    tmp = None
+    try:
+        if args.synthetic:
+            tmp = tempfile.mkdtemp(prefix='bench_pipeline_')
+            make_synthetic_split(tmp, args.synthetic)
+            source = ArraySource.from_split('train', tmp, tmp)
+        elif args.packed:
+            source = ArraySource.from_packed(args.packed)
+        else:
+            source = ArraySource.from_split(args.set, args.array_dir, args.label_dir)
+        benchmark(source, args.batch_size, args.buffer, args.block, engines, args.max_batches)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import glob
+import logging
+
+import numpy as np
+import pandas as pd
+
+from download_plan import build_download_plan
+
+# Manifest columnar (Parquet) de las descargas.
+#
+# Una fila por objeto del catálogo con su índice de origen, coordenadas
+# exactas (float64, sin pasar por el nombre de fichero), catálogo de
+# procedencia, etiqueta, ruta y tamaño en bytes. Los constructores de
+# arrays de imágenes y etiquetas se alinean sobre él en lugar de parsear
+# nombres de fichero y buscar cada imagen en los catálogos.
+
+MANIFEST_FILE = 'manifest.parquet'
+SHARD_MANIFEST = 'manifest.shard{index}of{total}.parquet'
+
+MANIFEST_COLUMNS = ['row_index', 'ra', 'dec', 'catalog', 'label', 'file_name', 'file_path',
+                    'bytes']
+
+
+def scan_sizes(out_path, suffix='.jpeg'):
+    """Tamaño de cada fichero del directorio (un solo scandir)"""
+    if not os.path.isdir(out_path):
+        return {}
+    with os.scandir(out_path) as entries:
+        return {entry.name: entry.stat().st_size for entry in entries
+                if entry.name.endswith(suffix) and entry.is_file()}
+
+
+def numeric_labels(labels):
+    """Etiquetas como int32; las no numéricas (p.ej. 'LSBG') y las ausentes pasan a -1"""
+    values = pd.to_numeric(labels, errors='coerce')
+    invalid = values.isna() & labels.notna()
+    if invalid.any():
+        logging.warning(f"{int(invalid.sum())} non-numeric values in label column "
+                        f"'{labels.name}' (e.g. {labels[invalid].iloc[0]!r}) set to -1")
+    return values.fillna(-1).astype(np.int32).to_numpy()
+
+
+def build_manifest(data, out_path, radii_default=256, label_column='label',
+                   catalog_column='catalog', catalog_name=None):
+    """Manifest del catálogo data descargado en out_path (bytes=0 si falta el fichero)"""
+    plan = build_download_plan(data, out_path, radii_default)
+    sizes = scan_sizes(out_path)
+
+    if catalog_column in data.columns:
+        catalog = data[catalog_column].astype(str).to_numpy()
+    else:
+        catalog = np.full(len(data), catalog_name or '', dtype=object)
+    if label_column in data.columns:
+        label = numeric_labels(data[label_column])
+    else:
+        label = np.full(len(data), -1, dtype=np.int32)
+
+    return pd.DataFrame({
+        'row_index': plan['row_index'].to_numpy(),
+        'ra': plan['ra'].astype(np.float64).to_numpy(),
+        'dec': plan['dec'].astype(np.float64).to_numpy(),
+        'catalog': catalog,
+        'label': label,
+        'file_name': plan['file_name'].to_numpy(),
+        'file_path': plan['file_path'].to_numpy(),
+        'bytes': plan['file_name'].map(sizes).fillna(0).astype(np.int64).to_numpy(),
+    })
+
+
+def write_manifest(manifest, path):
+    """Guarda el manifest, fusionándolo con uno existente (gana la fila nueva)"""
+    if os.path.exists(path):
+        previous = pd.read_parquet(path)
+        manifest = pd.concat([previous, manifest], ignore_index=True)
+        manifest = manifest.drop_duplicates(subset='file_name', keep='last')
+    manifest = manifest.reset_index(drop=True)[MANIFEST_COLUMNS]
+    manifest.to_parquet(path, index=False)
+    downloaded = int((manifest['bytes'] > 0).sum())
+    logging.info(f"Manifest written to {path} ({downloaded}/{len(manifest)} downloaded)")
+    return manifest
+
+
+def update_manifest(data, out_path, radii_default=256, manifest_path=None, **kwargs):
+    """Construye y guarda el manifest tras una descarga"""
+    if manifest_path is None:
+        manifest_path = os.path.join(out_path, MANIFEST_FILE)
+    return write_manifest(build_manifest(data, out_path, radii_default, **kwargs), manifest_path)
+
+
+def shard_manifest_path(out_path, index, total):
+    return os.path.join(out_path, SHARD_MANIFEST.format(index=index, total=total))
+
+
+def merge_shard_manifests(out_path, remove=False):
+    """Fusiona los manifests de shard en manifest.parquet"""
+    shard_files = sorted(glob.glob(os.path.join(out_path, 'manifest.shard*of*.parquet')))
+    if not shard_files:
+        return None
+    merged = pd.concat([pd.read_parquet(f) for f in shard_files], ignore_index=True)
+    manifest = write_manifest(merged, os.path.join(out_path, MANIFEST_FILE))
+    if remove:
+        for f in shard_files:
+            os.remove(f)
+    return manifest
+
+
+def read_manifest(path, downloaded_only=True):
+    """Manifest en el orden canónico de los arrays (row_index de origen)"""
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_FILE)
+    manifest = pd.read_parquet(path)
+    if downloaded_only:
+        manifest = manifest[manifest['bytes'] > 0]
+    return manifest.sort_values(['row_index', 'file_name']).reset_index(drop=True)
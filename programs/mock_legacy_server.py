@@ -0,0 +1,245 @@
+import io
+import time
+import random
+import threading
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from PIL import Image
+
+# Servidor HTTP local que imita /viewer/jpeg-cutout y /viewer/fits-cutout
+# de legacysurvey.org para benchmarks sin tocar el servicio real.
+
+_jpeg_cache = {}
+_cache_lock = threading.Lock()
+
+
+def synthetic_jpeg(size, seed=0):
+    """JPEG sintético (ruido + fuente gaussiana) de size x size píxeles"""
+    key = (size, seed)
+    with _cache_lock:
+        if key in _jpeg_cache:
+            return _jpeg_cache[key]
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    r2 = (xx - size / 2) ** 2 + (yy - size / 2) ** 2
+    blob = 120 * np.exp(-r2 / (2 * (size / 10) ** 2))
+    pixels = rng.normal(30, 8, (size, size, 3)) + blob[..., None]
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    content = buffer.getvalue()
+    with _cache_lock:
+        _jpeg_cache[key] = content
+    return content
+
+
+def synthetic_fits(size, bands='grz', ra=0.0, dec=0.0, pixscale=0.262, seed=0):
+    """FITS sintético como el de fits-cutout: cubo float32 (banda, y, x) + WCS"""
+    from astropy.io import fits
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    r2 = (xx - size / 2) ** 2 + (yy - size / 2) ** 2
+    # Fuente difusa de bajo brillo superficial (nanomaggies) sobre ruido de cielo
+    blob = 0.05 * np.exp(-r2 / (2 * (size / 8) ** 2))
+    data = np.stack([blob * (1 + 0.3 * i) + rng.normal(0, 0.01, (size, size))
+                     for i in range(len(bands))]).astype(np.float32)
+
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+    header['CRVAL1'], header['CRVAL2'] = float(ra), float(dec)
+    header['CRPIX1'] = header['CRPIX2'] = (size + 1) / 2
+    header['CD1_1'], header['CD2_2'] = -pixscale / 3600, pixscale / 3600
+    header['CD1_2'] = header['CD2_1'] = 0.0
+    header['BANDS'] = bands
+    for i, band in enumerate(bands):
+        header[f'BAND{i}'] = band
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data, header).writeto(buffer)
+    return buffer.getvalue()
+
+
+# Cielo sintético continuo: ondas en coordenadas absolutas del cielo
+# (periodo en arcsec, amplitud, fase), de modo que dos cutouts que se
+# solapan muestran los mismos píxeles en la zona común.
+SKY_WAVES = ((11.0, 0.6, 0.3), (17.0, 0.5, 1.1), (29.0, 0.8, 2.0), (47.0, 1.0, 0.7))
+
+
+def synthetic_sky(ra, dec, width, height, pixscale=0.262, bands='grz'):
+    """Cielo sintético (bandas, height, width) float32 centrado en (ra, dec)
+
+    Orientación de jpeg-cutout: fila 0 al norte, este a la izquierda, centro
+    en el píxel ((width - 1) / 2, (height - 1) / 2).
+    """
+    from crossmatch import inverse_gnomonic
+
+    cols = np.arange(width) - (width - 1) / 2
+    rows = np.arange(height) - (height - 1) / 2
+    xi = -cols[None, :] * pixscale
+    eta = -rows[:, None] * pixscale
+    sky_ra, sky_dec = inverse_gnomonic(xi, eta, ra, dec)
+    u = sky_ra * 3600.0 * np.cos(np.radians(sky_dec))
+    v = sky_dec * 3600.0
+    data = np.empty((len(bands), height, width), dtype=np.float32)
+    for b in range(len(bands)):
+        field = np.zeros((height, width))
+        for k, (period, amplitude, phase) in enumerate(SKY_WAVES):
+            angle = 0.7 * k + 0.4 * b
+            projected = u * np.cos(angle) + v * np.sin(angle)
+            field += amplitude * np.sin(2 * np.pi * projected / period + phase + b)
+        data[b] = 0.01 * field
+    return data
+
+
+def sky_cutout(fmt, ra, dec, width, height, pixscale=0.262, bands='grz'):
+    """Bytes de un cutout del cielo sintético ('jpeg' o 'fits')"""
+    data = synthetic_sky(ra, dec, width, height, pixscale, bands)
+    buffer = io.BytesIO()
+    if fmt == 'fits':
+        from astropy.io import fits
+        header = fits.Header()
+        header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+        header['CRVAL1'], header['CRVAL2'] = float(ra), float(dec)
+        header['CRPIX1'], header['CRPIX2'] = (width + 1) / 2, (height + 1) / 2
+        header['CD1_1'], header['CD2_2'] = -pixscale / 3600, pixscale / 3600
+        header['CD1_2'] = header['CD2_1'] = 0.0
+        header['BANDS'] = bands
+        for i, band in enumerate(bands):
+            header[f'BAND{i}'] = band
+        # FITS: fila 0 al sur
+        fits.PrimaryHDU(data[:, ::-1], header).writeto(buffer)
+    else:
+        rgb = np.clip(128 + 2500 * data[:3].transpose(1, 2, 0), 0, 255).astype(np.uint8)
+        Image.fromarray(rgb).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class CutoutHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 para permitir conexiones keep-alive
+    protocol_version = 'HTTP/1.1'
+    # Latencia simulada por petición (s), emula el RTT al servicio real
+    latency = 0.0
+    # Fracción de respuestas 503 aleatorias
+    error_rate = 0.0
+    # Peticiones simultáneas que el servidor atiende sin degradarse
+    # (None = ilimitado). Por encima la latencia crece linealmente y a
+    # partir del doble responde 429.
+    capacity = None
+    # Renderizar el cielo sintético en la posición pedida (tile_planner.py)
+    # en vez de un cutout fijo
+    sky = False
+
+    active = 0
+    active_lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.active_lock:
+            cls.active += 1
+            active = cls.active
+        try:
+            self._handle(active)
+        finally:
+            with cls.active_lock:
+                cls.active -= 1
+
+    def _handle(self, active):
+        if self.capacity and active > 2 * self.capacity:
+            self._send(429, b'too many requests', 'text/plain')
+            return
+
+        latency = self.latency
+        if self.capacity and active > self.capacity:
+            latency *= active / self.capacity
+        if latency > 0:
+            time.sleep(latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self._send(503, b'service unavailable', 'text/plain')
+            return
+
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        size = int(float(params.get('size', ['256'])[0]))
+        if self.sky and parsed.path.endswith(('fits-cutout', 'jpeg-cutout')):
+            fmt = 'fits' if parsed.path.endswith('fits-cutout') else 'jpeg'
+            width = int(float(params.get('width', [size])[0]))
+            height = int(float(params.get('height', [size])[0]))
+            body = sky_cutout(fmt, float(params['ra'][0]), float(params['dec'][0]), width,
+                              height, float(params.get('pixscale', ['0.262'])[0]),
+                              params.get('bands', ['grz'])[0])
+            self._send(200, body, f'image/{fmt}')
+        elif parsed.path.endswith('fits-cutout'):
+            ra = float(params.get('ra', ['0'])[0])
+            dec = float(params.get('dec', ['0'])[0])
+            bands = params.get('bands', ['grz'])[0]
+            pixscale = float(params.get('pixscale', ['0.262'])[0])
+            self._send(200, synthetic_fits(size, bands, ra, dec, pixscale), 'image/fits')
+        elif parsed.path.endswith('jpeg-cutout'):
+            self._send(200, synthetic_jpeg(size), 'image/jpeg')
+        else:
+            self._send(404, b'not found', 'text/plain')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Silenciar el log por petición
+        pass
+
+
+def make_handler(latency=0.0, error_rate=0.0, capacity=None, sky=False):
+    """Subclase del handler con latencia, errores y capacidad configurados"""
+    return type('ConfiguredCutoutHandler', (CutoutHandler,), {
+        'latency': latency,
+        'error_rate': error_rate,
+        'capacity': capacity,
+        'sky': sky,
+        'active': 0,
+        'active_lock': threading.Lock(),
+    })
+
+
+def start_mock_server(host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, capacity=None,
+                      sky=False):
+    """Arranca el servidor en un hilo; devuelve (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), make_handler(latency, error_rate, capacity, sky))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://{host}:{server.server_address[1]}/viewer/jpeg-cutout"
+    return server, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Legacy cutout service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Per-request latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503 responses")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help="Concurrent requests served before degrading (default: unlimited)")
+    parser.add_argument("--sky", action="store_true",
+                        help="Render a continuous synthetic sky at each requested position")
+    args = parser.parse_args()
+
+    handler = make_handler(args.latency, args.error_rate, args.capacity, args.sky)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"Serving synthetic cutouts on http://{args.host}:{args.port}/viewer/jpeg-cutout")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import os
+import gc
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from preprocessing import CROP_MODES, TARGET_SIZE, preprocess_path, calibrate_fast
+from rebuild_image_arrays import INPUT_DIRS, OUTPUT_DIR, list_images, build_image_array
+
+# Constructor de X_{set}.npy de notebooks/numpy-arrays.ipynb como script.
+#
+# El notebook procesaba lotes de 500 imágenes, guardaba cada lote como
+# temp_batch_*.npy y al final los recargaba todos en una lista para
+# concatenarlos: pico de memoria ~2x el dataset y el doble de E/S. Aquí el
+# .npy final se preasigna con open_memmap y cada worker escribe su rango en
+# su sitio (build_image_array), sin ficheros temporales ni concatenación.
+# Se mantiene la configuración del notebook: recorte de 30" (deepshadows),
+# 64x64, float32 normalizado, y las imágenes ilegibles no abortan (su fila
+# queda a cero para no desalinear X con las etiquetas).
+#
+# --compare-legacy ejecuta también el método del notebook y mide el pico
+# de RSS de cada uno en un proceso nuevo.
+
+LEGACY_BATCH_SIZE = 500
+
+
+def legacy_build(input_dir, output_path, crop_mode='deepshadows', target_size=TARGET_SIZE,
+                 fast=False, batch_size=LEGACY_BATCH_SIZE):
+    """Método original del notebook: temp_batch_*.npy + np.concatenate"""
+    output_dir = os.path.dirname(output_path) or '.'
+    image_files = list_images(input_dir)
+    for i in range(0, len(image_files), batch_size):
+        batch_arrays = []
+        for filename in image_files[i:i + batch_size]:
+            try:
+                img = preprocess_path(os.path.join(input_dir, filename), crop_mode,
+                                      target_size, fast=fast)
+            except Exception as e:
+                print(f"Error procesando {filename}: {str(e)}")
+                continue
+            batch_arrays.append(img.astype(np.float32) / 255.0)
+        if batch_arrays:
+            np.save(os.path.join(output_dir, f'temp_batch_{i // batch_size}.npy'),
+                    np.stack(batch_arrays))
+            del batch_arrays
+            gc.collect()
+
+    batch_files = [f for f in os.listdir(output_dir) if f.startswith('temp_batch_')]
+    batch_files.sort(key=lambda x: int(x.split('_')[2].split('.')[0]))
+    all_arrays = []
+    for batch_file in batch_files:
+        batch_path = os.path.join(output_dir, batch_file)
+        all_arrays.append(np.load(batch_path))
+        os.remove(batch_path)
+    np.save(output_path, np.concatenate(all_arrays, axis=0))
+
+
+def peak_rss_mb():
+    """Pico de RSS (MB) de este proceso y del mayor de sus hijos terminados"""
+    # ru_maxrss está en KB en Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def _measured_build(method, input_dir, output_path, options):
+    start = time.perf_counter()
+    if method == 'legacy':
+        legacy_build(input_dir, output_path, options['crop_mode'], fast=options['fast'])
+    else:
+        build_image_array(input_dir, output_path, options['workers'], options['chunk'],
+                          options['crop_mode'], fast=options['fast'], skip_errors=True)
+    elapsed = time.perf_counter() - start
+    own, children = peak_rss_mb()
+    return {'seconds': elapsed, 'peak_rss_mb': own, 'worker_peak_rss_mb': children}
+
+
+def measured_build(method, input_dir, output_path, options):
+    """Construye X en un proceso nuevo (pico de RSS sin contaminar)"""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_measured_build, method, input_dir, output_path, options).result()
+
+
+def compare(input_dir, output_path, options):
+    """Pico de RSS y tiempo: notebook (temp batches) frente a memmap preasignado"""
+    n_images = len(list_images(input_dir))
+    array_mb = n_images * np.prod(TARGET_SIZE) * 3 * 4 / 1024 ** 2
+    tmp = tempfile.mkdtemp(prefix='numpy_arrays_', dir=os.path.dirname(output_path) or '.')
+    try:
+        legacy_path = os.path.join(tmp, 'X_legacy.npy')
+        results = {'legacy (temp batches)': measured_build('legacy', input_dir, legacy_path,
+                                                           options),
+                   'memmap (in place)': measured_build('memmap', input_dir, output_path,
+                                                       options)}
+        identical = np.array_equal(np.load(legacy_path, mmap_mode='r'),
+                                   np.load(output_path, mmap_mode='r'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\nPeak RSS ({n_images} images, final array {array_mb:.0f} MB)")
+    print(f"  {'method':22s} {'time s':>8s} {'main MB':>9s} {'worker MB':>10s}")
+    for method, stats in results.items():
+        print(f"  {method:22s} {stats['seconds']:8.2f} {stats['peak_rss_mb']:9.0f} "
+              f"{stats['worker_peak_rss_mb']:10.0f}")
+    print(f"  identical arrays: {identical}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build X_{set}.npy as in numpy-arrays.ipynb, writing in place")
+    parser.add_argument("--sets", nargs='+', choices=list(INPUT_DIRS), default=['test'])
+    parser.add_argument("--input-dir", default=None, help="Override the JPEG directory")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: all cores)")
+    parser.add_argument("--chunk", type=int, default=256, help="Images per task")
+    parser.add_argument("--crop-mode", choices=CROP_MODES, default="deepshadows")
+    parser.add_argument("--fast", action="store_true", help="Draft JPEG decoding")
+    parser.add_argument("--compare-legacy", action="store_true",
+                        help="Also run the notebook's temp-batch method and report peak RSS")
+    parser.add_argument("--synthetic", type=int, default=None, metavar="N",
+                        help="Run --compare-legacy on N synthetic JPEGs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    options = {'workers': args.workers, 'chunk': args.chunk, 'crop_mode': args.crop_mode,
+               'fast': args.fast}
+
+    if args.synthetic:
+        from bench_image_arrays import make_jpeg_set
+        tmp = tempfile.mkdtemp(prefix='numpy_arrays_synthetic_')
+        try:
+            make_jpeg_set(os.path.join(tmp, 'jpeg'), args.synthetic)
+            options['fast'] = args.fast and calibrate_fast(
+                [os.path.join(tmp, 'jpeg', f) for f in list_images(os.path.join(tmp, 'jpeg'))],
+                args.crop_mode)
+            compare(os.path.join(tmp, 'jpeg'), os.path.join(tmp, 'X_synthetic.npy'), options)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for set_name in args.sets:
+        input_dir = args.input_dir or INPUT_DIRS[set_name]
+        output_path = os.path.join(args.output_dir, f'X_{set_name}.npy')
+        print(f"\nProcesando conjunto: {set_name}")
+        # Camino rápido solo si en una muestra queda dentro de FAST_TOLERANCE
+        options['fast'] = args.fast and calibrate_fast(
+            [os.path.join(input_dir, f) for f in list_images(input_dir)], args.crop_mode)
+        if args.compare_legacy:
+            compare(input_dir, output_path, options)
+        else:
+            files = build_image_array(input_dir, output_path, args.workers, args.chunk,
+                                      args.crop_mode, fast=options['fast'], skip_errors=True)
+            print(f"Array final guardado en {output_path}. "
+                  f"Dimensiones: {(len(files),) + TARGET_SIZE + (3,)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import os
+import csv
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Dataset empaquetado en disco: imágenes en bloques .npy de tamaño fijo
+# (memory-mapped) más un índice CSV con las coordenadas y etiquetas.
+#
+#   dataset/
+#     meta.json          número de filas confirmadas, forma, parámetros
+#     X_00000.npy ...    bloques de chunk_size imágenes (uint8)
+#     index.csv          fila -> row_index, ra, dec, label, file_name
+#
+# Se puede ir ampliando fila a fila sin conocer el tamaño final; solo las
+# filas contadas en meta.json son válidas (lo que haya después de un corte
+# se sobrescribe al reanudar).
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.csv'
+INDEX_COLUMNS = ['row', 'row_index', 'ra', 'dec', 'label', 'file_name']
+
+
+def _chunk_name(i):
+    return f'X_{i:05d}.npy'
+
+
+def write_json_atomic(path, payload):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ChunkedDatasetWriter:
+    """Base de los escritores por bloques: meta.json + index.csv + bloques .npy
+
+    Gestiona la reanudación (solo valen las filas contadas en meta.json),
+    el índice y el orden de los flush; las subclases deciden cómo se
+    guardan los datos de cada fila (_open_chunk, _store, _flush_chunks).
+    """
+
+    def __init__(self, path, meta):
+        """meta: metadatos de un dataset nuevo (count, chunk_size y los propios)"""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending_index = []
+
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            # Reanudar un dataset existente
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            self._check_meta(self.meta)
+            self._truncate_index(self.meta['count'])
+        else:
+            self.meta = meta
+            with open(os.path.join(path, INDEX_FILE), 'w', newline='') as f:
+                csv.writer(f).writerow(INDEX_COLUMNS)
+            write_json_atomic(meta_path, self.meta)
+
+        self.count = self.meta['count']
+        self.chunk_size = self.meta['chunk_size']
+        self._chunk_id = None
+
+    def _check_meta(self, meta):
+        """ValueError si el dataset existente no es compatible con el pedido"""
+
+    def _open_chunk(self, chunk_id):
+        raise NotImplementedError
+
+    def _store(self, offset, data):
+        raise NotImplementedError
+
+    def _flush_chunks(self):
+        raise NotImplementedError
+
+    def _close_chunks(self):
+        raise NotImplementedError
+
+    def _truncate_index(self, count):
+        """Descarta filas del índice posteriores al último flush confirmado"""
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path, newline='') as f:
+            lines = f.readlines()
+        if len(lines) > count + 1:
+            with open(index_path, 'w', newline='') as f:
+                f.writelines(lines[:count + 1])
+
+    def _append(self, data, label, row_index, ra, dec, file_name):
+        with self._lock:
+            row = self.count
+            chunk_id, offset = divmod(row, self.chunk_size)
+            if chunk_id != self._chunk_id:
+                self._open_chunk(chunk_id)
+                self._chunk_id = chunk_id
+            self._store(offset, data)
+            self._pending_index.append((row, row_index, repr(float(ra)), repr(float(dec)),
+                                        int(label), file_name))
+            self.count += 1
+            return row
+
+    @property
+    def pending(self):
+        return len(self._pending_index)
+
+    def file_rows(self):
+        """Fila de cada cutout ya confirmado en el dataset (file_name -> row)"""
+        index = pd.read_csv(os.path.join(self.path, INDEX_FILE), usecols=['row', 'file_name'],
+                            dtype={'file_name': str}, nrows=self.meta['count'])
+        return dict(zip(index['file_name'], index['row']))
+
+    def flush(self):
+        """Persiste datos, índice y contador (en ese orden)"""
+        with self._lock:
+            self._flush_chunks()
+            if self._pending_index:
+                with open(os.path.join(self.path, INDEX_FILE), 'a', newline='') as f:
+                    csv.writer(f).writerows(self._pending_index)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._pending_index = []
+            self.meta['count'] = self.count
+            write_json_atomic(os.path.join(self.path, META_FILE), self.meta)
+
+    def close(self):
+        self.flush()
+        self._close_chunks()
+        self._chunk_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class PackedDatasetWriter(ChunkedDatasetWriter):
+    def __init__(self, path, image_shape=(64, 64, 3), dtype=np.uint8, chunk_size=4096,
+                 attrs=None):
+        """
+        image_shape: forma de cada imagen
+        chunk_size: imágenes por bloque .npy
+        attrs: metadatos adicionales (crop, pixscale, ...)
+        """
+        self._image_shape = tuple(image_shape)
+        self._chunk = None
+        super().__init__(path, {
+            'count': 0,
+            'chunk_size': chunk_size,
+            'image_shape': list(image_shape),
+            'dtype': np.dtype(dtype).str,
+            'attrs': attrs or {},
+        })
+
+    def _check_meta(self, meta):
+        if tuple(meta['image_shape']) != self._image_shape:
+            raise ValueError(f"{self.path} has image_shape {meta['image_shape']}, "
+                             f"requested {self._image_shape}")
+
+    def _open_chunk(self, chunk_id):
+        self._flush_chunks()
+        chunk_path = os.path.join(self.path, _chunk_name(chunk_id))
+        if os.path.exists(chunk_path):
+            self._chunk = np.load(chunk_path, mmap_mode='r+')
+        else:
+            shape = (self.chunk_size,) + tuple(self.meta['image_shape'])
+            self._chunk = np.lib.format.open_memmap(chunk_path, mode='w+',
+                                                    dtype=np.dtype(self.meta['dtype']),
+                                                    shape=shape)
+
+    def _store(self, offset, image):
+        self._chunk[offset] = image
+
+    def _flush_chunks(self):
+        if self._chunk is not None:
+            self._chunk.flush()
+
+    def _close_chunks(self):
+        self._chunk = None
+
+    def append(self, image, label=-1, row_index=-1, ra=np.nan, dec=np.nan, file_name=''):
+        """Añade una imagen; devuelve su número de fila"""
+        return self._append(image, label, row_index, ra, dec, file_name)
+
+
+class PackedDataset:
+    """Lectura de un dataset empaquetado (bloques memory-mapped)"""
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        self.chunk_size = self.meta['chunk_size']
+        self.image_shape = tuple(self.meta['image_shape'])
+        self.attrs = self.meta.get('attrs', {})
+        n_chunks = -(-self.count // self.chunk_size)
+        self._chunks = [np.load(os.path.join(path, _chunk_name(i)), mmap_mode=mmap_mode)
+                        for i in range(n_chunks)]
+        self._index = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.count
+        if not 0 <= row < self.count:
+            raise IndexError(row)
+        chunk_id, offset = divmod(row, self.chunk_size)
+        return self._chunks[chunk_id][offset]
+
+    @property
+    def index(self):
+        """DataFrame con row_index, ra, dec, label, file_name por fila"""
+        if self._index is None:
+            index = pd.read_csv(os.path.join(self.path, INDEX_FILE))
+            self._index = index.iloc[:self.count].reset_index(drop=True)
+        return self._index
+
+    @property
+    def labels(self):
+        return self.index['label'].to_numpy()
+
+    def iter_chunks(self):
+        """Bloques de imágenes válidas (vistas memory-mapped)"""
+        for i, chunk in enumerate(self._chunks):
+            n_valid = min(self.chunk_size, self.count - i * self.chunk_size)
+            yield chunk[:n_valid]
+
+    def to_array(self, dtype=None):
+        """Copia todas las imágenes a un único array en memoria"""
+        out = np.empty((self.count,) + self.image_shape,
+                       dtype=dtype or np.dtype(self.meta['dtype']))
+        start = 0
+        for chunk in self.iter_chunks():
+            out[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        return out
@@ -0,0 +1,376 @@
+import os
+import io
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+from preprocessing import (TARGET_SIZE, CROP_FACTOR, CROP_MODES, FAST_RESAMPLE,
+                           preprocess_path)
+
+# Caché en disco de cutouts preprocesados, direccionada por contenido.
+#
+# La clave es el hash del JPEG de origen más los parámetros del
+# preprocesado (modo de recorte, factor, tamaño final, filtro de
+# remuestreo, decodificación rápida), así que cambiar TARGET_SIZE o el
+# recorte no invalida las entradas de los otros parámetros y dos copias
+# del mismo fichero comparten entrada. Los arrays uint8 se guardan como
+# .npy en cache_dir/ab/abcdef....npy; un índice SQLite (WAL) lleva el
+# tamaño y el último acceso de cada entrada para la expulsión LRU cuando
+# se supera max_bytes. Los hashes de origen se memorizan por (ruta,
+# tamaño, mtime) para no releer ficheros sin cambios.
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Cambiar al modificar preprocessing.py (invalida todas las entradas)
+PREPROCESS_VERSION = 1
+
+# Tras expulsar se baja hasta este fracción de max_bytes (histéresis)
+EVICT_TARGET = 0.9
+
+# Antigüedad (s) a partir de la cual un .tmp se considera abandonado
+STALE_TMP_AGE = 3600
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)",
+    """
+    CREATE TABLE IF NOT EXISTS sources (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest TEXT NOT NULL
+    ) WITHOUT ROWID
+    """,
+]
+
+
+def resample_name(fast=False, resample=FAST_RESAMPLE):
+    """Filtro efectivo de preprocess_path (LANCZOS salvo en el camino rápido)"""
+    from PIL import Image
+    if not fast:
+        return 'lanczos'
+    return {Image.NEAREST: 'nearest', Image.BILINEAR: 'bilinear', Image.BICUBIC: 'bicubic',
+            Image.LANCZOS: 'lanczos', Image.BOX: 'box', Image.HAMMING: 'hamming'}[resample]
+
+
+def params_key(crop_mode='fraction', target_size=TARGET_SIZE, crop_factor=CROP_FACTOR,
+               fast=False, resample=FAST_RESAMPLE):
+    """Parte de la clave que depende del preprocesado"""
+    return json.dumps({
+        'crop_mode': crop_mode,
+        # El factor solo afecta al recorte 'fraction'
+        'crop_factor': crop_factor if crop_mode == 'fraction' else None,
+        'target_size': list(target_size),
+        'resample': resample_name(fast, resample),
+        'fast': bool(fast),
+        'version': PREPROCESS_VERSION,
+    }, sort_keys=True)
+
+
+class PreprocessCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, touch_batch=256, reconcile=True):
+        """
+        max_bytes: tamaño máximo de los arrays guardados
+        touch_batch: accesos / inserciones acumulados antes de escribirlos en el índice
+        reconcile: indexar al abrir los .npy que un corte dejó fuera del índice
+            (los workers lo desactivan; el proceso principal ya lo ha hecho)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.touch_batch = touch_batch
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        # Varios procesos (workers de los constructores) comparten el índice
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'), timeout=60,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+        self._touched = {}
+        self._inserted = {}
+        self._sources = {}
+        # Total en bytes mantenido de forma incremental: put y la expulsión
+        # no recorren la tabla. Solo cuenta lo que ve este proceso; al
+        # superar el límite se recalcula una vez antes de expulsar
+        self._total_bytes = self._sum_sizes()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        if reconcile:
+            self.reconcile()
+
+    # ------------------------------------------------------------------
+    # Claves
+    # ------------------------------------------------------------------
+    def source_digest(self, path):
+        """Hash del contenido de path, memorizado por (tamaño, mtime)"""
+        stat = os.stat(path)
+        with self._lock:
+            row = self._sources.get(path) or self._conn.execute(
+                "SELECT size, mtime_ns, digest FROM sources WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        with open(path, 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        with self._lock:
+            self._sources[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def make_key(self, path, params):
+        digest = self.source_digest(path)
+        return hashlib.blake2b(f"{digest}|{params}".encode(), digest_size=20).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    # ------------------------------------------------------------------
+    # Lectura / escritura
+    # ------------------------------------------------------------------
+    def get(self, key):
+        """Array guardado o None"""
+        try:
+            array = np.load(self._entry_path(key))
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= self.touch_batch:
+                self._flush_pending()
+        return array
+
+    def put(self, key, array):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(array))
+        data = buffer.getvalue()
+        # Escritura atómica: otro proceso nunca ve un .npy a medias
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            # Commit por lotes, como los accesos del LRU
+            self._inserted[key] = (len(data), time.time())
+            self._total_bytes += len(data)
+            if len(self._inserted) >= self.touch_batch:
+                self._flush_pending()
+        self._maybe_evict()
+
+    def get_or_compute(self, path, params, compute):
+        """Array de caché para (contenido de path, params); si falta, compute(path)"""
+        key = self.make_key(path, params)
+        array = self.get(key)
+        if array is None:
+            array = compute(path)
+            self.put(key, array)
+        return array
+
+    # ------------------------------------------------------------------
+    # LRU
+    # ------------------------------------------------------------------
+    def _flush_pending(self):
+        """Inserciones y accesos pendientes en una sola transacción"""
+        if not self._touched and not self._inserted and not self._sources:
+            return
+        with self._conn:
+            if self._sources:
+                self._conn.executemany("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                                       [(p,) + v for p, v in self._sources.items()])
+            if self._inserted:
+                self._conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                                       [(k, size, t) for k, (size, t) in self._inserted.items()])
+            if self._touched:
+                self._conn.executemany("UPDATE entries SET last_access = ? WHERE key = ?",
+                                       [(t, k) for k, t in self._touched.items()])
+        self._inserted = {}
+        self._sources = {}
+        self._touched = {}
+
+    def reconcile(self, stale_tmp_age=STALE_TMP_AGE):
+        """Indexa los .npy ausentes del índice y borra los .tmp abandonados.
+
+        put escribe el fichero antes de confirmar su fila por lotes; si el
+        proceso muere entre medias, el fichero quedaría fuera del total y de
+        la expulsión. Se indexan con su tamaño y last_access = mtime (los
+        primeros candidatos a expulsar). Devuelve cuántos se han indexado.
+        """
+        with self._lock:
+            self._flush_pending()
+            known = {row[0] for row in self._conn.execute("SELECT key FROM entries")}
+        now = time.time()
+        orphans = []
+        with os.scandir(self.cache_dir) as shards:
+            shard_dirs = [entry.path for entry in shards
+                          if len(entry.name) == 2 and entry.is_dir()]
+        for shard_dir in shard_dirs:
+            with os.scandir(shard_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.name.endswith('.tmp'):
+                            # Los recientes pueden ser escrituras en curso de otro proceso
+                            if now - entry.stat().st_mtime > stale_tmp_age:
+                                os.remove(entry.path)
+                        elif entry.name.endswith('.npy') and entry.name[:-4] not in known:
+                            stat = entry.stat()
+                            orphans.append((entry.name[:-4], stat.st_size, stat.st_mtime))
+                    except FileNotFoundError:
+                        # Expulsado o renombrado por otro proceso mientras se recorría
+                        continue
+        if orphans:
+            with self._lock:
+                with self._conn:
+                    self._conn.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?, ?)",
+                                           orphans)
+                self._total_bytes = self._sum_sizes()
+            logging.info(f"Cache {self.cache_dir}: {len(orphans)} unindexed entries recovered")
+            self._maybe_evict()
+        return len(orphans)
+
+    def _sum_sizes(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def total_bytes(self):
+        return self._total_bytes
+
+    def _maybe_evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        with self._lock:
+            self._flush_pending()
+            # Resincronizar con lo que hayan añadido o expulsado otros procesos
+            total = self._total_bytes = self._sum_sizes()
+            if total <= self.max_bytes:
+                return
+            target = self.max_bytes * EVICT_TARGET
+            victims = []
+            for key, size in self._conn.execute(
+                    "SELECT key, size FROM entries ORDER BY last_access"):
+                if total <= target:
+                    break
+                victims.append(key)
+                total -= size
+                self.evicted_bytes += size
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in victims])
+            self._conn.commit()
+            self._total_bytes = total
+        for key in victims:
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+        self.evictions += len(victims)
+
+    # ------------------------------------------------------------------
+    # Estadísticas
+    # ------------------------------------------------------------------
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+        }
+
+    def summary(self):
+        s = self.stats
+        return (f"hits={s['hits']} misses={s['misses']} hit_rate={s['hit_rate']:.1%} "
+                f"evictions={s['evictions']}")
+
+    def info(self):
+        with self._lock:
+            self._flush_pending()
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
+
+    def flush(self):
+        """Escribe las inserciones y accesos pendientes en el índice"""
+        with self._lock:
+            self._flush_pending()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def cached_preprocess_path(path, cache=None, crop_mode='fraction', target_size=TARGET_SIZE,
+                           crop_factor=CROP_FACTOR, fast=False, resample=FAST_RESAMPLE):
+    """preprocess_path con caché opcional (misma salida uint8)"""
+    def compute(source):
+        return preprocess_path(source, crop_mode, target_size, crop_factor, fast, resample)
+
+    if cache is None:
+        return compute(path)
+    params = params_key(crop_mode, target_size, crop_factor, fast, resample)
+    return cache.get_or_compute(path, params, compute)
+
+
+def benchmark(input_dir, cache_dir, crop_mode='fraction', fast=False, max_bytes=DEFAULT_MAX_BYTES):
+    """Dos pasadas sobre input_dir: en frío (llena la caché) y en caliente"""
+    files = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir)
+                   if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    with PreprocessCache(cache_dir, max_bytes) as cache:
+        for label in ('cold', 'warm'):
+            start = time.perf_counter()
+            for path in files:
+                cached_preprocess_path(path, cache, crop_mode, fast=fast)
+            elapsed = time.perf_counter() - start
+            print(f"  {label}: {len(files) / elapsed:8.0f} images/s  ({cache.summary()})")
+        print(f"  cache: {cache.info()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocessed cutout cache")
+    parser.add_argument("cache_dir", help="Cache directory")
+    parser.add_argument("--max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3)
+    parser.add_argument("--bench", default=None, metavar="JPEG_DIR",
+                        help="Cold/warm benchmark over a JPEG directory")
+    parser.add_argument("--crop-mode", choices=CROP_MODES, default="fraction")
+    parser.add_argument("--fast", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    max_bytes = int(args.max_gb * 1024 ** 3)
+    if args.bench:
+        benchmark(args.bench, args.cache_dir, args.crop_mode, args.fast, max_bytes)
+        return
+    with PreprocessCache(args.cache_dir, max_bytes) as cache:
+        info = cache.info()
+    print(f"{args.cache_dir}: {info['entries']} entries, {info['bytes'] / 1024 ** 2:.1f} MB "
+          f"of {info['max_bytes'] / 1024 ** 2:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import io
+import logging
+
+import numpy as np
+from PIL import Image
+
+# Recorte y redimensionado de cutouts compartido por los constructores de
+# arrays y la descarga en streaming.
+
+TARGET_SIZE = (64, 64)
+CROP_FACTOR = 0.2  # Recortar 20% de cada borde (rebuild_image_arrays.py)
+
+# Recorte DeepShadows (numpy-arrays.ipynb)
+ORIGINAL_PIXSCALE = 0.262  # Arcsec/pixel usado en las descargas
+DEEP_SHADOWS_ANGULAR_SIZE = 30  # Arcsec (tamaño angular objetivo)
+
+CROP_MODES = ('fraction', 'deepshadows')
+
+# Remuestreo del camino rápido (decodificación reducida + BILINEAR)
+FAST_RESAMPLE = Image.BILINEAR
+
+# Error medio absoluto (0-255) admitido al camino rápido frente a preprocess(),
+# medido sobre una muestra antes de usarlo (calibrate_fast)
+FAST_TOLERANCE = 2.0
+FAST_CALIBRATION_SAMPLE = 64
+
+
+def calculate_crop_size(img_width, pixscale=ORIGINAL_PIXSCALE,
+                        angular_size=DEEP_SHADOWS_ANGULAR_SIZE):
+    """
+    Calcula el recorte necesario para obtener 30"x30"
+    basado en el pixscale original de 0.262
+    """
+    total_arcsec = img_width * pixscale
+    crop_pixels = int((total_arcsec - angular_size) / pixscale / 2)
+    return crop_pixels
+
+
+def crop_box(width, height, crop_mode='fraction', crop_factor=CROP_FACTOR):
+    """Caja (left, upper, right, lower) del recorte central"""
+    if crop_mode == 'fraction':
+        crop_w = int(width * crop_factor)
+        crop_h = int(height * crop_factor)
+    elif crop_mode == 'deepshadows':
+        crop_w = crop_h = calculate_crop_size(width)
+    else:
+        raise ValueError(f"Unknown crop mode: {crop_mode}")
+    return (crop_w, crop_h, width - crop_w, height - crop_h)
+
+
+def preprocess(img, crop_mode='fraction', target_size=TARGET_SIZE, crop_factor=CROP_FACTOR):
+    """Recorta y redimensiona una imagen PIL; devuelve un array uint8 (H, W, 3)"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    width, height = img.size
+    img = img.crop(crop_box(width, height, crop_mode, crop_factor))
+    img = img.resize(target_size, Image.LANCZOS)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def draft_scale(box, target_size):
+    """Mayor factor JPEG (1/2/4/8) que deja el recorte >= target_size"""
+    crop_w = box[2] - box[0]
+    crop_h = box[3] - box[1]
+    for scale in (8, 4, 2):
+        if crop_w / scale >= target_size[0] and crop_h / scale >= target_size[1]:
+            return scale
+    return 1
+
+
+def preprocess_draft(img, crop_mode='fraction', target_size=TARGET_SIZE,
+                     crop_factor=CROP_FACTOR, resample=FAST_RESAMPLE):
+    """Camino rápido: decodificación JPEG escalada en el dominio DCT (draft).
+
+    img debe estar abierta pero sin cargar. El recorte se aplica en
+    coordenadas reescaladas (sin redondeo) y el remuestreo final es más
+    barato que LANCZOS; ver report_fast_decode.py para el error frente
+    a preprocess() y calibrate_fast() para la comprobación que hacen los
+    constructores antes de usarlo.
+    """
+    width, height = img.size
+    box = crop_box(width, height, crop_mode, crop_factor)
+    scale = draft_scale(box, target_size)
+    if scale > 1 and img.format == 'JPEG':
+        img.draft('RGB', (-(-width // scale), -(-height // scale)))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    sx = img.size[0] / width
+    sy = img.size[1] / height
+    scaled_box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+    img = img.resize(target_size, resample, box=scaled_box)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def preprocess_path(source, crop_mode='fraction', target_size=TARGET_SIZE,
+                    crop_factor=CROP_FACTOR, fast=False, resample=FAST_RESAMPLE):
+    """Ruta o fichero -> array uint8; fast=True usa preprocess_draft"""
+    with Image.open(source) as img:
+        if fast:
+            return preprocess_draft(img, crop_mode, target_size, crop_factor, resample)
+        return preprocess(img, crop_mode, target_size, crop_factor)
+
+
+def fast_path_error(sources, crop_mode='fraction', target_size=TARGET_SIZE,
+                    crop_factor=CROP_FACTOR, resample=FAST_RESAMPLE):
+    """Error medio absoluto (0-255) de preprocess_draft frente a preprocess.
+
+    Devuelve (error, imágenes medidas); las que no se pueden leer se omiten.
+    """
+    errors = []
+    for source in sources:
+        try:
+            with Image.open(source) as img:
+                fast = preprocess_draft(img, crop_mode, target_size, crop_factor, resample)
+            with Image.open(source) as img:
+                exact = preprocess(img, crop_mode, target_size, crop_factor)
+        except OSError:
+            continue
+        errors.append(np.abs(fast.astype(np.float64) - exact).mean())
+    return (float(np.mean(errors)) if errors else None), len(errors)
+
+
+def calibrate_fast(sources, crop_mode='fraction', target_size=TARGET_SIZE,
+                   crop_factor=CROP_FACTOR, resample=FAST_RESAMPLE, tolerance=FAST_TOLERANCE,
+                   sample_size=FAST_CALIBRATION_SAMPLE):
+    """Decide una vez si el camino rápido es aceptable para sources.
+
+    Compara ambos caminos sobre hasta sample_size rutas repartidas por
+    sources; devuelve False (usar preprocess) si el error supera tolerance
+    o ninguna imagen de la muestra se puede leer.
+    """
+    step = max(1, len(sources) // sample_size)
+    sample = list(sources[::step][:sample_size])
+    error, measured = fast_path_error(sample, crop_mode, target_size, crop_factor, resample)
+    if error is None:
+        logging.warning("No readable images to calibrate fast decode; using full decode + LANCZOS")
+        return False
+    if error > tolerance:
+        logging.warning(f"Fast decode MAE {error:.2f} > {tolerance} on {measured} images; "
+                        f"using full decode + LANCZOS")
+        return False
+    logging.info(f"Fast decode MAE {error:.2f} <= {tolerance} on {measured} images")
+    return True
+
+
+def decode_cutout(content):
+    """Decodifica los bytes de un JPEG descargado"""
+    img = Image.open(io.BytesIO(content))
+    img.load()
+    return img
+
+
+def preprocess_bytes(content, crop_mode='fraction', target_size=TARGET_SIZE,
+                     crop_factor=CROP_FACTOR, fast=False):
+    """Bytes JPEG -> array uint8 recortado y redimensionado (sin pasar por disco)"""
+    if fast:
+        return preprocess_path(io.BytesIO(content), crop_mode, target_size, crop_factor, fast=True)
+    return preprocess(decode_cutout(content), crop_mode, target_size, crop_factor)
@@ -0,0 +1,201 @@
+import time
+import random
+from collections import deque
+import asyncio
+import logging
+import threading
+
+import psutil
+
+# Control de concurrencia AIMD (additive increase / multiplicative decrease)
+# para las descargas. Sustituye a las pausas fijas de ResourceManager: en
+# lugar de detener todo 30-60 s se reduce el número de peticiones en vuelo,
+# y ninguna descarga se descarta por estar el sistema ocupado.
+
+THROTTLE_STATUS = {429, 500, 502, 503, 504}
+
+# Latencia base: percentil bajo de las últimas BASE_WINDOW respuestas
+# correctas (no el mínimo histórico, que con jitter normal dejaba la
+# latencia media siempre por encima del umbral y el límite en min_limit)
+BASE_WINDOW = 256
+BASE_PERCENTILE = 0.1
+BASE_UPDATE = 32
+
+
+class AdaptiveRateController:
+    def __init__(self, max_limit=32, min_limit=1, initial=None, priority=0.5,
+                 latency_factor=2.0, decrease=0.5, check_interval=2.0, adaptive=True):
+        """
+        max_limit: máximo de peticiones simultáneas
+        priority: 0.1 (baja) - 1.0 (alta), ajusta los umbrales de CPU/memoria
+        latency_factor: latencia media / latencia base que se considera congestión
+        adaptive: False mantiene el límite fijo en max_limit (para comparar)
+        """
+        self.priority = max(0.1, min(1.0, priority))
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        if initial is None:
+            initial = max(self.min_limit, self.max_limit // 4)
+        self.adaptive = adaptive
+        self.limit = float(self.max_limit if not adaptive else min(initial, self.max_limit))
+        self.latency_factor = latency_factor
+        self.decrease = decrease
+        self.check_interval = check_interval
+
+        self.in_flight = 0
+        self.base_latency = None
+        self.avg_latency = None
+        self._recent_latencies = deque(maxlen=BASE_WINDOW)
+        self._since_base_update = 0
+        self.last_decrease = 0.0
+        self.last_check = 0.0
+        self.under_pressure = False
+        self.stats = {'ok': 0, 'throttled': 0, 'errors': 0, 'other': 0, 'decreases': 0}
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._async_cond = None
+
+        # Primera llamada de cpu_percent sin intervalo solo inicializa el contador
+        psutil.cpu_percent(interval=None)
+
+    # ------------------------------------------------------------------
+    # Reserva de plazas (hilos)
+    # ------------------------------------------------------------------
+    def acquire(self):
+        """Bloquea hasta que haya una plaza libre bajo el límite actual"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait(timeout=1.0)
+                self._check_resources()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # Reserva de plazas (asyncio)
+    # ------------------------------------------------------------------
+    async def acquire_async(self):
+        if self._async_cond is None:
+            self._async_cond = asyncio.Condition()
+        async with self._async_cond:
+            while self.in_flight >= int(self.limit):
+                try:
+                    await asyncio.wait_for(self._async_cond.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                self._check_resources()
+            self.in_flight += 1
+
+    async def release_async(self):
+        async with self._async_cond:
+            self.in_flight -= 1
+            self._async_cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # Realimentación
+    # ------------------------------------------------------------------
+    def record(self, latency, status, valid=True):
+        """Registra el resultado de una petición (status None = excepción de red)
+
+        valid=False marca un 200 con cuerpo truncado o inválido, que cuenta
+        como error. Otros códigos (p.ej. 404 fuera del footprint) no dicen
+        nada de la carga del servidor: ni ajustan la latencia base ni suben
+        el límite.
+        """
+        with self._lock:
+            now = time.time()
+            if status is None or status in THROTTLE_STATUS or not valid:
+                if status in THROTTLE_STATUS:
+                    self.stats['throttled'] += 1
+                else:
+                    self.stats['errors'] += 1
+                self._multiplicative_decrease(now, f"status {status}" if valid
+                                              else "invalid response body")
+                return
+            if status != 200:
+                self.stats['other'] += 1
+                return
+
+            self.stats['ok'] += 1
+            if latency is not None:
+                self.avg_latency = (latency if self.avg_latency is None
+                                    else 0.8 * self.avg_latency + 0.2 * latency)
+                self._update_base_latency(latency)
+
+            self._check_resources()
+            if self.under_pressure:
+                self._multiplicative_decrease(now, "local resource pressure")
+            elif (latency is not None and self.base_latency
+                  and self.avg_latency > self.latency_factor * max(self.base_latency, 0.01)
+                  and latency > self.latency_factor * max(self.base_latency, 0.01)):
+                # Latencia creciente (media y respuesta actual): cola en el
+                # servidor, reducir suavemente. Una respuesta rápida cuenta
+                # como sana aunque la media aún arrastre picos anteriores
+                self._multiplicative_decrease(now, f"latency {self.avg_latency:.2f}s", factor=0.9)
+            else:
+                self._additive_increase()
+
+    def _update_base_latency(self, latency):
+        """Percentil BASE_PERCENTILE de la ventana, recalculado cada BASE_UPDATE respuestas"""
+        self._recent_latencies.append(latency)
+        self._since_base_update += 1
+        if self.base_latency is None or self._since_base_update >= BASE_UPDATE:
+            ordered = sorted(self._recent_latencies)
+            self.base_latency = ordered[int(BASE_PERCENTILE * (len(ordered) - 1))]
+            self._since_base_update = 0
+
+    def _additive_increase(self):
+        if not self.adaptive:
+            return
+        # +1 plaza por "ventana" completa de respuestas correctas
+        self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+        self._cond.notify_all()
+
+    def _multiplicative_decrease(self, now, reason, factor=None):
+        if not self.adaptive:
+            return
+        # Como mucho una reducción por latencia media: las respuestas de una
+        # misma ráfaga no deben colapsar el límite
+        window = max(self.avg_latency or 0.0, 0.5)
+        if now - self.last_decrease < window:
+            return
+        self.last_decrease = now
+        old = self.limit
+        self.limit = max(self.min_limit, self.limit * (factor or self.decrease))
+        self.stats['decreases'] += 1
+        if int(old) != int(self.limit):
+            logging.info(f"Concurrency {int(old)} -> {int(self.limit)} ({reason})")
+
+    def _check_resources(self):
+        """Muestrea CPU/memoria sin bloquear, como mucho cada check_interval s"""
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+
+        cpu_percent = psutil.cpu_percent(interval=None)
+        mem_available = psutil.virtual_memory().available / (1024 ** 3)  # GB
+
+        # Umbrales ajustables por prioridad (mismos que ResourceManager)
+        cpu_threshold = 80 - (20 * self.priority)
+        mem_threshold = 1.0 + (2 * self.priority)
+
+        pressure = cpu_percent > cpu_threshold or mem_available < mem_threshold
+        if pressure and not self.under_pressure:
+            logging.warning(f"Resource pressure (CPU {cpu_percent}%, "
+                            f"{mem_available:.1f}GB free), reducing concurrency")
+        self.under_pressure = pressure
+
+    def backoff_delay(self, attempt, base=1.0, cap=60.0):
+        """Espera antes de reintentar una petición limitada (jitter completo)"""
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+    def summary(self):
+        return (f"limit={int(self.limit)} ok={self.stats['ok']} "
+                f"throttled={self.stats['throttled']} errors={self.stats['errors']} "
+                f"other={self.stats['other']} "
+                f"decreases={self.stats['decreases']}")
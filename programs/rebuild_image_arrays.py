@@ -1,8 +1,16 @@
 import numpy as np
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 from tqdm import tqdm
 
+from preprocessing import (TARGET_SIZE, CROP_FACTOR, CROP_MODES, preprocess, preprocess_path,
+                           calibrate_fast)
+from compact_dataset import compact_path, write_compact_metadata
+from manifest import read_manifest
+from preprocess_cache import PreprocessCache, cached_preprocess_path, DEFAULT_MAX_BYTES
+
 # Configuración
 INPUT_DIRS = {
     'train': '../Datasets_DeepShadows/Jpeg_data/Training/',
@@ -11,49 +19,192 @@ INPUT_DIRS = {
 }
 
 OUTPUT_DIR = '../Datasets_DeepShadows/array_images/'
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Parámetros de procesamiento
-TARGET_SIZE = (64, 64)
-CROP_FACTOR = 0.2  # Recortar 20% de cada borde
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def load_pixels(img_path, crop_mode='fraction', target_size=TARGET_SIZE, fast=False, cache=None):
+    """Imagen recortada y redimensionada como uint8 (sin normalizar)"""
+    if cache is not None:
+        # Reutiliza el cutout preprocesado de ejecuciones anteriores (preprocess_cache.py)
+        return cached_preprocess_path(img_path, cache, crop_mode, target_size, CROP_FACTOR, fast)
+    if fast:
+        # Decodificación reducida (draft) + remuestreo barato
+        return preprocess_path(img_path, crop_mode, target_size, CROP_FACTOR, fast=True)
 
-def process_image(img_path):
     img = Image.open(img_path)
-    
-    # Recorte proporcional
-    width, height = img.size
-    crop_w = int(width * CROP_FACTOR)
-    crop_h = int(height * CROP_FACTOR)
-    
-    img = img.crop((
-        crop_w, 
-        crop_h, 
-        width - crop_w, 
-        height - crop_h
-    ))
-    
-    # Redimensionar
-    img = img.resize(TARGET_SIZE, Image.LANCZOS)
-    
+
+    # Recorte proporcional + redimensionar (preprocessing.py)
+    return preprocess(img, crop_mode, target_size, CROP_FACTOR)
+
+def process_image(img_path, crop_mode='fraction', target_size=TARGET_SIZE, fast=False):
     # Convertir a array y normalizar
-    return np.array(img) / 255.0
-
-for set_name, input_dir in INPUT_DIRS.items():
-    print(f"\nProcesando conjunto: {set_name}")
-    
-    # Obtener archivos ordenados
-    files = sorted([f for f in os.listdir(input_dir) 
-                  if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
-    
-    # Procesar imágenes
-    images = []
-    for filename in tqdm(files, desc="Procesando imágenes"):
+    return load_pixels(img_path, crop_mode, target_size, fast) / 255.0
+
+def list_images(input_dir, use_manifest=False):
+    """Archivos de imagen en el orden de X e y.
+
+    Con use_manifest el orden es el row_index del catálogo de origen
+    (manifest.parquet del directorio); si no, orden alfabético.
+    """
+    if use_manifest:
+        return read_manifest(input_dir)['file_name'].tolist()
+    return sorted([f for f in os.listdir(input_dir)
+                   if f.lower().endswith(IMAGE_EXTENSIONS)])
+
+# Estado de cada proceso: disposición del .npy de salida y caché, una vez por worker
+_worker_output = None
+_worker_cache = None
+
+def npy_layout(path):
+    """(dtype, shape, offset de los datos) de un .npy en orden C"""
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order:
+            raise ValueError(f"{path} is Fortran-ordered")
+        return dtype, shape, f.tell()
+
+def _init_worker(output_path, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES):
+    global _worker_output, _worker_cache
+    _worker_output = (output_path,) + npy_layout(output_path)
+    if cache_dir:
+        _worker_cache = PreprocessCache(cache_dir, cache_max_bytes, reconcile=False)
+
+def _process_range(input_dir, files, start, crop_mode, target_size, fast, skip_errors=False):
+    """Procesa files y escribe en X[start:start+len(files)] del .npy compartido
+
+    Solo se mapea el rango del batch y se libera al terminar, así la
+    memoria residente de cada worker no crece con el tamaño del array.
+    """
+    path, dtype, shape, data_offset = _worker_output
+    row_bytes = dtype.itemsize * int(np.prod(shape[1:]))
+    output = np.memmap(path, dtype=dtype, mode='r+', offset=data_offset + start * row_bytes,
+                       shape=(len(files),) + tuple(shape[1:]))
+    # uint8: píxeles sin normalizar (compact_dataset.py); float: divididos por 255
+    normalize = dtype != np.uint8
+    cache = _worker_cache
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    failed = []
+    for offset, filename in enumerate(files):
         img_path = os.path.join(input_dir, filename)
-        img_array = process_image(img_path)
-        images.append(img_array)
-    
-    # Guardar array
-    images_array = np.array(images, dtype=np.float32)
-    output_path = os.path.join(OUTPUT_DIR, f'X_{set_name}.npy')
-    np.save(output_path, images_array)
-    print(f"Guardado {output_path} con {len(images_array)} imágenes")
+        try:
+            pixels = load_pixels(img_path, crop_mode, target_size, fast, cache)
+        except Exception as e:
+            if not skip_errors:
+                raise
+            # La fila queda a cero para no desalinear X con la lista de ficheros
+            print(f"Error procesando {filename}: {e}")
+            failed.append(filename)
+            continue
+        output[offset] = pixels / 255.0 if normalize else pixels
+    output.flush()
+    del output
+    if cache is None:
+        return len(files), 0, 0, failed
+    cache.flush()
+    return len(files), cache.hits - hits, cache.misses - misses, failed
+
+def build_image_array(input_dir, output_path, workers=None, chunk=256,
+                      crop_mode='fraction', target_size=TARGET_SIZE, dtype=np.float32,
+                      fast=False, files=None, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+                      skip_errors=False):
+    """Construye X en paralelo sobre un .npy preasignado (sin copias en memoria)
+
+    Con cache_dir los cutouts preprocesados se leen/guardan en la caché
+    de preprocess_cache.py (compartida entre workers y ejecuciones). Con
+    skip_errors las imágenes ilegibles quedan a cero en vez de abortar.
+    """
+    if files is None:
+        files = list_images(input_dir)
+    shape = (len(files),) + tuple(target_size) + (3,)
+
+    # Preasignar el .npy final; cada worker escribe su rango por índice
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=shape)
+    del output
+
+    workers = workers or os.cpu_count() or 1
+    ranges = [(start, files[start:start + chunk]) for start in range(0, len(files), chunk)]
+    if cache_dir:
+        # Recuperar entradas de ejecuciones cortadas una sola vez, antes de los workers
+        PreprocessCache(cache_dir, cache_max_bytes).close()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(output_path, cache_dir, cache_max_bytes)) as executor:
+        futures = [executor.submit(_process_range, input_dir, batch, start, crop_mode,
+                                   tuple(target_size), fast, skip_errors)
+                   for start, batch in ranges]
+        hits = misses = 0
+        failed = []
+        with tqdm(total=len(files), desc="Procesando imágenes") as progress:
+            for future in as_completed(futures):
+                done, batch_hits, batch_misses, batch_failed = future.result()
+                failed.extend(batch_failed)
+                hits += batch_hits
+                misses += batch_misses
+                progress.update(done)
+
+    if failed:
+        print(f"{len(failed)} imágenes con error (filas a cero en {output_path})")
+    if cache_dir:
+        lookups = hits + misses
+        print(f"Caché {cache_dir}: {hits} hits, {misses} misses "
+              f"({hits / lookups if lookups else 0:.1%} hit rate)")
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(description="Build X_{set}.npy image arrays")
+    parser.add_argument("--sets", nargs='+', choices=list(INPUT_DIRS), default=list(INPUT_DIRS),
+                        help="Dataset splits to build")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: all cores)")
+    parser.add_argument("--chunk", type=int, default=256, help="Images per task")
+    parser.add_argument("--crop-mode", choices=CROP_MODES, default="fraction",
+                        help="fraction (CROP_FACTOR) or deepshadows (30 arcsec)")
+    parser.add_argument("--fast", action="store_true",
+                        help="Reduced-size JPEG decoding (draft) + bilinear resample")
+    parser.add_argument("--uint8", action="store_true",
+                        help="Compact format: X_{set}_u8.npy + metadata (see compact_dataset.py)")
+    parser.add_argument("--manifest", action="store_true",
+                        help="Order images by the download manifest (manifest.parquet)")
+    parser.add_argument("--cache", default=None, metavar="DIR",
+                        help="Reuse preprocessed cutouts across runs (preprocess_cache.py)")
+    parser.add_argument("--cache-max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="Cache size bound (LRU eviction)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help="Output directory")
+    args = parser.parse_args()
+    cache_max_bytes = int(args.cache_max_gb * 1024 ** 3)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for set_name in args.sets:
+        input_dir = INPUT_DIRS[set_name]
+        print(f"\nProcesando conjunto: {set_name}")
+        files = list_images(input_dir, args.manifest)
+        # Camino rápido solo si en una muestra queda dentro de FAST_TOLERANCE
+        fast = args.fast and calibrate_fast([os.path.join(input_dir, f) for f in files],
+                                            args.crop_mode, crop_factor=CROP_FACTOR)
+
+        if args.uint8:
+            # uint8 + metadatos; la normalización se hace al cargar cada batch
+            output_path = compact_path(args.output_dir, set_name)
+            files = build_image_array(input_dir, output_path, args.workers, args.chunk,
+                                      args.crop_mode, dtype=np.uint8, fast=fast,
+                                      files=files, cache_dir=args.cache,
+                                      cache_max_bytes=cache_max_bytes)
+            write_compact_metadata(args.output_dir, set_name, files,
+                                   crop_mode=args.crop_mode, crop_factor=CROP_FACTOR,
+                                   fast_decode=fast)
+            print(f"Guardado {output_path} con {len(files)} imágenes (uint8)")
+            continue
+
+        # Guardar array
+        output_path = os.path.join(args.output_dir, f'X_{set_name}.npy')
+        files = build_image_array(input_dir, output_path, args.workers, args.chunk,
+                                  args.crop_mode, fast=fast, files=files,
+                                  cache_dir=args.cache, cache_max_bytes=cache_max_bytes)
+        print(f"Guardado {output_path} con {len(files)} imágenes")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 import numpy as np
-import os
 import pandas as pd
+import os
 import re
-from tqdm import tqdm
+import argparse
+
+from manifest import read_manifest
+from crossmatch import DEFAULT_TOL_ARCSEC, crossmatch_labels, load_catalog_indexes
 
 # Configuración
 JPEG_DIRS = {
@@ -18,9 +21,6 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 LSB_PATH = '../Datasets_DeepShadows/Datasets/random_LSBGs_all.csv'
 ARTIFACT_PATH = '../Datasets_DeepShadows/Datasets/random_negative_all_2.csv'
 
-lsb_df = pd.read_csv(LSB_PATH)
-art_df = pd.read_csv(ARTIFACT_PATH)
-
 # Función para parsear nombres de archivo
 def parse_filename(filename):
     match = re.match(r'^([\d\.\-]+)_([\d\.\-]+)_\d+_256pix\.jpe?g', filename, re.IGNORECASE)
@@ -33,50 +33,75 @@ def parse_filename(filename):
             return (None, None)
     return (None, None)
 
-# Función para obtener etiqueta
-def get_label(ra, dec):
-    if ra is None or dec is None:
-        return 0
-    
-    # Buscar en galaxias LSB
-    match_lsb = lsb_df[
-        (abs(lsb_df['ra'] - ra) < 0.001) & 
-        (abs(lsb_df['dec'] - dec) < 0.001)
-    ]
-    if not match_lsb.empty:
-        return 1
-    
-    # Buscar en artefactos
-    match_art = art_df[
-        (abs(art_df['ra'] - ra) < 0.001) & 
-        (abs(art_df['dec'] - dec) < 0.001)
-    ]
-    if not match_art.empty:
-        return 0
-    
-    return 0
+# Etiquetas de todas las imágenes en una llamada (KD-tree, crossmatch.py)
+def get_labels(files, lsb_index, art_index, tol_arcsec=DEFAULT_TOL_ARCSEC):
+    coords = [parse_filename(f) for f in files]
+    ra = np.array([c[0] if c[0] is not None else np.nan for c in coords], dtype=np.float64)
+    dec = np.array([c[1] if c[1] is not None else np.nan for c in coords], dtype=np.float64)
+    return crossmatch_labels(ra, dec, lsb_index, art_index, tol_arcsec)
+
+# Etiquetas desde el manifest de descarga: coordenadas exactas del catálogo
+# de origen y etiqueta conocida; el cross-match solo cubre las filas sin ella.
+# load_indexes() devuelve los índices de los catálogos y solo se llama si
+# alguna fila no tiene etiqueta
+def get_manifest_labels(jpeg_dir, load_indexes, tol_arcsec=DEFAULT_TOL_ARCSEC):
+    manifest = read_manifest(jpeg_dir)
+    labels = manifest['label'].to_numpy(dtype=np.int32)
+    unknown = labels < 0
+    matches = pd.DataFrame({
+        'ra': manifest['ra'].to_numpy(dtype=np.float64),
+        'dec': manifest['dec'].to_numpy(dtype=np.float64),
+        'expected_label': labels,
+        'dual': np.zeros(len(manifest), dtype=bool),
+        'ambiguous': np.zeros(len(manifest), dtype=bool),
+    })
+    if unknown.any():
+        lsb_index, art_index = load_indexes()
+        matched = crossmatch_labels(matches['ra'].to_numpy()[unknown],
+                                    matches['dec'].to_numpy()[unknown],
+                                    lsb_index, art_index, tol_arcsec)
+        for column in ('expected_label', 'dual', 'ambiguous'):
+            matches.loc[unknown, column] = matched[column].to_numpy()
+    print(f"Etiquetas del manifest: {(~unknown).sum()} | Por cross-match: {unknown.sum()}")
+    return matches
+
+def main():
+    parser = argparse.ArgumentParser(description="Build y_{set}.npy label arrays")
+    parser.add_argument("--manifest", action="store_true",
+                        help="Align on the download manifest (same order as rebuild_image_arrays.py --manifest)")
+    args = parser.parse_args()
+
+    # Índices espaciales de los catálogos (una sola vez y solo si hacen falta)
+    indexes = []
+    def load_indexes():
+        if not indexes:
+            indexes.extend(load_catalog_indexes(LSB_PATH, ARTIFACT_PATH))
+        return indexes
+
+    for set_name, jpeg_dir in JPEG_DIRS.items():
+        print(f"\nProcesando conjunto: {set_name}")
+        
+        if args.manifest:
+            matches = get_manifest_labels(jpeg_dir, load_indexes)
+        else:
+            # Obtener archivos ordenados
+            files = sorted([f for f in os.listdir(jpeg_dir) 
+                          if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
+            
+            # Asignar etiquetas
+            matches = get_labels(files, *load_indexes())
+        
+        # Guardar array
+        labels_array = matches['expected_label'].to_numpy(dtype=np.int32)
+        output_path = os.path.join(OUTPUT_DIR, f'y_{set_name}.npy')
+        np.save(output_path, labels_array)
+        
+        # Estadísticas
+        galaxy_count = np.sum(labels_array == 1)
+        print(f"Guardado {output_path} con {len(labels_array)} etiquetas")
+        print(f"Galaxias: {galaxy_count} ({galaxy_count/len(labels_array):.2%})")
+        print(f"Artefactos: {len(labels_array) - galaxy_count}")
+        print(f"En ambos catálogos: {matches['dual'].sum()} | Ambiguas: {matches['ambiguous'].sum()}")
 
-for set_name, jpeg_dir in JPEG_DIRS.items():
-    print(f"\nProcesando conjunto: {set_name}")
-    
-    # Obtener archivos ordenados
-    files = sorted([f for f in os.listdir(jpeg_dir) 
-                  if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
-    
-    # Asignar etiquetas
-    labels = []
-    for filename in tqdm(files, desc="Asignando etiquetas"):
-        ra, dec = parse_filename(filename)
-        label = get_label(ra, dec)
-        labels.append(label)
-    
-    # Guardar array
-    labels_array = np.array(labels, dtype=np.int32)
-    output_path = os.path.join(OUTPUT_DIR, f'y_{set_name}.npy')
-    np.save(output_path, labels_array)
-    
-    # Estadísticas
-    galaxy_count = np.sum(labels_array == 1)
-    print(f"Guardado {output_path} con {len(labels_array)} etiquetas")
-    print(f"Galaxias: {galaxy_count} ({galaxy_count/len(labels_array):.2%})")
-    print(f"Artefactos: {len(labels_array) - galaxy_count}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+import io
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from mock_legacy_server import synthetic_jpeg
+from preprocessing import CROP_MODES, TARGET_SIZE, FAST_TOLERANCE, preprocess, preprocess_draft
+
+# Informe de precisión/velocidad del camino rápido de preprocesado
+# (decodificación JPEG reducida + remuestreo barato) frente al actual
+# (decodificación completa + LANCZOS).
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+VARIANTS = {
+    'draft+lanczos': Image.LANCZOS,
+    'draft+bicubic': Image.BICUBIC,
+    'draft+bilinear': Image.BILINEAR,
+    'draft+box': Image.BOX,
+}
+
+
+def load_sample(input_dir, n):
+    """Bytes de hasta n JPEGs del directorio, o sintéticos si no hay directorio"""
+    if input_dir and os.path.isdir(input_dir):
+        files = sorted(f for f in os.listdir(input_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+        sample = []
+        for f in files[:n]:
+            with open(os.path.join(input_dir, f), 'rb') as fh:
+                sample.append(fh.read())
+        if sample:
+            return sample, input_dir
+    return [synthetic_jpeg(256, seed=i) for i in range(n)], 'synthetic'
+
+
+def run(sample, func, repeats):
+    """Aplica func a cada JPEG; devuelve (arrays, imágenes/s)"""
+    outputs = [func(content) for content in sample]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for content in sample:
+            func(content)
+    elapsed = time.perf_counter() - start
+    return np.stack(outputs), repeats * len(sample) / elapsed
+
+
+def report(sample, crop_mode='fraction', target_size=TARGET_SIZE, tolerance=FAST_TOLERANCE, repeats=3):
+    def reference(content):
+        with Image.open(io.BytesIO(content)) as img:
+            return preprocess(img, crop_mode, target_size)
+
+    ref, ref_rate = run(sample, reference, repeats)
+    ref = ref.astype(np.float64)
+
+    print(f"{'variant':16s} {'img/s':>8s} {'speedup':>8s} {'MAE':>6s} {'p99':>6s} "
+          f"{'max':>5s} {'PSNR':>6s}  within tol")
+    print(f"{'full+lanczos':16s} {ref_rate:8.1f} {1.0:8.2f} {0:6.2f} {0:6.1f} {0:5d} {'inf':>6s}  ref")
+
+    results = {}
+    for name, resample in VARIANTS.items():
+        def fast(content, resample=resample):
+            with Image.open(io.BytesIO(content)) as img:
+                return preprocess_draft(img, crop_mode, target_size, resample=resample)
+
+        out, rate = run(sample, fast, repeats)
+        diff = np.abs(out.astype(np.float64) - ref)
+        mae = diff.mean()
+        p99 = np.percentile(diff, 99)
+        mse = (diff ** 2).mean()
+        psnr = 10 * np.log10(255.0 ** 2 / mse) if mse > 0 else float('inf')
+        ok = mae <= tolerance
+        results[name] = (rate / ref_rate, mae, ok)
+        print(f"{name:16s} {rate:8.1f} {rate / ref_rate:8.2f} {mae:6.2f} {p99:6.1f} "
+              f"{int(diff.max()):5d} {psnr:6.1f}  {'yes' if ok else 'no'}")
+
+    candidates = [(speedup, name) for name, (speedup, _, ok) in results.items() if ok]
+    if candidates:
+        speedup, name = max(candidates)
+        print(f"\nFastest variant within MAE <= {tolerance} (0-255 units): {name} ({speedup:.2f}x)")
+    else:
+        print(f"\nNo variant within MAE <= {tolerance}; keep full decode + LANCZOS")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy/speed report for draft-mode decoding")
+    parser.add_argument("--input-dir", default='../Datasets_DeepShadows/Jpeg_data/Test/',
+                        help="JPEG directory (synthetic cutouts if missing)")
+    parser.add_argument("--n", type=int, default=500, help="Number of images")
+    parser.add_argument("--crop-mode", choices=CROP_MODES, default=None,
+                        help="Crop mode (default: both)")
+    parser.add_argument("--tolerance", type=float, default=FAST_TOLERANCE,
+                        help="Max mean absolute error in 0-255 units")
+    parser.add_argument("--repeats", type=int, default=3, help="Timing repetitions")
+    args = parser.parse_args()
+
+    sample, source = load_sample(args.input_dir, args.n)
+    for crop_mode in ([args.crop_mode] if args.crop_mode else CROP_MODES):
+        print(f"\n=== {len(sample)} images from {source}, crop_mode={crop_mode}, "
+              f"target={TARGET_SIZE} ===")
+        report(sample, crop_mode, TARGET_SIZE, args.tolerance, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+import csv
+import time
+import heapq
+import random
+import logging
+import threading
+
+import pandas as pd
+
+# Cola de reintentos y registro de objetos fallidos para las descargas.
+#
+# En lugar de dormir dentro del hilo de descarga, un objeto que falla con
+# un error reintentable (429/5xx o error de red) vuelve a la cola con un
+# instante de disponibilidad now + backoff exponencial con jitter completo;
+# mientras tanto los hilos siguen con otros objetos. Cada intento fallido
+# se guarda en el checkpoint (estado failed, motivo y número de intentos),
+# así que la cola sobrevive a un corte: al reanudar, los objetos no
+# completados vuelven a planificarse. Al terminar se escribe el registro
+# failed_objects.csv con coordenadas y motivo de los que agotaron su
+# presupuesto de intentos o fallaron de forma definitiva (p.ej. 404).
+
+LEDGER_FILE = 'failed_objects.csv'
+LEDGER_COLUMNS = ['ra', 'dec', 'size', 'layer', 'pixscale', 'bands', 'reason', 'attempts',
+                  'file_path']
+
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Espera antes del intento attempt + 1 (exponencial con jitter completo)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RetryQueue:
+    """Cola de objetos por instante de disponibilidad, con presupuesto de intentos"""
+
+    def __init__(self, items=(), max_attempts=DEFAULT_MAX_ATTEMPTS, base=BACKOFF_BASE,
+                 cap=BACKOFF_CAP):
+        """
+        items: objetos disponibles desde ya (hashables)
+        max_attempts: intentos por objeto en esta ejecución
+        """
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self._heap = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.attempts = {}
+        self.retried = 0
+        self.exhausted = 0
+        for item in items:
+            self.push(item)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, delay=0.0):
+        with self._lock:
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, item))
+            self._seq += 1
+
+    def retry(self, item):
+        """Registra un intento fallido; True si el objeto vuelve a la cola"""
+        attempts = self.attempts.get(item, 0) + 1
+        self.attempts[item] = attempts
+        if attempts >= self.max_attempts:
+            self.exhausted += 1
+            return False
+        self.retried += 1
+        self.push(item, backoff_delay(attempts - 1, self.base, self.cap))
+        return True
+
+    def pop_ready(self, limit):
+        """Hasta limit objetos cuyo instante de disponibilidad ya pasó"""
+        ready = []
+        now = time.monotonic()
+        with self._lock:
+            while self._heap and len(ready) < limit and self._heap[0][0] <= now:
+                ready.append(heapq.heappop(self._heap)[2])
+        return ready
+
+    def wait_time(self):
+        """Segundos hasta el próximo objeto disponible (None si la cola está vacía)"""
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - time.monotonic())
+
+
+def failed_ledger_path(checkpoint_path):
+    """Registro junto a su checkpoint
+
+    download_checkpoint.db -> failed_objects.csv y
+    download_checkpoint.shard0of4.db -> failed_objects.shard0of4.csv
+    """
+    directory, name = os.path.split(checkpoint_path)
+    stem = os.path.splitext(name)[0]
+    prefix = 'download_checkpoint'
+    if stem.startswith(prefix):
+        return os.path.join(directory, LEDGER_FILE.replace('.csv', stem[len(prefix):] + '.csv'))
+    return os.path.join(directory, stem + '_' + LEDGER_FILE)
+
+
+def write_failed_ledger(store, ledger_path=None):
+    """Escribe los objetos en estado failed del checkpoint con coordenadas y motivo"""
+    ledger_path = ledger_path or failed_ledger_path(store.db_path)
+    rows = store.failed()
+    tmp_path = ledger_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LEDGER_COLUMNS)
+        writer.writerows(rows)
+    os.replace(tmp_path, ledger_path)
+    if rows:
+        logging.warning(f"{len(rows)} failed objects written to {ledger_path}")
+    return len(rows)
+
+
+def read_failed_ledger(ledger_path):
+    """Registro de fallidos como DataFrame (vacío si no existe)"""
+    if not os.path.exists(ledger_path):
+        return pd.DataFrame(columns=LEDGER_COLUMNS)
+    # round_trip: ra/dec exactos para reconstruir la clave del checkpoint
+    return pd.read_csv(ledger_path, dtype={'layer': str, 'bands': str, 'file_path': str},
+                       float_precision='round_trip')
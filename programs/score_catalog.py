@@ -0,0 +1,356 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import logging
+import argparse
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import CROP_MODES, TARGET_SIZE, CROP_FACTOR, calibrate_fast
+from preprocess_cache import PreprocessCache, cached_preprocess_path, DEFAULT_MAX_BYTES
+from download_plan import build_download_plan
+from manifest import read_manifest
+from export_model import load_scorer
+
+# Puntuación por lotes de catálogos grandes con la CNN.
+#
+# La tabla de trabajo (ra, dec y ruta de cada cutout, o fila de un dataset
+# empaquetado) se divide en batches fijos. Un pool de procesos carga el
+# modelo una vez por worker y puntúa cada batch; el proceso principal
+# escribe cada batch terminado como un fichero Parquet propio
+# (part-XXXXXXXX.parquet, escrito con rename atómico). run.json guarda el
+# hash de la tabla de trabajo ordenada, batch_size y el rango de filas de
+# cada parte escrita; al reanudar solo se saltan las partes que constan ahí
+# y, si la tabla o batch_size han cambiado, se rechaza la reanudación.
+
+PART_PATTERN = 'part-{:08d}.parquet'
+RUN_MANIFEST = 'run.json'
+
+# Estado de cada worker (se carga una vez en _init_worker)
+_worker_model = None
+_worker_source = None
+_worker_options = None
+_worker_cache = None
+
+
+def _init_worker(model_path, threads, packed_path, options):
+    global _worker_model, _worker_source, _worker_options, _worker_cache
+    # .keras configura los hilos de TensorFlow; .tflite/.onnx no lo importan
+    if options.get('prefilter'):
+        from cascade import load_cascade
+        _worker_model = load_cascade(options['prefilter'], options['prefilter_threshold'],
+                                     model_path, threads)
+    else:
+        _worker_model = load_scorer(model_path, threads)
+    if packed_path:
+        from input_pipeline import ArraySource
+        _worker_source = ArraySource.from_packed(packed_path)
+    elif options.get('cache_dir'):
+        _worker_cache = PreprocessCache(options['cache_dir'], options['cache_max_bytes'],
+                                        reconcile=False)
+    _worker_options = options
+
+
+def _load_images(paths):
+    """Cutouts de disco preprocesados; NaN en el score si alguno falla"""
+    opts = _worker_options
+    images = np.zeros((len(paths),) + tuple(opts['target_size']) + (3,), dtype=np.uint8)
+    valid = np.ones(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        try:
+            images[i] = cached_preprocess_path(path, _worker_cache, opts['crop_mode'],
+                                               tuple(opts['target_size']), CROP_FACTOR,
+                                               opts['fast'])
+        except Exception as e:
+            logging.warning(f"Cannot read {path}: {e}")
+            valid[i] = False
+    return images, valid
+
+
+def _score_batch(batch_id, ra, dec, paths=None, rows=None):
+    """Puntúa un batch; devuelve (batch_id, DataFrame, segundos de cómputo, hits, misses)"""
+    start = time.perf_counter()
+    cache = _worker_cache
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    if rows is not None:
+        images, _ = _worker_source.read_block(*rows)
+        valid = np.ones(len(images), dtype=bool)
+    else:
+        images, valid = _load_images(paths)
+    x = images.astype(np.float32)
+    if images.dtype == np.uint8:
+        x /= 255.0
+
+    score = np.full(len(x), np.nan, dtype=np.float32)
+    if valid.any():
+        score[valid] = _worker_model(x[valid])
+    result = pd.DataFrame({'ra': ra, 'dec': dec, 'score': score})
+    elapsed = time.perf_counter() - start
+    if cache is None:
+        return batch_id, result, elapsed, 0, 0
+    cache.flush()
+    return batch_id, result, elapsed, cache.hits - hits, cache.misses - misses
+
+
+def work_table(catalog=None, manifest=None, packed=None, jpeg_dir=None, radii_default=256):
+    """Tabla (ra, dec, file_path) o (ra, dec) para packed, en orden estable"""
+    if packed:
+        from packed_dataset import PackedDataset
+        index = PackedDataset(packed).index
+        return index[['ra', 'dec']].reset_index(drop=True)
+    if manifest:
+        return read_manifest(manifest)[['ra', 'dec', 'file_path']]
+    data = pd.read_csv(catalog)
+    plan = build_download_plan(data, jpeg_dir, radii_default)
+    missing = int((~plan['exists']).sum())
+    if missing:
+        logging.warning(f"{missing} catalog objects have no cutout in {jpeg_dir}; skipped")
+    return plan.loc[plan['exists'], ['ra', 'dec', 'file_path']].reset_index(drop=True)
+
+
+class RunMismatchError(ValueError):
+    """Las partes del directorio de salida son de otra tabla o batch_size"""
+
+
+def table_digest(table):
+    """Hash de la tabla de trabajo en su orden (ra, dec y file_path si existe)"""
+    hashes = pd.util.hash_pandas_object(table, index=False).to_numpy()
+    return hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest()
+
+
+def _write_run_manifest(output_dir, run):
+    path = os.path.join(output_dir, RUN_MANIFEST)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(run, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def load_run(output_dir, table, batch_size, restart=False):
+    """Manifest de la ejecución; comprueba que las partes existentes encajan.
+
+    Devuelve el dict del manifest (parts: batch_id -> [start, stop]). Si el
+    directorio tiene partes de otra tabla o de otro batch_size lanza
+    RunMismatchError, salvo con restart=True, que las borra y empieza de cero.
+    """
+    digest = table_digest(table)
+    path = os.path.join(output_dir, RUN_MANIFEST)
+    existing = glob.glob(os.path.join(output_dir, 'part-*.parquet'))
+    run = None
+    if os.path.exists(path):
+        with open(path) as f:
+            run = json.load(f)
+
+    matches = (run is not None and run['table_digest'] == digest
+               and run['batch_size'] == batch_size and run['rows'] == len(table))
+    if not matches and (existing or run is not None):
+        if not restart:
+            reason = ("no run manifest" if run is None
+                      else "work table or batch size changed since the previous run")
+            raise RunMismatchError(f"Cannot resume in {output_dir}: {reason}. "
+                             f"Use a new output directory or restart=True (--restart)")
+        logging.warning(f"Discarding {len(existing)} previous parts in {output_dir}")
+        for part in existing:
+            os.remove(part)
+        run = None
+
+    if run is None:
+        run = {'table_digest': digest, 'batch_size': batch_size, 'rows': len(table),
+               'parts': {}}
+        _write_run_manifest(output_dir, run)
+    return run
+
+
+def done_batches(output_dir, run):
+    """Batches registrados en el manifest con su fichero presente (reanudación)"""
+    done = set()
+    for batch_id, (start, stop) in run['parts'].items():
+        batch_id = int(batch_id)
+        expected = (batch_id * run['batch_size'],
+                    min((batch_id + 1) * run['batch_size'], run['rows']))
+        path = os.path.join(output_dir, PART_PATTERN.format(batch_id))
+        if (start, stop) == expected and os.path.exists(path):
+            done.add(batch_id)
+    return done
+
+
+def write_part(output_dir, batch_id, result):
+    """Escribe un batch con rename atómico (sin ficheros a medias tras un fallo)"""
+    path = os.path.join(output_dir, PART_PATTERN.format(batch_id))
+    tmp_path = path + '.tmp'
+    result.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def score_catalog(table, model_path, output_dir, batch_size=1024, workers=None, threads=1,
+                  packed=None, crop_mode='fraction', target_size=TARGET_SIZE, fast=False,
+                  prefilter=None, prefilter_threshold=None, cache_dir=None,
+                  cache_max_bytes=DEFAULT_MAX_BYTES, restart=False):
+    """Puntúa table en batches fijos con un pool de procesos; reanudable
+
+    Con cache_dir los cutouts preprocesados se reutilizan entre ejecuciones
+    (preprocess_cache.py); no aplica a datasets empaquetados. restart=True
+    descarta las partes de una ejecución con otra tabla o batch_size.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for tmp_path in glob.glob(os.path.join(output_dir, '*.tmp')):
+        os.remove(tmp_path)
+
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    n_batches = -(-len(table) // batch_size)
+    run = load_run(output_dir, table, batch_size, restart)
+    done = done_batches(output_dir, run)
+    pending = [b for b in range(n_batches) if b not in done]
+    pending_rows = sum(min((b + 1) * batch_size, len(table)) - b * batch_size for b in pending)
+    logging.info(f"{len(table)} objects in {n_batches} batches of {batch_size}: "
+                 f"{len(done)} done, {len(pending)} to score with {workers} workers "
+                 f"x {threads} threads")
+    if not pending:
+        return {'scored': 0}
+
+    ra = table['ra'].to_numpy()
+    dec = table['dec'].to_numpy()
+    paths = table['file_path'].to_numpy() if 'file_path' in table.columns else None
+    if fast and not packed and paths is not None:
+        # Camino rápido solo si en una muestra queda dentro de FAST_TOLERANCE
+        fast = calibrate_fast(paths, crop_mode, tuple(target_size))
+    if cache_dir and not packed:
+        # Recuperar entradas de ejecuciones cortadas una sola vez, antes de los workers
+        PreprocessCache(cache_dir, cache_max_bytes).close()
+    options = {'crop_mode': crop_mode, 'target_size': list(target_size), 'fast': fast,
+               'prefilter': prefilter, 'prefilter_threshold': prefilter_threshold,
+               'cache_dir': cache_dir, 'cache_max_bytes': cache_max_bytes}
+
+    def batch_rows(batch_id):
+        return batch_id * batch_size, min((batch_id + 1) * batch_size, len(table))
+
+    def submit(executor, batch_id):
+        start, stop = batch_rows(batch_id)
+        if packed:
+            return executor.submit(_score_batch, batch_id, ra[start:stop], dec[start:stop],
+                                   rows=(start, stop))
+        return executor.submit(_score_batch, batch_id, ra[start:stop], dec[start:stop],
+                               paths=list(paths[start:stop]))
+
+    scored = 0
+    parts = 0
+    compute_time = 0.0
+    cache_hits = cache_misses = 0
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_path, threads, packed, options)) as executor:
+        # Como mucho 2 batches en cola por worker: memoria acotada
+        queue = iter(pending)
+        in_flight = {submit(executor, b) for b in islice(queue, 2 * workers)}
+        while in_flight:
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                batch_id, result, elapsed, hits, misses = future.result()
+                cache_hits += hits
+                cache_misses += misses
+                write_part(output_dir, batch_id, result)
+                # La parte solo cuenta como hecha cuando consta en el manifest
+                run['parts'][str(batch_id)] = list(batch_rows(batch_id))
+                _write_run_manifest(output_dir, run)
+                scored += len(result)
+                parts += 1
+                compute_time += elapsed
+                next_batch = next(queue, None)
+                if next_batch is not None:
+                    in_flight.add(submit(executor, next_batch))
+                if parts % 20 == 0:
+                    rate = scored / (time.perf_counter() - start_time)
+                    logging.info(f"Scored {scored}/{pending_rows} pending "
+                                 f"({rate:.0f} objects/s)")
+
+    wall = time.perf_counter() - start_time
+    cores = workers * threads
+    stats = {
+        'scored': scored,
+        'seconds': wall,
+        'objects_per_s': scored / wall,
+        'objects_per_core_s': scored / wall / cores,
+        'objects_per_worker_busy_s': scored / compute_time if compute_time else 0.0,
+        'cache_hits': cache_hits,
+        'cache_misses': cache_misses,
+    }
+    logging.info(f"Scored {scored} objects in {wall:.1f}s: {stats['objects_per_s']:.0f} objects/s, "
+                 f"{stats['objects_per_core_s']:.0f} objects/s per core "
+                 f"({cores} cores), {stats['objects_per_worker_busy_s']:.0f} objects/s per busy "
+                 f"worker")
+    if cache_dir and not packed:
+        lookups = cache_hits + cache_misses
+        logging.info(f"Preprocess cache {cache_dir}: {cache_hits} hits, {cache_misses} misses "
+                     f"({cache_hits / lookups if lookups else 0:.1%} hit rate)")
+    return stats
+
+
+def read_scores(output_dir):
+    """Todos los batches puntuados, en el orden de la tabla de trabajo"""
+    parts = sorted(glob.glob(os.path.join(output_dir, 'part-*.parquet')))
+    if not parts:
+        return pd.DataFrame(columns=['ra', 'dec', 'score'])
+    return pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a cutout catalog with the DeepShadows CNN")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--catalog", help="CSV with ra/dec (cutouts looked up in --jpeg-dir)")
+    source.add_argument("--manifest", help="Download manifest (file or directory)")
+    source.add_argument("--packed", help="Packed dataset directory (download_to_dataset.py)")
+    parser.add_argument("--jpeg-dir", default=None, help="Cutout directory for --catalog")
+    parser.add_argument("--radii_default", type=int, default=256)
+    parser.add_argument("--model", required=True,
+                        help="Trained model (.keras, or .tflite/.onnx from export_model.py)")
+    parser.add_argument("--output", required=True, help="Output directory of Parquet parts")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: cores / threads)")
+    parser.add_argument("--threads", type=int, default=1, help="TensorFlow threads per worker")
+    parser.add_argument("--crop-mode", choices=CROP_MODES, default="fraction")
+    parser.add_argument("--fast", action="store_true", help="Draft JPEG decoding")
+    parser.add_argument("--prefilter", default=None,
+                        help="Stage-1 classical model (cascade.py); rejected objects score 0")
+    parser.add_argument("--prefilter-threshold", type=float, default=None,
+                        help="Stage-1 threshold tuned by cascade.py")
+    parser.add_argument("--cache", default=None, metavar="DIR",
+                        help="Reuse preprocessed cutouts across runs (preprocess_cache.py)")
+    parser.add_argument("--cache-max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="Cache size bound (LRU eviction)")
+    parser.add_argument("--restart", action="store_true",
+                        help="Discard parts of a previous run with a different table/batch size")
+    parser.add_argument("--merge", default=None,
+                        help="Also write all scores to this single Parquet file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.catalog and not args.jpeg_dir:
+        parser.error("--catalog requires --jpeg-dir")
+    if args.prefilter and args.prefilter_threshold is None:
+        parser.error("--prefilter requires --prefilter-threshold")
+    table = work_table(args.catalog, args.manifest, args.packed, args.jpeg_dir,
+                       args.radii_default)
+    try:
+        score_catalog(table, args.model, args.output, args.batch_size, args.workers,
+                      args.threads, args.packed, args.crop_mode, fast=args.fast,
+                      prefilter=args.prefilter, prefilter_threshold=args.prefilter_threshold,
+                      cache_dir=args.cache, cache_max_bytes=int(args.cache_max_gb * 1024 ** 3),
+                      restart=args.restart)
+    except RunMismatchError as e:
+        parser.error(str(e))
+
+    if args.merge:
+        scores = read_scores(args.output)
+        scores.to_parquet(args.merge, index=False)
+        logging.info(f"Merged {len(scores)} scores into {args.merge}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import glob
+import logging
+import argparse
+
+import numpy as np
+
+from checkpoint_store import CheckpointStore
+from manifest import merge_shard_manifests
+from retry_queue import write_failed_ledger
+
+# Particionado determinista del catálogo para descargas en paralelo.
+#
+# N procesos (en uno o varios nodos) ejecutan download_legacy con
+# --shard i/N sobre el mismo catálogo y el mismo directorio de salida.
+# Cada objeto pertenece a un único shard, así que no hay descargas
+# duplicadas; cada shard escribe su propio checkpoint y manifest, y
+# merge_shards los reconcilia en download_checkpoint.db / manifest.parquet.
+
+SHARD_CHECKPOINT = 'download_checkpoint.shard{index}of{total}.db'
+
+# Cuantización de coordenadas antes del hash (1e-6 grados ~ 3.6 mas)
+COORD_SCALE = 1e6
+
+
+def parse_shard(text):
+    """'i/N' -> (i, N) con 0 <= i < N"""
+    try:
+        index, total = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{text}', expected i/N")
+    if total < 1 or not 0 <= index < total:
+        raise ValueError(f"Invalid shard '{text}', need 0 <= i < N")
+    return index, total
+
+
+def _splitmix64(x):
+    """Mezcla de bits splitmix64 vectorizada (uint64, aritmética modular)"""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_shards(ra, dec, total):
+    """Shard por hash de (ra, dec); reparto uniforme e independiente del orden"""
+    ra_q = np.round(np.asarray(ra, dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    dec_q = np.round(np.asarray(dec, dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    with np.errstate(over='ignore'):
+        h = _splitmix64(ra_q.view(np.uint64) ^ _splitmix64(dec_q.view(np.uint64)))
+    return (h % np.uint64(total)).astype(np.int64)
+
+
+def healpix_shards(ra, dec, total, nside=64):
+    """Shard por rangos contiguos de píxeles HEALPix (NESTED): conserva la localidad"""
+    try:
+        import healpy as hp
+    except ImportError:
+        raise ImportError("healpy is required for --shard-scheme healpix. "
+                          "Install with: pip install healpy")
+    pix = hp.ang2pix(nside, np.asarray(ra), np.asarray(dec), nest=True, lonlat=True)
+    npix = hp.nside2npix(nside)
+    return (pix.astype(np.int64) * total // npix).astype(np.int64)
+
+
+def shard_ids(ra, dec, total, scheme='hash', nside=64):
+    if scheme == 'hash':
+        return hash_shards(ra, dec, total)
+    if scheme == 'healpix':
+        return healpix_shards(ra, dec, total, nside)
+    raise ValueError(f"Unknown shard scheme: {scheme}")
+
+
+def select_shard(data, index, total, scheme='hash', nside=64):
+    """Filas del catálogo que pertenecen al shard index/total (conserva el índice original)"""
+    ids = shard_ids(data['ra'].to_numpy(), data['dec'].to_numpy(), total, scheme, nside)
+    subset = data[ids == index]
+    logging.info(f"Shard {index}/{total} ({scheme}): {len(subset)} of {len(data)} objects")
+    return subset
+
+
+def shard_checkpoint_path(out_path, index, total):
+    return os.path.join(out_path, SHARD_CHECKPOINT.format(index=index, total=total))
+
+
+def merge_shards(out_path, checkpoint_file=None, remove=False):
+    """Reconcilia los checkpoints de shard en el checkpoint principal"""
+    if checkpoint_file is None:
+        checkpoint_file = os.path.join(out_path, 'download_checkpoint.db')
+    shard_files = sorted(glob.glob(os.path.join(out_path, 'download_checkpoint.shard*of*.db')))
+    if not shard_files:
+        logging.warning(f"No shard checkpoints found in {out_path}")
+        return
+
+    with CheckpointStore(checkpoint_file) as store:
+        for shard_file in shard_files:
+            merged, conflicts = store.merge_from(shard_file)
+            logging.info(f"Merged {merged} entries from {os.path.basename(shard_file)}"
+                         + (f" ({conflicts} already done elsewhere)" if conflicts else ""))
+        n_failed = write_failed_ledger(store)
+        logging.info(f"Checkpoint {checkpoint_file}: {len(store)} entries, {n_failed} failed")
+
+    merge_shard_manifests(out_path, remove=remove)
+
+    if remove:
+        for shard_file in shard_files:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(shard_file + suffix):
+                    os.remove(shard_file + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge per-shard download checkpoints")
+    parser.add_argument("output", help="Shared output directory")
+    parser.add_argument("--remove", action="store_true", help="Delete shard checkpoints after merge")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    merge_shards(args.output, remove=args.remove)
+
+
+if __name__ == "__main__":
+    main()
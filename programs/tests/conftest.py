@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Los scripts de programs/ se importan como módulos planos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
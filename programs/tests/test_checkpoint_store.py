@@ -0,0 +1,46 @@
+import os
+
+from checkpoint_store import make_key, open_checkpoint, parse_checkpoint_line
+
+
+def test_parse_both_filename_formats():
+    # download_legacy: {ra}_{dec}_{idx}_{size}pix.jpeg (size "256.0" en tablas numéricas)
+    assert parse_checkpoint_line('out/150.1_2.5_7_256pix.jpeg\n')[0] == make_key(150.1, 2.5, 256)
+    assert parse_checkpoint_line('out/150.1_2.5_7_256.0pix.jpeg')[0] == make_key(150.1, 2.5, 256)
+    # Notebooks: {ra}_{dec}_{size}pix.jpeg, sin índice
+    assert parse_checkpoint_line('Training//26.108572_-6.439318_128pix.jpeg')[0] == \
+        make_key(26.108572, -6.439318, 128)
+    assert parse_checkpoint_line('notes.txt') is None
+    assert parse_checkpoint_line('\n') is None
+
+
+def test_import_text_checkpoint(tmp_path):
+    lines = [
+        'Training//26.108572_-6.439318_128pix.jpeg',
+        'Training//16.885239000000002_-19.114691_128pix.jpeg',
+        'legacy_color_images/150.1_2.5_7_256pix.jpeg',
+        'legacy_color_images/150.2_-2.5_8_256.0pix.jpeg',
+        # Duplicado y línea no reconocida
+        'Training//26.108572_-6.439318_128pix.jpeg',
+        'garbage',
+    ]
+    (tmp_path / 'download_checkpoint.txt').write_text('\n'.join(lines) + '\n')
+
+    store = open_checkpoint(str(tmp_path))
+    try:
+        assert len(store) == 4
+        assert store.is_done(make_key(26.108572, -6.439318, 128))
+        assert store.is_done(make_key(16.885239000000002, -19.114691, 128))
+        assert store.is_done(make_key(150.1, 2.5, 256))
+        assert store.is_done(make_key(150.2, -2.5, 256))
+        assert store.is_done_path('legacy_color_images/150.1_2.5_7_256pix.jpeg')
+    finally:
+        store.close()
+
+    # El .txt solo se importa al crear la base de datos
+    store = open_checkpoint(str(tmp_path))
+    try:
+        assert len(store) == 4
+    finally:
+        store.close()
+    assert os.path.exists(tmp_path / 'download_checkpoint.db')
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('astropy')
+
+from mock_legacy_server import synthetic_fits
+from download_plan import build_download_plan
+from fits_cutouts import FitsCube, FitsCubeWriter, pack_fits, read_fits_cutout
+
+SIZE = 32
+
+
+@pytest.fixture
+def fits_plan(tmp_path):
+    """Catálogo de 10 objetos con sus FITS sintéticos ya en disco"""
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'ra': rng.uniform(0, 360, 10), 'dec': rng.uniform(-60, 30, 10),
+                         'label': rng.integers(0, 2, 10)})
+    fits_dir = str(tmp_path / 'fits')
+    os.makedirs(fits_dir)
+    plan = build_download_plan(data, fits_dir, SIZE, extension='fits')
+    for seed, (ra, dec, file_path) in enumerate(zip(plan['ra'], plan['dec'], plan['file_path'])):
+        with open(file_path, 'wb') as f:
+            f.write(synthetic_fits(SIZE, ra=ra, dec=dec, seed=seed))
+    plan = build_download_plan(data, fits_dir, SIZE, extension='fits')
+    assert plan['exists'].all()
+    return data, plan
+
+
+def _stamps(plan):
+    return np.stack([read_fits_cutout(p)[0] for p in plan['file_path']])
+
+
+def test_partial_band_read(tmp_path, fits_plan):
+    data, plan = fits_plan
+    cube_path = str(tmp_path / 'cube')
+    # Bloques de 4 stamps: las lecturas cruzan fronteras de bloque
+    assert pack_fits(plan, cube_path, data['label'], chunk_size=4) == len(plan)
+    expected = _stamps(plan)
+
+    cube = FitsCube(cube_path)
+    assert cube.bands == ['g', 'r', 'z']
+    np.testing.assert_array_equal(cube.band('r'), expected[:, 1])
+    np.testing.assert_array_equal(cube.read(3, 9, ['z', 'g']), expected[3:9][:, [2, 0]])
+    window = (8, 4, 24, 20)
+    np.testing.assert_array_equal(cube.read(0, len(cube), ['g'], window),
+                                  expected[:, [0], 4:20, 8:24])
+    np.testing.assert_array_equal(cube.view(['r'])[2:5], expected[2:5, 1, :, :, None])
+    np.testing.assert_array_equal(cube.labels, data['label'].to_numpy())
+    with pytest.raises(KeyError):
+        cube.read(0, 1, ['i'])
+
+
+def test_resume_without_duplicates(tmp_path, fits_plan):
+    data, plan = fits_plan
+    cube_path = str(tmp_path / 'cube')
+    expected = _stamps(plan)
+
+    # Primera ejecución con la mitad del catálogo
+    assert pack_fits(plan.iloc[:5], cube_path, data['label'], chunk_size=4) == 5
+
+    # Corte antes del flush: esas filas no cuentan y se sobrescriben
+    writer = FitsCubeWriter(cube_path, ['g', 'r', 'z'], (SIZE, SIZE), 4)
+    writer.append(expected[7], 1, 7, 0.0, 0.0, plan['file_name'].iloc[7])
+    del writer
+
+    assert pack_fits(plan, cube_path, data['label'], chunk_size=4) == 5
+    assert pack_fits(plan, cube_path, data['label'], chunk_size=4) == 0
+
+    cube = FitsCube(cube_path)
+    assert len(cube) == len(plan)
+    assert cube.index['file_name'].is_unique
+    assert cube.index['file_name'].tolist() == plan['file_name'].tolist()
+    np.testing.assert_array_equal(cube.read(0, len(cube)), expected)
+
+
+def test_writer_rejects_other_layout(tmp_path, fits_plan):
+    _, plan = fits_plan
+    cube_path = str(tmp_path / 'cube')
+    pack_fits(plan.iloc[:2], cube_path)
+    with pytest.raises(ValueError):
+        FitsCubeWriter(cube_path, ['g', 'r'], (SIZE, SIZE))
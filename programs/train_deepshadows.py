@@ -0,0 +1,235 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from input_pipeline import ArraySource, make_dataset, make_synthetic_split, ARRAY_DIR, LABEL_DIR
+
+# Entrenamiento de la CNN DeepShadows (Deep-Learning.ipynb) fuera de Jupyter.
+#
+# Mismo modelo y compilación que el notebook (3 bloques Conv2D/BN/MaxPool/
+# Dropout + Dense(1024), Adadelta lr 0.1, EarlyStopping y ReduceLROnPlateau)
+# con los datos en streaming desde input_pipeline.py y ajustes de CPU:
+# hilos intra/inter-op, oneDNN, mixed precision (bfloat16), XLA, semillas
+# deterministas y checkpoints reanudables.
+#
+# TensorFlow se importa dentro de configure_cpu(): las variables de entorno
+# de oneDNN y los hilos solo tienen efecto antes de inicializar el runtime.
+
+CHECKPOINT_DIR = '../Datasets_DeepShadows/checkpoints/'
+
+INPUT_SHAPE = (64, 64, 3)
+
+
+def configure_cpu(intra_op=None, inter_op=None, onednn=True, mixed_precision=False, seed=None,
+                  deterministic=False):
+    """Configura el runtime de TensorFlow para CPU y devuelve el módulo tf"""
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    os.environ['TF_ENABLE_ONEDNN_OPTS'] = '1' if onednn else '0'
+
+    import tensorflow as tf
+
+    if intra_op:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    if inter_op:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+    if mixed_precision:
+        # bfloat16: tipo nativo de las CPU con AVX512_BF16/AMX vía oneDNN
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    if seed is not None:
+        tf.keras.utils.set_random_seed(seed)
+    if deterministic:
+        tf.config.experimental.enable_op_determinism()
+    return tf
+
+
+def build_model(input_shape=INPUT_SHAPE, l2_conv=0.13, l2_dense=0.12, dropout=0.4):
+    """Modelo exacto del paper (Deep-Learning.ipynb)"""
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import (InputLayer, Conv2D, BatchNormalization,
+                                         MaxPool2D, Dropout, Flatten, Dense)
+    from tensorflow.keras import regularizers
+
+    layers = [InputLayer(shape=input_shape)]
+    for filters in (16, 32, 64):
+        layers += [
+            Conv2D(filters=filters, kernel_size=(3, 3), padding='same', activation='relu',
+                   kernel_regularizer=regularizers.l2(l2_conv)),
+            BatchNormalization(),
+            MaxPool2D(pool_size=(2, 2)),
+            Dropout(dropout),
+        ]
+    layers += [
+        Flatten(),
+        Dense(units=1024, activation='relu', kernel_regularizer=regularizers.l2(l2_dense)),
+        # Salida en float32 también con mixed precision (pérdida estable)
+        Dense(units=1, activation='sigmoid', dtype='float32'),
+    ]
+    return Sequential(layers)
+
+
+def compile_model(model, learning_rate=0.1, jit_compile=False):
+    """Compilación del paper: Adadelta + binary_crossentropy"""
+    import tensorflow as tf
+    from tensorflow.keras import optimizers
+
+    model.compile(optimizer=optimizers.Adadelta(learning_rate=learning_rate),
+                  loss='binary_crossentropy',
+                  metrics=['accuracy',
+                           tf.keras.metrics.Precision(name='precision'),
+                           tf.keras.metrics.Recall(name='recall')],
+                  jit_compile=jit_compile)
+    return model
+
+
+def make_epoch_timer(samples_per_epoch):
+    """Callback que mide tiempo y muestras/s de cada época (incluye validación)"""
+    import tensorflow as tf
+
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def __init__(self):
+            super().__init__()
+            self.epochs = []
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self._start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            elapsed = time.perf_counter() - self._start
+            self.epochs.append({'epoch': epoch + 1, 'seconds': elapsed,
+                                'samples': samples_per_epoch,
+                                'samples_per_s': samples_per_epoch / elapsed})
+            print(f"  epoch {epoch + 1}: {elapsed:.1f}s, "
+                  f"{samples_per_epoch / elapsed:.0f} samples/s")
+
+    return EpochTimer()
+
+
+def make_callbacks(checkpoint_dir, patience=10, lr_patience=5):
+    """Callbacks del notebook más checkpoints y reanudación"""
+    from tensorflow.keras.callbacks import (EarlyStopping, ReduceLROnPlateau, ModelCheckpoint,
+                                            BackupAndRestore, CSVLogger)
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    return [
+        EarlyStopping(monitor='val_loss', patience=patience, restore_best_weights=True),
+        ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=lr_patience, min_lr=1e-6),
+        ModelCheckpoint(os.path.join(checkpoint_dir, 'best.keras'), monitor='val_loss',
+                        save_best_only=True),
+        # Estado completo por época: una ejecución interrumpida continúa donde se quedó
+        BackupAndRestore(os.path.join(checkpoint_dir, 'backup')),
+        CSVLogger(os.path.join(checkpoint_dir, 'history.csv'), append=True),
+    ]
+
+
+def train(array_dir=ARRAY_DIR, label_dir=LABEL_DIR, checkpoint_dir=CHECKPOINT_DIR, epochs=50,
+          batch_size=32, buffer_size=8192, learning_rate=0.1, jit_compile=False, seed=None,
+          steps_per_epoch=None, callbacks=True, evaluate=True):
+    """Entrena sobre X/y_{train,val} en streaming; devuelve (modelo, history, tiempos)"""
+    train_source = ArraySource.from_split('train', array_dir, label_dir)
+    val_source = ArraySource.from_split('val', array_dir, label_dir)
+    train_ds = make_dataset(train_source, batch_size, shuffle=True, buffer_size=buffer_size,
+                            seed=seed)
+    val_ds = make_dataset(val_source, batch_size, shuffle=False)
+    if steps_per_epoch:
+        train_ds = train_ds.repeat()
+
+    model = compile_model(build_model(train_source.sample_shape), learning_rate, jit_compile)
+    samples_per_epoch = steps_per_epoch * batch_size if steps_per_epoch else len(train_source)
+    timer = make_epoch_timer(samples_per_epoch)
+    callback_list = [timer] + (make_callbacks(checkpoint_dir) if callbacks else [])
+
+    print(f"\nComenzando entrenamiento en CPU: {len(train_source)} train, "
+          f"{len(val_source)} val")
+    history = model.fit(train_ds, epochs=epochs, steps_per_epoch=steps_per_epoch,
+                        validation_data=val_ds, callbacks=callback_list, verbose=2)
+
+    if callbacks:
+        model.save(os.path.join(checkpoint_dir, 'final.keras'))
+        with open(os.path.join(checkpoint_dir, 'epoch_times.json'), 'w') as f:
+            json.dump(timer.epochs, f, indent=1)
+
+    if evaluate and os.path.exists(os.path.join(label_dir, 'y_test.npy')):
+        evaluate_model(model, ArraySource.from_split('test', array_dir, label_dir), batch_size)
+    return model, history, timer.epochs
+
+
+def evaluate_model(model, source, batch_size=32):
+    """Métricas en test (como el notebook) más F1"""
+    print("\nEvaluando modelo...")
+    results = model.evaluate(make_dataset(source, batch_size, shuffle=False), verbose=0,
+                             return_dict=True)
+    precision, recall = results['precision'], results['recall']
+    results['f1'] = 2 * (precision * recall) / (precision + recall + 1e-7)
+
+    print("\nResultados finales en test set:")
+    for name, value in results.items():
+        print(f" - {name}: {value:.4f}")
+    return results
+
+
+def benchmark(n_samples=20000, epochs=2, batch_size=32, jit_compile=False, seed=0):
+    """Tiempo por época y muestras/s con datos sintéticos (sin checkpoints)"""
+    tmp = tempfile.mkdtemp(prefix='bench_train_')
+    try:
+        make_synthetic_split(tmp, n_samples, INPUT_SHAPE, seed)
+        shutil.copy(os.path.join(tmp, 'y_train.npy'), os.path.join(tmp, 'y_val.npy'))
+        os.symlink(os.path.join(tmp, 'X_train_u8.npy'), os.path.join(tmp, 'X_val_u8.npy'))
+        _, _, times = train(tmp, tmp, epochs=epochs, batch_size=batch_size,
+                            jit_compile=jit_compile, seed=seed, callbacks=False, evaluate=False)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # La primera época incluye el trazado/compilación del grafo
+    steady = times[1:] or times
+    print(f"\nTraining benchmark: {n_samples} samples, batch {batch_size}, {epochs} epochs")
+    print(f"  first epoch:  {times[0]['seconds']:7.1f}s")
+    print(f"  steady epoch: {np.mean([t['seconds'] for t in steady]):7.1f}s  "
+          f"{np.mean([t['samples_per_s'] for t in steady]):8.0f} samples/s")
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the DeepShadows CNN on CPU")
+    parser.add_argument("--array-dir", default=ARRAY_DIR)
+    parser.add_argument("--label-dir", default=LABEL_DIR)
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR,
+                        help="Best/final models, per-epoch backup (resume) and history")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--buffer", type=int, default=8192, help="Shuffle buffer (samples)")
+    parser.add_argument("--lr", type=float, default=0.1, help="Adadelta learning rate")
+    parser.add_argument("--intra-op", type=int, default=None,
+                        help="Threads inside one op (default: TensorFlow, all cores)")
+    parser.add_argument("--inter-op", type=int, default=None, help="Ops run in parallel")
+    parser.add_argument("--no-onednn", action="store_true", help="Disable oneDNN kernels")
+    parser.add_argument("--bf16", action="store_true", help="mixed_bfloat16 precision policy")
+    parser.add_argument("--xla", action="store_true", help="Compile train/eval steps with XLA")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for weights, shuffling and dropout")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="Deterministic ops (requires --seed, slower)")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="N",
+                        help="Benchmark epoch time on N synthetic samples instead of training")
+    parser.add_argument("--bench-epochs", type=int, default=2,
+                        help="Epochs for --benchmark (the first one includes tracing)")
+    args = parser.parse_args()
+
+    configure_cpu(args.intra_op, args.inter_op, not args.no_onednn, args.bf16, args.seed,
+                  args.deterministic)
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.bench_epochs, args.batch_size, args.xla, args.seed or 0)
+        return
+
+    train(args.array_dir, args.label_dir, args.checkpoint_dir, args.epochs, args.batch_size,
+          args.buffer, args.lr, args.xla, args.seed)
+
+
+if __name__ == "__main__":
+    main()